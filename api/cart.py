@@ -0,0 +1,481 @@
+import atexit
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections, connection, transaction
+from django.utils.module_loading import import_string
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+
+from littlelemon.models import LineItem, MenuItem, OrderItem, Cart
+
+from .snapshots import get_menu_version
+
+
+logger = logging.getLogger(__name__)
+
+# Caches that can't hold a lock for every process, which the cache cart
+# backend needs. The local memory and dummy caches aren't shared between
+# processes, and the file cache doesn't add keys atomically.
+UNLOCKABLE_CACHES = (LocMemCache, DummyCache, FileBasedCache)
+
+
+def run_cart_upsert(user, rows_sql, params, increment=True):
+    """
+    Inserts the cart items of `user` produced by `rows_sql`, a VALUES list or
+    SELECT of (user, menuitem, quantity, unit_price, price, state) rows, or
+    adds their quantity to the cart items already holding the same menu item
+    (sets it, without `increment`). Returns the resulting cart items.
+    """
+    opts = LineItem._meta
+    table = connection.ops.quote_name(opts.db_table)
+    column = {
+        name: connection.ops.quote_name(opts.get_field(name).column)
+        for name in ['id', 'user', 'menuitem', 'quantity', 'unit_price', 'price', 'state']
+    }
+    quantity_column, price_column = column['quantity'], column['price']
+    new_quantity = f'EXCLUDED.{quantity_column}'
+    if increment:
+        new_quantity = f'{table}.{quantity_column} + {new_quantity}'
+    # The conflict target names the partial unique index on cart items, with
+    # its condition spelled out as in the index so the databases match them.
+    sql = (
+        f'INSERT INTO {table} ({column["user"]}, {column["menuitem"]}, {quantity_column}, '
+        f'{column["unit_price"]}, {price_column}, {column["state"]}) {rows_sql} '
+        f"ON CONFLICT ({column['user']}, {column['menuitem']}) WHERE {column['state']} = '{LineItem.IN_CART}' DO UPDATE SET "
+        f'{quantity_column} = {new_quantity}, '
+        f'{column["unit_price"]} = EXCLUDED.{column["unit_price"]}, '
+        f'{price_column} = ({new_quantity}) * EXCLUDED.{column["unit_price"]} '
+        f'RETURNING {column["id"]}, {column["menuitem"]}, {quantity_column}, {column["unit_price"]}, {price_column}'
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    field = opts.get_field
+    return [
+        OrderItem(
+            id = order_item_id,
+            user = user,
+            menuitem_id = menuitem_id,
+            quantity = quantity,
+            unit_price = field('unit_price').to_python(unit_price),
+            price = field('price').to_python(price),
+        )
+        for order_item_id, menuitem_id, quantity, unit_price, price in rows
+    ]
+
+
+def upsert_cart_item(user, menuitem_id, quantity):
+    """
+    Adds `quantity` of a menu item to the cart items of `user` with a single
+    statement that prices the item from the menu. Returns the cart item, or
+    None if the menu item doesn't exist.
+    """
+    menu = connection.ops.quote_name(MenuItem._meta.db_table)
+    order_items = run_cart_upsert(
+        user,
+        f'SELECT %s, id, %s, price, price * %s, %s FROM {menu} WHERE id = %s',
+        [user.pk, quantity, quantity, LineItem.IN_CART, menuitem_id],
+    )
+    return order_items[0] if order_items else None
+
+
+def upsert_cart_items(user, quantities, prices, increment=True):
+    """
+    Adds the {menu item id: quantity} `quantities` to the cart items of
+    `user` with a single statement, priced from the {menu item id: price}
+    `prices`.
+    """
+    if not quantities:
+        return []
+    params = []
+    for menuitem_id, quantity in quantities.items():
+        price = prices[menuitem_id]
+        params += [user.pk, menuitem_id, quantity, price, price * quantity, LineItem.IN_CART]
+    values = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(quantities))
+    return run_cart_upsert(user, f'VALUES {values}', params, increment)
+
+
+def attach_to_cart(user, order_item_ids):
+    cart, _ = Cart.objects.get_or_create(user=user)
+    CartItems = Cart.orderitems.through
+    CartItems.objects.bulk_create(
+        [CartItems(cart_id=cart.pk, orderitem_id=order_item_id) for order_item_id in order_item_ids],
+        ignore_conflicts = True,
+    )
+    return cart
+
+
+def line_totals(lines):
+    return {
+        'count': len(lines),
+        'quantity': sum(line.quantity for line in lines),
+        'total': sum((line.price for line in lines), Decimal(0)),
+    }
+
+
+def summarize_cart(cart):
+    """Loads the cart items, with their menu items, and the totals of the cart."""
+    cart.lines = list(cart.orderitems.select_related('menuitem').order_by('id'))
+    cart.totals = line_totals(cart.lines)
+    return cart
+
+
+@transaction.atomic
+def add_cart_item(user, menuitem_id, quantity):
+    order_item = upsert_cart_item(user, menuitem_id, quantity)
+    if order_item is not None:
+        attach_to_cart(user, [order_item.pk])
+    return order_item
+
+
+@transaction.atomic
+def change_cart_items(user, quantities):
+    """
+    Adds the {menu item id: quantity} `quantities` to the cart of `user`,
+    where a negative quantity takes units out and drops the items left with
+    none. Returns the cart and the ids of the menu items that don't exist,
+    in which case nothing is changed.
+    """
+    prices = dict(MenuItem.objects.filter(pk__in=quantities).values_list('pk', 'price'))
+    missing = sorted(set(quantities) - set(prices))
+    if missing:
+        return None, missing
+    order_items = upsert_cart_items(user, quantities, prices)
+    emptied = [order_item.pk for order_item in order_items if order_item.quantity <= 0]
+    if emptied:
+        OrderItem.objects.filter(pk__in=emptied).delete()
+    cart = attach_to_cart(user, [order_item.pk for order_item in order_items if order_item.quantity > 0])
+    return cart, []
+
+
+def check_line_item(quantity, unit_price):
+    """Raises ValidationError unless the quantity and price fit the line-items table."""
+    low, high = connection.ops.integer_field_ranges[LineItem._meta.get_field('quantity').get_internal_type()]
+    price_field = LineItem._meta.get_field('price')
+    if not low <= quantity <= high or abs(unit_price * quantity) >= 10 ** (price_field.max_digits - price_field.decimal_places):
+        raise ValidationError({'quantity': 'the item quantity is out of range'})
+
+
+class CartBusy(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'The cart is busy, try again later.'
+    default_code = 'cart_busy'
+
+
+@contextmanager
+def cache_lock(key):
+    """
+    Holds `key` in the cache while the block runs, waiting up to
+    CART_LOCK_WAIT seconds for another process to release it, and raises
+    CartBusy after that. A lock left behind by a dead process expires after
+    CART_LOCK_TIMEOUT seconds.
+    """
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + settings.CART_LOCK_WAIT
+    while not cache.add(key, token, settings.CART_LOCK_TIMEOUT):
+        if time.monotonic() >= deadline:
+            raise CartBusy()
+        time.sleep(0.01)
+    try:
+        yield
+    finally:
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+def menu_prices():
+    """Returns the {menu item id: (title, price)} of the menu, cached by menu version."""
+    key = f'menu-prices:{get_menu_version()}'
+    prices = cache.get(key)
+    if prices is None:
+        prices = {pk: (title, price) for pk, title, price in MenuItem.objects.values_list('pk', 'title', 'price')}
+        cache.set(key, prices, settings.MENU_SNAPSHOT_TIMEOUT)
+    return prices
+
+
+class DatabaseCartBackend:
+    """
+    Writes every cart change to the Cart and OrderItem tables as it comes.
+    Backends that keep carts elsewhere implement the same methods:
+    `add_item(user, menuitem_id, quantity)` returns the cart item, or None if
+    the menu item doesn't exist, `change_items(user, quantities)` returns
+    the summarized cart and the ids of the menu items that don't exist,
+    `summarize(user)` returns the cart with its `lines` and `totals`,
+    `unwritten(user=None)` returns the {order-item id: quantity} changes and
+    the ids of the removed order-items of the cart of `user`, or of every
+    cart, not written to the tables yet, and
+    `flush(user=None)` writes the cart of `user`, or every cart, to the
+    tables before they are changed there.
+    """
+
+    def start(self):
+        pass
+
+    def add_item(self, user, menuitem_id, quantity):
+        return add_cart_item(user, menuitem_id, quantity)
+
+    def change_items(self, user, quantities):
+        cart, missing = change_cart_items(user, quantities)
+        if cart is not None:
+            summarize_cart(cart)
+        return cart, missing
+
+    def summarize(self, user):
+        cart, _ = Cart.objects.get_or_create(user=user)
+        return summarize_cart(cart)
+
+    def unwritten(self, user=None):
+        return {}, set()
+
+    def flush(self, user=None):
+        pass
+
+
+class CacheCartBackend:
+    """
+    Keeps the quantities of the carts changed through the cart endpoints in
+    the cache and writes them to the tables later. A menu item new to a cart
+    gets its order-item row right away, so every cart item has an id, and
+    only the quantity changes and removals wait in the cache. A cart is
+    written at checkout, before the cart and order-item endpoints change the
+    tables, and from the background thread of any process once it has gone
+    CART_FLUSH_AFTER seconds without being written. Reads of the tables show
+    the unwritten changes on top of them instead. The carts,
+    a lock per cart and the set of carts waiting to be written are all kept
+    in the cache, so every process has to share it.
+    """
+    pending_key = 'cart-pending'
+
+    def check(self):
+        if isinstance(caches['default'], UNLOCKABLE_CACHES):
+            raise ImproperlyConfigured(
+                'CacheCartBackend requires a cache shared by every process that adds keys atomically, '
+                'such as the database, Memcached or Redis cache. Set CACHE_BACKEND.'
+            )
+
+    def start(self):
+        self.check()
+        threading.Thread(target=self.write_behind, name='cart-flush', daemon=True).start()
+        atexit.register(self.flush)
+
+    def cache_key(self, user_id):
+        return f'cart:{user_id}'
+
+    def lock(self, user_id):
+        return cache_lock(f'cart-lock:{user_id}')
+
+    def pending(self):
+        """Returns the {user id: time of the first unwritten change} of the carts waiting to be written."""
+        return cache.get(self.pending_key) or {}
+
+    def set_pending(self, user_id, is_pending):
+        if (user_id in self.pending()) == is_pending:
+            return
+        with cache_lock(f'{self.pending_key}-lock'):
+            pending = self.pending()
+            if is_pending:
+                pending.setdefault(user_id, time.time())
+            else:
+                pending.pop(user_id, None)
+            cache.set(self.pending_key, pending, None)
+
+    def load(self, user):
+        state = cache.get(self.cache_key(user.pk))
+        if state is None:
+            cart, _ = Cart.objects.get_or_create(user=user)
+            state = {'cart': cart.pk, 'lines': {}, 'removed': {}, 'changed': False}
+            for order_item in cart.orderitems.all():
+                state['lines'][order_item.menuitem_id] = [order_item.pk, order_item.quantity]
+        return state
+
+    def store(self, user, state, was_changed):
+        cache.set(self.cache_key(user.pk), state, settings.CART_CACHE_TIMEOUT)
+        # A cart already changed is pending until it is flushed, which also
+        # drops its state, so only its first change has to mark it.
+        if state['changed'] and not was_changed:
+            self.set_pending(user.pk, True)
+
+    def apply(self, user, state, quantities, prices):
+        """
+        Adds the {menu item id: quantity} `quantities` to the cart `state`.
+        The order-items of the menu items new to the cart are created, and
+        the other changes are left in the state until it is written. Raises
+        ValidationError, changing nothing, if a quantity or price wouldn't
+        fit the line-items table.
+        """
+        lines, removed = state['lines'], state['removed']
+        new_quantities = {}
+        for menuitem_id, quantity in quantities.items():
+            new_quantity = quantity + (lines[menuitem_id][1] if menuitem_id in lines else 0)
+            if new_quantity > 0:
+                check_line_item(new_quantity, prices[menuitem_id][1])
+            new_quantities[menuitem_id] = new_quantity
+
+        created = {}
+        for menuitem_id, quantity in new_quantities.items():
+            if quantity <= 0:
+                if menuitem_id in lines:
+                    removed[menuitem_id] = lines.pop(menuitem_id)[0]
+                    state['changed'] = True
+            elif menuitem_id in lines:
+                lines[menuitem_id][1] = quantity
+                state['changed'] = True
+            elif menuitem_id in removed:
+                # The order-item waiting to be deleted is kept instead.
+                lines[menuitem_id] = [removed.pop(menuitem_id), quantity]
+                state['changed'] = True
+            else:
+                created[menuitem_id] = quantity
+        if created:
+            with transaction.atomic():
+                order_items = upsert_cart_items(
+                    user, created, {menuitem_id: prices[menuitem_id][1] for menuitem_id in created}, increment=False,
+                )
+                attach_to_cart(user, [order_item.pk for order_item in order_items])
+            for order_item in order_items:
+                lines[order_item.menuitem_id] = [order_item.pk, order_item.quantity]
+
+    def make_line(self, user, menuitem_id, line, prices):
+        title, unit_price = prices[menuitem_id]
+        return OrderItem(
+            id = line[0],
+            user = user,
+            menuitem = MenuItem(pk=menuitem_id, title=title, price=unit_price),
+            quantity = line[1],
+            unit_price = unit_price,
+            price = unit_price * line[1],
+        )
+
+    def add_item(self, user, menuitem_id, quantity):
+        prices = menu_prices()
+        if menuitem_id not in prices:
+            return None
+        with self.lock(user.pk):
+            state = self.load(user)
+            was_changed = state['changed']
+            self.apply(user, state, {menuitem_id: quantity}, prices)
+            self.store(user, state, was_changed)
+        return self.make_line(user, menuitem_id, state['lines'][menuitem_id], prices)
+
+    def change_items(self, user, quantities):
+        prices = menu_prices()
+        missing = sorted(set(quantities) - set(prices))
+        if missing:
+            return None, missing
+        with self.lock(user.pk):
+            state = self.load(user)
+            was_changed = state['changed']
+            self.apply(user, state, quantities, prices)
+            self.store(user, state, was_changed)
+        return self.make_cart(user, state, prices), []
+
+    def summarize(self, user):
+        # A read needs neither the lock nor a write: a cart not cached yet is
+        # only added, so it can't replace a change made meanwhile.
+        state = cache.get(self.cache_key(user.pk))
+        if state is None:
+            state = self.load(user)
+            cache.add(self.cache_key(user.pk), state, settings.CART_CACHE_TIMEOUT)
+        return self.make_cart(user, state, menu_prices())
+
+    def make_cart(self, user, state, prices):
+        # Menu items taken off the menu since they were added are left out.
+        cart = Cart(pk=state['cart'], user=user)
+        cart.lines = [
+            self.make_line(user, menuitem_id, line, prices)
+            for menuitem_id, line in sorted(state['lines'].items()) if menuitem_id in prices
+        ]
+        cart.totals = line_totals(cart.lines)
+        return cart
+
+    def unwritten(self, user=None):
+        user_ids = list(self.pending()) if user is None else [user.pk]
+        quantities, removed = {}, set()
+        for state in cache.get_many([self.cache_key(user_id) for user_id in user_ids]).values():
+            if state['changed']:
+                quantities.update(state['lines'].values())
+                removed.update(state['removed'].values())
+        return quantities, removed
+
+    def flush(self, user=None):
+        user_ids = list(self.pending()) if user is None else [user.pk]
+        for user_id in user_ids:
+            with self.lock(user_id):
+                state = cache.get(self.cache_key(user_id))
+                if state is not None and state['changed']:
+                    self.write(User(pk=user_id), state)
+                cache.delete(self.cache_key(user_id))
+                self.set_pending(user_id, False)
+
+    @transaction.atomic
+    def write(self, user, state):
+        if state['removed']:
+            OrderItem.objects.filter(user=user, pk__in=state['removed'].values()).delete()
+        quantities = {menuitem_id: quantity for menuitem_id, (_, quantity) in state['lines'].items()}
+        prices = dict(MenuItem.objects.filter(pk__in=quantities).values_list('pk', 'price'))
+        quantities = {menuitem_id: quantity for menuitem_id, quantity in quantities.items() if menuitem_id in prices}
+        order_items = upsert_cart_items(user, quantities, prices, increment=False)
+        attach_to_cart(user, [order_item.pk for order_item in order_items])
+
+    def flush_stale(self):
+        """Writes the carts that have gone CART_FLUSH_AFTER seconds without being written."""
+        written_before = time.time() - settings.CART_FLUSH_AFTER
+        for user_id, changed_at in self.pending().items():
+            if changed_at < written_before:
+                self.flush(User(pk=user_id))
+
+    def write_behind(self):
+        while True:
+            time.sleep(settings.CART_FLUSH_INTERVAL)
+            try:
+                close_old_connections()
+                self.flush_stale()
+            except Exception:
+                logger.exception('Could not write the cached carts')
+
+
+class CartStore:
+    """Hands the cart changes to the CART_BACKEND backend, loaded on first use."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.backend = None
+
+    def get_backend(self):
+        with self.lock:
+            if self.backend is None:
+                # Kept only once started, so a failed start is tried again.
+                backend = import_string(settings.CART_BACKEND)()
+                backend.start()
+                self.backend = backend
+            return self.backend
+
+    def add_item(self, user, menuitem_id, quantity):
+        return self.get_backend().add_item(user, menuitem_id, quantity)
+
+    def change_items(self, user, quantities):
+        return self.get_backend().change_items(user, quantities)
+
+    def summarize(self, user):
+        return self.get_backend().summarize(user)
+
+    def unwritten(self, user=None):
+        return self.get_backend().unwritten(user)
+
+    def flush(self, user=None):
+        self.get_backend().flush(user)
+
+
+carts = CartStore()
@@ -0,0 +1,124 @@
+from django.db import DatabaseError, transaction
+from django.db.models import Sum
+
+from littlelemon.models import (
+    LineItem,
+    OrderItem,
+    Cart,
+    Order,
+    Purchase,
+    CheckoutJob,
+)
+
+from .cart import carts, CartBusy
+from .dispatch import dispatch_on_commit
+from .events import publish_order_event, ORDER_CREATED
+from .rollups import add_purchase_to_rollups
+
+
+class CheckoutError(Exception):
+    pass
+
+
+def snapshot_line_items(items):
+    """
+    Returns the line-items snapshot of order or purchase items, with their
+    menu items loaded. Prices are strings, as they read once stored.
+    """
+    return [
+        {
+            'menuitem': item.menuitem_id,
+            'title': item.menuitem.title,
+            'quantity': item.quantity,
+            'unit_price': str(item.unit_price),
+            'price': str(item.price),
+        }
+        for item in items
+    ]
+
+
+def create_purchase_record(user, user_cart):
+    order_items = list(user_cart.orderitems.select_related('menuitem').order_by('id'))
+    purchase = Purchase.objects.create(user=user, line_items=snapshot_line_items(order_items))
+    # The cart items become the purchase-items in place.
+    LineItem.objects.filter(pk__in=[order_item.pk for order_item in order_items]).update(
+        state = LineItem.PURCHASED,
+        purchase = purchase,
+    )
+    return purchase, order_items
+
+
+def get_purchase_cost(purchase_record):
+    total_cost = purchase_record.purchaseitems.aggregate(total=Sum('price'))['total']
+    return 0 if total_cost is None else total_cost
+
+
+def create_order_object(user, purchase_record):
+    return Order.objects.create(
+        user = user,
+        purchase = purchase_record,
+        total = get_purchase_cost(purchase_record)
+    )
+
+
+def delete_user_order_items(user, user_cart):
+    Cart.orderitems.through.objects.filter(cart=user_cart).delete()
+    # Order-items that were never added to the cart are dropped as well.
+    OrderItem.objects.filter(user=user).delete()
+
+
+def lock_cart(user_cart):
+    # Concurrent checkouts of the same cart wait for each other here, and
+    # the ones that come after the first find it empty.
+    user_cart = Cart.objects.select_for_update().get(pk=user_cart.pk)
+    if not user_cart.orderitems.exists():
+        raise CheckoutError('the cart is empty')
+    return user_cart
+
+
+@transaction.atomic
+def checkout(user, user_cart):
+    user_cart = lock_cart(user_cart)
+    purchase_record, purchase_items = create_purchase_record(user, user_cart)
+    add_purchase_to_rollups(purchase_record, purchase_items)
+    order_object = create_order_object(user, purchase_record)
+    delete_user_order_items(user, user_cart)
+    publish_order_event(ORDER_CREATED, order_object)
+    dispatch_on_commit(order_object.pk)
+    return order_object
+
+
+def enqueue_checkout(user):
+    return CheckoutJob.objects.create(user=user)
+
+
+def run_checkout_job(job):
+    try:
+        carts.flush(job.user)
+        with transaction.atomic():
+            user_cart = Cart.objects.filter(user_id=job.user_id).first()
+            if user_cart is None:
+                raise CheckoutError('the user does not have a cart')
+            job.order = checkout(job.user, user_cart)
+            job.status = CheckoutJob.DONE
+    except (CheckoutError, CartBusy, DatabaseError) as error:
+        job.status = CheckoutJob.FAILED
+        job.error = str(error)[:255]
+    job.save(update_fields=['order', 'status', 'error', 'updated'])
+
+
+def run_next_checkout_job():
+    # The row lock is held until the job is finished, and SKIP LOCKED lets
+    # every other worker move on to the next pending job meanwhile.
+    with transaction.atomic():
+        job = (
+            CheckoutJob.objects
+            .select_for_update(skip_locked=True)
+            .select_related('user')
+            .filter(status=CheckoutJob.PENDING)
+            .order_by('id')
+            .first()
+        )
+        if job is not None:
+            run_checkout_job(job)
+    return job
@@ -0,0 +1,151 @@
+import heapq
+import statistics
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Case, Count, Value, When
+from django.utils import timezone
+
+from littlelemon.models import Order
+
+from .events import publish_order_events, ORDER_ASSIGNED
+
+
+class CrewLoad:
+    """
+    Number of open orders per delivery-crew member, kept in a heap ordered by
+    (load, crew id) so the least-loaded member is popped first. A member whose
+    load changes gets a new heap entry, and the outdated entries are skipped
+    when they surface. The heap is rebuilt from the open orders on first use
+    and every DISPATCH_REBUILD_INTERVAL seconds, which also picks up orders
+    delivered and crew members added or removed in the meantime.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []
+        self.loads = {}
+        self.built_at = None
+
+    def rebuild(self):
+        crew_ids = User.objects.filter(groups__name='Delivery Crew').values_list('pk', flat=True)
+        open_orders = dict(
+            Order.objects
+            .filter(status=False, delivery_crew__isnull=False)
+            .values_list('delivery_crew')
+            .annotate(Count('id'))
+        )
+        loads = {crew_id: open_orders.get(crew_id, 0) for crew_id in crew_ids}
+        heap = [(load, crew_id) for crew_id, load in loads.items()]
+        heapq.heapify(heap)
+        with self.lock:
+            self.loads, self.heap, self.built_at = loads, heap, time.monotonic()
+
+    def is_stale(self):
+        return self.built_at is None or time.monotonic() - self.built_at > settings.DISPATCH_REBUILD_INTERVAL
+
+    def refresh(self):
+        if self.is_stale():
+            self.rebuild()
+
+    def take(self, count):
+        """
+        Returns the crew member ids for `count` orders, adding every order to
+        the member with the fewest open orders at that point.
+        """
+        self.refresh()
+        crew_ids = []
+        with self.lock:
+            while self.heap and len(crew_ids) < count:
+                load, crew_id = heapq.heappop(self.heap)
+                if self.loads.get(crew_id) != load:
+                    continue
+                crew_ids.append(crew_id)
+                self.loads[crew_id] = load + 1
+                heapq.heappush(self.heap, (load + 1, crew_id))
+        return crew_ids
+
+    def snapshot(self):
+        self.refresh()
+        with self.lock:
+            return dict(sorted(self.loads.items()))
+
+
+class DispatchStats:
+    """Keeps the latencies of the latest assignments of this process."""
+    size = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waits = deque(maxlen=self.size)
+        self.batches = deque(maxlen=self.size)
+
+    def record(self, waits, batch_duration):
+        with self.lock:
+            self.waits.extend(waits)
+            self.batches.append(batch_duration)
+
+    def summarize(self, values):
+        if not values:
+            return None
+        values = sorted(values)
+        return {
+            'count': len(values),
+            'p50': round(statistics.median(values), 4),
+            'p95': round(values[min(len(values) - 1, int(len(values) * 0.95))], 4),
+            'max': round(values[-1], 4),
+        }
+
+    def report(self):
+        with self.lock:
+            waits, batches = list(self.waits), list(self.batches)
+        return {
+            'order_wait_seconds': self.summarize(waits),
+            'batch_seconds': self.summarize(batches),
+        }
+
+
+crew_load = CrewLoad()
+dispatch_stats = DispatchStats()
+
+
+def dispatch_orders(order_ids=None, limit=None):
+    """
+    Assigns the oldest unassigned open orders, or those of `order_ids`, to
+    the least-loaded crew members with a single UPDATE. Returns the
+    {order id: crew id} assignments.
+    """
+    started = time.perf_counter()
+    limit = limit or settings.DISPATCH_BATCH_SIZE
+    with transaction.atomic():
+        orders = Order.objects.select_for_update(skip_locked=True).filter(
+            status=False, delivery_crew__isnull=True,
+        )
+        if order_ids is not None:
+            orders = orders.filter(pk__in=order_ids)
+        orders = list(orders.order_by('date', 'id').values_list('pk', 'date', 'user')[:limit])
+        assignments = dict(zip((order_id for order_id, _, _ in orders), crew_load.take(len(orders))))
+        if assignments:
+            Order.objects.filter(pk__in=assignments).update(delivery_crew=Case(
+                *[When(pk=order_id, then=Value(crew_id)) for order_id, crew_id in assignments.items()]
+            ))
+        publish_order_events(ORDER_ASSIGNED, [
+            Order(pk=order_id, user_id=user_id, delivery_crew_id=assignments[order_id], status=False)
+            for order_id, _, user_id in orders if order_id in assignments
+        ])
+
+    now = timezone.now()
+    dispatch_stats.record(
+        [(now - date).total_seconds() for order_id, date, _ in orders if order_id in assignments],
+        time.perf_counter() - started,
+    )
+    return assignments
+
+
+def dispatch_on_commit(order_id):
+    if settings.DISPATCH_ON_CHECKOUT:
+        transaction.on_commit(lambda: dispatch_orders([order_id]))
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from littlelemon.models import OrderEvent
+
+
+logger = logging.getLogger(__name__)
+
+ORDER_CREATED = OrderEvent.CREATED
+ORDER_ASSIGNED = OrderEvent.ASSIGNED
+ORDER_STATUS = OrderEvent.STATUS
+ORDER_DELETED = OrderEvent.DELETED
+
+
+def event_data(order_event):
+    return {
+        'id': order_event.pk,
+        'type': order_event.kind,
+        'order': order_event.order_id,
+        'user': order_event.user_id,
+        'delivery_crew': order_event.delivery_crew_id,
+        'status': order_event.status,
+        'created': order_event.created,
+    }
+
+
+def settled_before():
+    # Ids are handed out when a row is inserted but become visible when its
+    # transaction commits, so an event may show up after one with a higher
+    # id. Events older than ORDER_EVENTS_SETTLE seconds are taken as final.
+    return timezone.now() - timedelta(seconds=settings.ORDER_EVENTS_SETTLE)
+
+
+class Subscription:
+
+    def __init__(self, broker, can_see):
+        self.broker = broker
+        self.can_see = can_see
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=settings.ORDER_EVENTS_QUEUE_SIZE)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # A client that can't keep up is disconnected, and reconnects.
+            self.overflowed = True
+            self.broker.unsubscribe(self)
+
+    def deliver(self, event):
+        if self.can_see(event):
+            self.loop.call_soon_threadsafe(self.put, event)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class OrderEventBroker:
+    """
+    Fans order events out to the event streams open in this process. Events
+    reach the broker through the backend, which decides whether they are
+    shared with other processes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = set()
+        self.backend = None
+
+    def get_backend(self):
+        with self.lock:
+            if self.backend is None:
+                # Kept only once started, so a failed start is tried again.
+                backend = import_string(settings.ORDER_EVENTS_BACKEND)()
+                backend.start(self.deliver)
+                self.backend = backend
+            return self.backend
+
+    def publish(self, event):
+        self.get_backend().publish(event)
+
+    async def subscribe(self, can_see):
+        # Starting the backend may query the database, which can't be done
+        # from the event loop.
+        await sync_to_async(self.get_backend)()
+        subscription = Subscription(self, can_see)
+        with self.lock:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def deliver(self, event):
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            subscription.deliver(event)
+
+
+class LocalEventBackend:
+    """
+    Delivers events to the streams of the publishing process only. Backends
+    that share events between processes implement the same two methods:
+    `start(deliver)` is called once with the callable that hands an event to
+    the local streams, and `publish(event)` sends an event to every process.
+    """
+
+    def start(self, deliver):
+        self.deliver = deliver
+
+    def publish(self, event):
+        self.deliver(event)
+
+
+class OrderEventLogBackend:
+    """
+    Shares events between processes through the OrderEvent table, which
+    every process tails from a background thread every
+    ORDER_EVENTS_POLL_INTERVAL seconds. Publishing is a no-op, the event rows
+    are written with the changes anyway.
+    """
+
+    def start(self, deliver):
+        self.deliver = deliver
+        self.settled_id = OrderEvent.objects.filter(created__lt=settled_before()).order_by('-id').values_list('id', flat=True).first() or 0
+        self.delivered_ids = set(OrderEvent.objects.filter(id__gt=self.settled_id).values_list('id', flat=True))
+        threading.Thread(target=self.tail, name='order-event-log', daemon=True).start()
+
+    def publish(self, event):
+        pass
+
+    def poll(self):
+        settled = settled_before()
+        settling = False
+        for order_event in OrderEvent.objects.filter(id__gt=self.settled_id).order_by('id'):
+            if order_event.pk not in self.delivered_ids:
+                self.delivered_ids.add(order_event.pk)
+                self.deliver(event_data(order_event))
+            settling = settling or order_event.created >= settled
+            if not settling:
+                self.settled_id = order_event.pk
+        self.delivered_ids = {event_id for event_id in self.delivered_ids if event_id > self.settled_id}
+
+    def tail(self):
+        while True:
+            time.sleep(settings.ORDER_EVENTS_POLL_INTERVAL)
+            try:
+                close_old_connections()
+                self.poll()
+            except Exception:
+                logger.exception('Could not read the order event log')
+
+
+broker = OrderEventBroker()
+
+
+def publish_order_events(kind, orders):
+    if not orders:
+        return
+    order_events = OrderEvent.objects.bulk_create([
+        OrderEvent(
+            order_id = order.pk,
+            user_id = order.user_id,
+            delivery_crew_id = order.delivery_crew_id,
+            kind = kind,
+            status = bool(order.status),
+        )
+        for order in orders
+    ])
+    events = [event_data(order_event) for order_event in order_events]
+
+    def publish():
+        for event in events:
+            broker.publish(event)
+    transaction.on_commit(publish)
+
+
+def publish_order_event(kind, order):
+    publish_order_events(kind, [order])
@@ -0,0 +1,73 @@
+import operator
+from decimal import Decimal, InvalidOperation
+from functools import reduce
+
+from django.db import models
+from django.db.models import Q
+from django.utils.dateparse import parse_date
+from rest_framework.filters import SearchFilter
+
+
+BOOLEAN_TERMS = {'true': True, '1': True, 'false': False, '0': False}
+
+
+class TypedSearchFilter(SearchFilter):
+    """
+    Matches every search term against the search fields according to the
+    field type. Text fields get a case insensitive containment lookup, which
+    the trigram indexes serve on PostgreSQL. Numeric, boolean, date and
+    related fields only get an exact lookup, and only when the term parses as
+    a value of that type, so those columns are never cast to text.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        search_fields = self.get_search_fields(view, request)
+        search_terms = self.get_search_terms(request)
+        if not search_fields or not search_terms:
+            return queryset
+
+        for term in search_terms:
+            conditions = [
+                condition for condition in (
+                    self.construct_term_filter(queryset, str(field_name), term)
+                    for field_name in search_fields
+                )
+                if condition is not None
+            ]
+            if not conditions:
+                return queryset.none()
+            queryset = queryset.filter(reduce(operator.or_, conditions))
+
+        if self.must_call_distinct(queryset, search_fields):
+            queryset = queryset.distinct()
+        return queryset
+
+    def construct_term_filter(self, queryset, field_name, term):
+        if field_name[0] in self.lookup_prefixes or '__' in field_name:
+            return Q(**{self.construct_search(field_name, queryset): term})
+
+        field = queryset.model._meta.get_field(field_name)
+        if isinstance(field, (models.CharField, models.TextField)):
+            return Q(**{f'{field_name}__icontains': term})
+        if isinstance(field, models.BooleanField):
+            value = BOOLEAN_TERMS.get(term.lower())
+            return None if value is None else Q(**{field_name: value})
+        if isinstance(field, (models.DecimalField, models.FloatField)):
+            try:
+                value = Decimal(term)
+            except InvalidOperation:
+                return None
+            return Q(**{field_name: value}) if value.is_finite() else None
+        if isinstance(field, models.IntegerField) or field.is_relation:
+            return Q(**{field_name: int(term)}) if term.isdecimal() else None
+        if isinstance(field, models.DateField):
+            try:
+                value = parse_date(term)
+            except ValueError:
+                return None
+            if value is None:
+                return None
+            if isinstance(field, models.DateTimeField):
+                return Q(**{f'{field_name}__date': value})
+            return Q(**{field_name: value})
+        return None
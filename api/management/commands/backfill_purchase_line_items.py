@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Prefetch
+
+from littlelemon.models import Purchase, PurchaseItem
+
+from api.checkout import snapshot_line_items
+
+
+class Command(BaseCommand):
+    help = 'Writes the line-items snapshot of the purchases made before it was kept at checkout.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Purchases updated per query.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1')
+        purchase_items = Prefetch(
+            'purchaseitems',
+            queryset=PurchaseItem.objects.select_related('menuitem').order_by('id'),
+        )
+        backfilled = 0
+        last_id = 0
+        while True:
+            purchases = list(
+                Purchase.objects
+                .filter(line_items__isnull=True, id__gt=last_id)
+                .order_by('id')
+                .only('id')
+                .prefetch_related(purchase_items)[:batch_size]
+            )
+            if not purchases:
+                break
+            for purchase in purchases:
+                purchase.line_items = snapshot_line_items(purchase.purchaseitems.all())
+            Purchase.objects.bulk_update(purchases, ['line_items'])
+            backfilled += len(purchases)
+            last_id = purchases[-1].pk
+        self.stdout.write(f'{backfilled} purchases backfilled')
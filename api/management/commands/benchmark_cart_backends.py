@@ -0,0 +1,61 @@
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from littlelemon.models import MenuItem
+
+from api.cart import DatabaseCartBackend, CacheCartBackend
+
+
+class Command(BaseCommand):
+    help = (
+        'Times the cart changes of both cart backends against the configured '
+        'database and cache. Runs in a transaction that is rolled back, so '
+        'the carts it fills are left behind in neither.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20, help='Carts changed by each backend.')
+        parser.add_argument('--changes', type=int, default=50, help='Changes made to each cart.')
+        parser.add_argument('--menu-items', type=int, default=5, help='Menu items each cart cycles through.')
+
+    def handle(self, *args, **options):
+        menuitem_ids = list(MenuItem.objects.order_by('id').values_list('pk', flat=True)[:options['menu_items']])
+        if not menuitem_ids:
+            raise CommandError('the benchmark requires at least one menu item')
+        try:
+            CacheCartBackend().check()
+        except ImproperlyConfigured as error:
+            raise CommandError(error)
+
+        with transaction.atomic():
+            for backend in [DatabaseCartBackend(), CacheCartBackend()]:
+                self.benchmark(backend, menuitem_ids, options['users'], options['changes'])
+            transaction.set_rollback(True)
+
+    def benchmark(self, backend, menuitem_ids, user_count, change_count):
+        prefix = f'cart-benchmark-{uuid.uuid4().hex[:8]}'
+        users = User.objects.bulk_create([User(username=f'{prefix}-{number}') for number in range(user_count)])
+
+        started = time.perf_counter()
+        for number in range(change_count):
+            for user in users:
+                backend.change_items(user, {menuitem_ids[number % len(menuitem_ids)]: 1})
+        changed = time.perf_counter() - started
+
+        # The cached carts are written before the rollback, so no cache is
+        # left holding carts of users that don't exist.
+        started = time.perf_counter()
+        for user in users:
+            backend.flush(user)
+        flushed = time.perf_counter() - started
+
+        total = user_count * change_count
+        self.stdout.write(
+            f'{type(backend).__name__}: {total} changes in {changed:.2f}s '
+            f'({total / changed:.0f} changes/s), carts written in {flushed:.2f}s'
+        )
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.checkout import run_next_checkout_job
+
+
+class Command(BaseCommand):
+    help = 'Runs the pending checkout jobs. Start one process per worker.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Exit once no job is pending.')
+        parser.add_argument('--sleep', type=float, default=1.0, help='Seconds to wait when no job is pending.')
+
+    def handle(self, *args, **options):
+        while True:
+            job = run_next_checkout_job()
+            if job is not None:
+                self.stdout.write(f'checkout job {job.pk}: {job.status}')
+                continue
+            if options['once']:
+                return
+            time.sleep(options['sleep'])
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from api.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the daily sales rollups from the purchases. Checkouts wait until it is done.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='Only rebuild the days from this date (YYYY-MM-DD) on.')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            since = parse_date(options['since'])
+            if since is None:
+                raise CommandError('--since requires a date such as 2023-02-16')
+        rebuild_rollups(since)
+        self.stdout.write('sales rollups rebuilt')
@@ -1,7 +1,20 @@
 from rest_framework.generics import ListCreateAPIView, RetrieveUpdateDestroyAPIView
 from rest_framework.response import Response
 from rest_framework import status
-
+from rest_framework.exceptions import ValidationError
+
+import hashlib
+import json
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 from django.contrib.auth.models import User, Group
 
 from .permission import (
@@ -10,6 +23,12 @@ from .permission import (
     IsDeliveryCrew,
     IsCustomer,
 )
+from .roles import get_user_roles
+from .snapshots import menu_snapshot_key, etag_for, etag_matches
+from .pagination import KeysetPagination
+from .cart import carts
+from .checkout import checkout
+from .events import publish_order_events, ORDER_ASSIGNED, ORDER_STATUS
 
 from littlelemon.models import (
     Category,
@@ -17,8 +36,7 @@ from littlelemon.models import (
     OrderItem,
     Cart,
     Order,
-    PurchaseItem,
-    Purchase,
+    IdempotencyKey,
 )
 
 
@@ -32,17 +50,32 @@ class UserHelperMixin:
         return False
 
     def user_in_group(self, request, group_name=''):
-        user = request.user
-        if user.groups.filter(name=group_name):
-            return True
-        return False
+        return group_name in get_user_roles(request)
+
+    def get_requested_user_object(self, request):
+        """
+        Loads the requested user together with their groups once per request.
+        Returns None when no such user exists.
+        """
+        if not hasattr(self, '_requested_user_object'):
+            user_pk = request.parser_context['kwargs'].get('pk')
+            self._requested_user_object = User.objects.prefetch_related('groups').filter(pk=user_pk).first()
+        return self._requested_user_object
+
+    def requested_user_roles(self, request):
+        user = self.get_requested_user_object(request)
+        if user is None:
+            return frozenset()
+        return frozenset(group.name for group in user.groups.all())
 
     def requested_user_in_group(self, request, group_name=''):
-        user_pk = request.parser_context['kwargs'].get('pk')
-        user = User.objects.get(pk=user_pk)
-        if user.groups.filter(name=group_name):
-            return True
-        return False
+        return group_name in self.requested_user_roles(request)
+
+    not_delivery_crew_message = 'delivery_crew_id is not a member of the delivery crew'
+
+    def delivery_crew_members(self, user_ids):
+        """Returns the ids among `user_ids` of the members of the delivery crew."""
+        return set(User.objects.filter(pk__in=user_ids, groups__name='Delivery Crew').values_list('pk', flat=True))
     
     def user_is_unathentictaed(self, request):
         return request.user.is_anonymous
@@ -118,6 +151,63 @@ class RetrieveUpdateDestroyAPIViewMixin(RetrieveUpdateDestroyAPIView):
             return Response({'message': 'object not found'}, status=status.HTTP_404_NOT_FOUND)
 
 
+class KeysetPaginationMixin:
+    """
+    Lets clients page the list with `?pagination=keyset` (or by following a
+    `cursor` link) instead of page numbers, ordered by `keyset_ordering`.
+    """
+    keyset_ordering = ('-id',)
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            query_params = self.request.query_params
+            if query_params.get('pagination') == 'keyset' or 'cursor' in query_params:
+                self._paginator = KeysetPagination(self.keyset_ordering)
+        return super().paginator
+
+
+class RelationLoadingMixin:
+    """
+    Loads the relations the serializer walks along with the queryset of the
+    view, so a page costs the same number of queries however many rows it
+    holds. Entries of `prefetch_related_fields` may be Prefetch objects.
+    """
+    select_related_fields = ()
+    prefetch_related_fields = ()
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.select_related_fields:
+            queryset = queryset.select_related(*self.select_related_fields)
+        if self.prefetch_related_fields:
+            queryset = queryset.prefetch_related(*self.prefetch_related_fields)
+        return queryset
+
+
+class LineItemsExpansionMixin:
+    """
+    Serves purchases from their line-items snapshot with `?expand=lines`,
+    using `line_items_serializer_class` and without loading the
+    purchase-items.
+    """
+    line_items_serializer_class = None
+
+    def wants_line_items(self):
+        return self.request.query_params.get('expand') == 'lines'
+
+    def get_serializer_class(self):
+        if self.wants_line_items():
+            return self.line_items_serializer_class
+        return super().get_serializer_class()
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.wants_line_items():
+            queryset = queryset.prefetch_related(None)
+        return queryset
+
+
 class GroupListHelperMixin:
     group_name = ''
 
@@ -127,7 +217,6 @@ class GroupListHelperMixin:
             user = User.objects.get(pk=user_id)
             group = Group.objects.get(name=self.group_name)
             group.user_set.add(user)
-            group.save()
             return Response(self.serializer_class(user).data, status=status.HTTP_201_CREATED)
         except ValueError:
             return Response({'id': 'a valid integer is required'}, status=status.HTTP_400_BAD_REQUEST)
@@ -142,7 +231,6 @@ class GroupDetailHelperMixin:
             user = User.objects.get(pk=kwargs['pk'])
             group = Group.objects.get(name=self.group_name)
             group.user_set.remove(user)
-            group.save()
             return Response({'message': 'user removed from the group'}, status=status.HTTP_200_OK)
         except User.DoesNotExist:
             return Response({'message': 'object not found'}, status=status.HTTP_404_NOT_FOUND)
@@ -158,6 +246,91 @@ class CustomerCanSeeMixin:
         return super().check_permissions(request)
 
 
+class MenuSnapshotMixin:
+    """
+    Serves GET responses of the menu endpoints from rendered snapshots keyed
+    by menu version, URL and renderer, and answers If-None-Match with 304.
+    A snapshot already cached is served without touching the database or the
+    serializers.
+    """
+
+    def snapshot_response(self, request, handler, *args, **kwargs):
+        if request.accepted_renderer.format == 'api':
+            return handler(request, *args, **kwargs)
+        key = menu_snapshot_key(request)
+        etag = etag_for(key)
+        # Resolved before the ETag is compared, so a missing item is a 404
+        # even to If-None-Match: *.
+        snapshot = cache.get(key)
+        if snapshot is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            response.accepted_renderer = request.accepted_renderer
+            response.accepted_media_type = request.accepted_media_type
+            response.renderer_context = self.get_renderer_context()
+            response.render()
+            snapshot = (response.content, response['Content-Type'])
+            cache.set(key, snapshot, settings.MENU_SNAPSHOT_TIMEOUT)
+        if etag_matches(request, etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        content, content_type = snapshot
+        response = HttpResponse(content, content_type=content_type)
+        response['ETag'] = etag
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.snapshot_response(request, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.snapshot_response(request, super().retrieve, *args, **kwargs)
+
+
+class IdempotencyMixin:
+    """
+    Answers a write sent again with the same Idempotency-Key header with the
+    stored response of the first one instead of repeating it. The key row is
+    locked for as long as the write runs, so concurrent duplicates wait and
+    then replay it.
+    """
+    idempotency_header = 'Idempotency-Key'
+
+    def get_request_hash(self, request):
+        data = dict(request.data.lists()) if hasattr(request.data, 'lists') else request.data
+        payload = json.dumps([request.method, request.path, data], sort_keys=True, cls=DjangoJSONEncoder)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def idempotent_response(self, request, handler, *args, **kwargs):
+        key = request.headers.get(self.idempotency_header)
+        if key is None:
+            return handler(request, *args, **kwargs)
+        if not key or len(key) > 255:
+            return Response({'message': f'{self.idempotency_header} must be 1 to 255 characters long'}, status=status.HTTP_400_BAD_REQUEST)
+
+        request_hash = self.get_request_hash(request)
+        expired = timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TIMEOUT)
+        with transaction.atomic():
+            IdempotencyKey.objects.filter(user=request.user, created__lt=expired).delete()
+            record, created = IdempotencyKey.objects.select_for_update().get_or_create(
+                user = request.user,
+                key = key,
+                defaults = {'request_hash': request_hash},
+            )
+            if not created:
+                if record.request_hash != request_hash:
+                    return Response({'message': f'{self.idempotency_header} was already used for a different request'}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+                return Response(record.response, status=record.status_code, headers={'Idempotent-Replayed': 'true'})
+
+            response = handler(request, *args, **kwargs)
+            if response.status_code >= 500:
+                record.delete()
+            else:
+                record.status_code = response.status_code
+                record.response = response.data
+                record.save(update_fields=['status_code', 'response'])
+        return response
+
+
 class CartViewHelperMixin(CommonUtilsMixin):
 
     def get_or_create_cart_object(self, user):
@@ -206,8 +379,69 @@ class CartViewHelperMixin(CommonUtilsMixin):
         cart_object.orderitems.clear()
         cart_object.save()
 
+    def wants_summary(self, request):
+        return request.query_params.get('expand') == 'summary'
+
+    def parse_cart_item(self, item, allow_removal=False):
+        if not isinstance(item, dict):
+            raise ValidationError({'message': 'requires a {menuitem_id, quantity} item'})
+        errors = {}
+        try:
+            menuitem_id = int(item.get('menuitem_id'))
+        except (TypeError, ValueError):
+            errors['menuitem_id'] = 'a valid integer is required'
+        try:
+            quantity = int(item.get('quantity', 1))
+            if quantity == 0 or (quantity < 0 and not allow_removal): raise ValueError
+        except (TypeError, ValueError):
+            errors['quantity'] = 'field requires a non-zero integer' if allow_removal else 'field requires a positive integer'
+        if errors:
+            raise ValidationError(errors)
+        return menuitem_id, quantity
+
+    def parse_cart_items(self, data):
+        """
+        Returns the {menu item id: quantity} changes of a list of {menuitem_id,
+        quantity} items, adding up the items of the same menu item.
+        """
+        limit = settings.CART_BATCH_LIMIT
+        if not isinstance(data, list) or not 0 < len(data) <= limit or not all(isinstance(item, dict) for item in data):
+            raise ValidationError({'message': f'requires a list of 1 to {limit} {{menuitem_id, quantity}} items'})
+        quantities = defaultdict(int)
+        errors = []
+        for item in data:
+            try:
+                menuitem_id, quantity = self.parse_cart_item(item, allow_removal=True)
+                quantities[menuitem_id] += quantity
+                errors.append({})
+            except ValidationError as error:
+                errors.append(error.detail)
+        if any(errors):
+            raise ValidationError(errors)
+        return dict(quantities)
+
 
 class OrderItemHelperMixin(CommonUtilsMixin):
+    unwritten_quantities = {}
+
+    def exclude_unwritten_removals(self, user=None):
+        """
+        Leaves out of the queryset the order-items the cart backend removed
+        without writing it yet, from the cart of `user` or from every cart,
+        and keeps its unwritten quantities for show_unwritten_quantities.
+        """
+        self.unwritten_quantities, removed = carts.unwritten(user)
+        if user is not None:
+            self.queryset = self.queryset.filter(user=user)
+        if removed:
+            self.queryset = self.queryset.exclude(pk__in=removed)
+
+    def show_unwritten_quantities(self, order_items):
+        for order_item in order_items:
+            if order_item.pk in self.unwritten_quantities:
+                order_item.quantity = self.unwritten_quantities[order_item.pk]
+                order_item.price = order_item.unit_price * order_item.quantity
+        return order_items
 
     def data_dict_constructor(self, request, user, **kwargs):
         try:
@@ -247,45 +481,127 @@ class OrderListHelperMixin(CommonUtilsMixin):
         except Cart.DoesNotExist:
             return None
     
-    def create_purchase_item_from_order_item(self, order_item):
-        purchase_item = PurchaseItem.objects.create(
-            user = order_item.user,
-            menuitem = order_item.menuitem,
-            quantity = order_item.quantity,
-            unit_price = order_item.unit_price,
-            price = order_item.price,
-        )
-        purchase_item.save()
-        return purchase_item
-    
-    def create_purchase_record(self, user, user_cart):
-        purchase = Purchase.objects.create(user=user)
-        for order_item in user_cart.orderitems.all():
-            purchase_item = self.create_purchase_item_from_order_item(order_item)
-            purchase.purchaseitems.add(purchase_item)
-        purchase.save()
-        return purchase
-    
-    def get_purchase_cost(self, purchase_record):
-        total_cost = 0
-        for purchase_item in purchase_record.purchaseitems.all():
-            total_cost += purchase_item.price
-        return total_cost
-    
-    def create_order_object(self, user, purchase_record):
-        order_object = self.model.objects.create(
-            user = user,
-            purchase = purchase_record,
-            total = self.get_purchase_cost(purchase_record)
-        )
-        order_object.save()
-        return order_object
-    
-    def delete_user_order_items(self, user):
-        order_items = OrderItem.objects.filter(user=user).delete()
-        if OrderItem.objects.filter(user=user).all():
-            return False
-        return True
+    def checkout(self, user, user_cart):
+        return checkout(user, user_cart)
+
+    def user_cart_is_empty(self, user_cart):
+        return not user_cart.orderitems.exists()
+
+    def wants_async_checkout(self, request):
+        preferences = [value.strip() for value in request.headers.get('Prefer', '').split(',')]
+        return 'respond-async' in preferences
+
+    def parse_order_change(self, change):
+        if not isinstance(change, dict): raise ValueError
+        order_id = int(change['id'])
+        order_status = change.get('status')
+        if order_status is not None:
+            order_status = int(order_status)
+            if order_status not in (0, 1): raise ValueError
+        delivery_crew_id = change.get('delivery_crew_id')
+        if delivery_crew_id is not None:
+            delivery_crew_id = int(delivery_crew_id)
+        if order_status is None and delivery_crew_id is None: raise ValueError
+        return order_id, order_status, delivery_crew_id
+
+    @transaction.atomic
+    def bulk_update_orders(self, request, changes):
+        """
+        Applies a list of {id, status, delivery_crew_id} changes with one
+        UPDATE per distinct new value, and returns a result per change.
+        Delivery crew may change the status of the orders assigned to them,
+        managers may change the status and the delivery crew of any order.
+        """
+        is_manager = 'Manager' in get_user_roles(request)
+        results = [None] * len(changes)
+        parsed_changes = {}
+        for index, change in enumerate(changes):
+            try:
+                parsed_changes[index] = self.parse_order_change(change)
+            except (KeyError, TypeError, ValueError):
+                results[index] = {
+                    'id': change.get('id') if isinstance(change, dict) else None,
+                    'code': status.HTTP_400_BAD_REQUEST,
+                    'message': 'requires an integer id, and a status (0 or 1) or an integer delivery_crew_id',
+                }
+
+        orders = self.model.objects.select_for_update().only('id', 'user_id', 'delivery_crew_id', 'status')
+        if not is_manager:
+            orders = orders.filter(delivery_crew=request.user)
+        orders = orders.in_bulk([order_id for order_id, _, _ in parsed_changes.values()])
+        crew_ids = {delivery_crew_id for _, _, delivery_crew_id in parsed_changes.values()} - {None}
+        delivery_crew = set()
+        if is_manager and crew_ids:
+            delivery_crew = self.delivery_crew_members(crew_ids)
+
+        status_updates = defaultdict(list)
+        delivery_crew_updates = defaultdict(list)
+        changed_ids = set()
+        for index, (order_id, order_status, delivery_crew_id) in parsed_changes.items():
+            error = None
+            if order_id in changed_ids:
+                error = status.HTTP_400_BAD_REQUEST, 'the order appears more than once'
+            elif order_id not in orders:
+                error = status.HTTP_404_NOT_FOUND, 'object not found'
+            elif delivery_crew_id is not None and not is_manager:
+                error = status.HTTP_403_FORBIDDEN, 'only managers can assign the delivery crew'
+            elif delivery_crew_id is not None and delivery_crew_id not in delivery_crew:
+                error = status.HTTP_400_BAD_REQUEST, self.not_delivery_crew_message
+            changed_ids.add(order_id)
+            if error is not None:
+                results[index] = {'id': order_id, 'code': error[0], 'message': error[1]}
+                continue
+            order_object = orders[order_id]
+            if order_status is not None:
+                status_updates[bool(order_status)].append(order_id)
+                order_object.status = bool(order_status)
+            if delivery_crew_id is not None:
+                delivery_crew_updates[delivery_crew_id].append(order_id)
+                order_object.delivery_crew_id = delivery_crew_id
+            results[index] = {'id': order_id, 'code': status.HTTP_200_OK}
+
+        for order_status, order_ids in status_updates.items():
+            self.model.objects.filter(pk__in=order_ids).update(status=order_status)
+        for delivery_crew_id, order_ids in delivery_crew_updates.items():
+            self.model.objects.filter(pk__in=order_ids).update(delivery_crew_id=delivery_crew_id)
+        publish_order_events(ORDER_STATUS, [
+            orders[order_id] for order_ids in status_updates.values() for order_id in order_ids
+        ])
+        publish_order_events(ORDER_ASSIGNED, [
+            orders[order_id] for order_ids in delivery_crew_updates.values() for order_id in order_ids
+        ])
+        return results
+
+
+class SalesReportHelperMixin:
+    default_report_days = 30
+
+    def get_report_period(self, request):
+        """
+        Returns the `from` and `to` dates of the report, both included. The
+        last `default_report_days` days are reported by default.
+        """
+        try:
+            date_to = request.query_params.get('to')
+            date_to = timezone.localdate() if date_to is None else parse_date(date_to)
+            if date_to is None: raise ValueError
+        except ValueError:
+            raise ValidationError({'to': 'requires a date such as 2023-02-16'})
+        try:
+            date_from = request.query_params.get('from')
+            date_from = date_to - timedelta(days=self.default_report_days - 1) if date_from is None else parse_date(date_from)
+            if date_from is None or date_from > date_to: raise ValueError
+        except ValueError:
+            raise ValidationError({'from': 'requires a date such as 2023-02-16, not after to'})
+        return date_from, date_to
+
+    def get_report_limit(self, request):
+        try:
+            limit = int(request.query_params.get('limit', 10))
+            if limit < 1: raise ValueError
+        except ValueError:
+            raise ValidationError({'limit': 'requires a positive integer'})
+        return limit
 
 
 class PurchaseDetailHelperMixin(CommonUtilsMixin):
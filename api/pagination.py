@@ -0,0 +1,222 @@
+import base64
+import binascii
+import hashlib
+import json
+import operator
+from collections import OrderedDict
+from functools import reduce
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import EmptyPage, Page, Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Pages through a queryset by the values of its ordering fields instead of
+    an offset, and without counting the rows. The cursor of the next page
+    holds the ordering values of the last row served, so every page costs
+    the same index range scan however deep the client goes.
+    """
+    cursor_query_param = 'cursor'
+    page_size = api_settings.PAGE_SIZE
+    invalid_cursor_message = 'Invalid cursor'
+
+    def __init__(self, ordering=('-id',)):
+        self.ordering = ordering
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.model = queryset.model
+        queryset = queryset.order_by(*self.ordering)
+        position = self.decode_cursor(request)
+        if position is not None:
+            queryset = queryset.filter(self.rows_after(position))
+
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        self.next_position = None
+        if self.has_next:
+            self.next_position = [
+                self.get_field(field).value_to_string(rows[-1]) for field in self.ordering
+            ]
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        cursor = base64.urlsafe_b64encode(json.dumps(self.next_position).encode()).decode()
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
+
+    def get_field(self, ordering_field):
+        return self.model._meta.get_field(ordering_field.lstrip('-'))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            position = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            if not isinstance(position, list) or len(position) != len(self.ordering):
+                raise ValueError
+            position = [
+                self.get_field(field).to_python(value)
+                for field, value in zip(self.ordering, position)
+            ]
+            # The ordering fields are never null, so neither is a real cursor.
+            if None in position:
+                raise ValueError
+            return position
+        except (binascii.Error, TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def rows_after(self, position):
+        # (a, b) after (x, y) reads as a > x OR (a = x AND b > y), with the
+        # comparison flipped for descending fields.
+        conditions = []
+        equal_to = {}
+        for field, value in zip(self.ordering, position):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            conditions.append(Q(**equal_to, **{f'{name}__{lookup}': value}))
+            equal_to[name] = value
+        return reduce(operator.or_, conditions)
+
+
+def is_unfiltered(queryset):
+    query = queryset.query
+    return not (
+        query.where or query.distinct or query.combinator or query.group_by
+        or query.low_mark or query.high_mark is not None
+    )
+
+
+def estimated_row_count(queryset):
+    connection = connections[queryset.db]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+            [connection.ops.quote_name(queryset.model._meta.db_table)],
+        )
+        row = cursor.fetchone()
+    # Tables that were never analyzed report -1 (or 0 before PostgreSQL 14).
+    if row is None or row[0] < settings.APPROXIMATE_COUNT_THRESHOLD:
+        return None
+    return row[0]
+
+
+def approximate_count(queryset):
+    """
+    Returns the row count of the queryset and whether it is approximate. On
+    PostgreSQL, the planner estimate is used for whole tables large enough
+    for it to matter, and filtered counts are cached for
+    APPROXIMATE_COUNT_TIMEOUT seconds. Anything else is counted exactly.
+    """
+    if connections[queryset.db].vendor != 'postgresql':
+        return queryset.count(), False
+    if is_unfiltered(queryset):
+        estimate = estimated_row_count(queryset)
+        if estimate is not None:
+            return estimate, True
+        return queryset.count(), False
+    sql, params = queryset.query.sql_with_params()
+    key = 'count:' + hashlib.md5(repr((queryset.db, sql, params)).encode()).hexdigest()
+    count = cache.get(key)
+    if count is not None:
+        return count, True
+    count = queryset.count()
+    cache.set(key, count, settings.APPROXIMATE_COUNT_TIMEOUT)
+    return count, False
+
+
+class ApproximateCountPage(Page):
+
+    def has_next(self):
+        if self.paginator.count_approximate:
+            return self.has_more
+        return super().has_next()
+
+
+class ApproximateCountPaginator(Paginator):
+    """
+    Paginator whose count may be approximate. Page numbers are then checked
+    against the rows actually found instead of the count, so a low estimate
+    never hides rows.
+    """
+
+    @cached_property
+    def count(self):
+        count, self.count_approximate = approximate_count(self.object_list)
+        return count
+
+    def count_exactly(self):
+        """Replaces an approximate count with the exact one."""
+        self.count
+        if self.count_approximate:
+            self.count = self.object_list.count()
+            self.count_approximate = False
+            self.__dict__.pop('num_pages', None)
+
+    def validate_number(self, number):
+        self.count
+        if not self.count_approximate:
+            return super().validate_number(number)
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            return super().validate_number(number)
+        if number < 1:
+            raise EmptyPage(_('That page number is less than 1'))
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        if not self.count_approximate:
+            return super().page(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not rows and number > 1:
+            raise EmptyPage(_('That page contains no results'))
+        page = self._get_page(rows[:self.per_page], number, self)
+        page.has_more = len(rows) > self.per_page
+        return page
+
+    def _get_page(self, *args, **kwargs):
+        return ApproximateCountPage(*args, **kwargs)
+
+
+class ApproximateCountPagination(PageNumberPagination):
+    django_paginator_class = ApproximateCountPaginator
+
+    def get_page_number(self, request, paginator):
+        # An estimate can be off by whole pages, so the last page is found
+        # from the exact count.
+        if request.query_params.get(self.page_query_param) in self.last_page_strings:
+            paginator.count_exactly()
+        return super().get_page_number(request, paginator)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('count', self.page.paginator.count),
+            ('count_approximate', self.page.paginator.count_approximate),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
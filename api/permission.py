@@ -1,15 +1,13 @@
 from rest_framework.permissions import BasePermission
 
+from .roles import get_user_roles
+
 
 class PermissionBaseMixin(BasePermission):
     group = ''
 
     def has_permission(self, request, view):
-        if not bool(request.user and request.user.is_authenticated):
-            return False
-        if request.user.groups.filter(name=self.group):
-            return True
-        return False
+        return self.group in get_user_roles(request)
 
 
 class IsSystemAdministrotor(PermissionBaseMixin):
@@ -31,10 +29,5 @@ class IsCustomer(PermissionBaseMixin):
 class IsCustomerOrDeliveryCrew(BasePermission):
 
     def has_permission(self, request, view):
-        if not bool(request.user and request.user.is_authenticated):
-            return False
-        if request.user.groups.filter(name='Customer'):
-            return True
-        if request.user.groups.filter(name='Delivery Crew'):
-            return True
-        return False
\ No newline at end of file
+        roles = get_user_roles(request)
+        return 'Customer' in roles or 'Delivery Crew' in roles
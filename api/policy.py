@@ -0,0 +1,67 @@
+from rest_framework.permissions import BasePermission
+
+from .roles import get_user_roles
+
+
+METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'HEAD', 'OPTIONS')
+ROLES = ('SysAdmin', 'Manager', 'Delivery Crew', 'Customer')
+ANONYMOUS = 'Anonymous'
+SELF = 'self'
+ANY = '*'
+
+# Every allowed (view, method, caller role, target) combination. Filled once
+# per view class when the class is created, read-only afterwards.
+POLICY_TABLE = set()
+
+
+def methods_except(*excluded):
+    return tuple(method for method in METHODS if method not in excluded)
+
+
+def allow(methods=ANY, roles=ANY, targets=ANY):
+    return methods, roles, targets
+
+
+def compile_policy(view):
+    for methods, roles, targets in view.policy:
+        methods = METHODS if methods == ANY else methods
+        roles = ROLES if roles == ANY else roles
+        targets = view.policy_targets if targets == ANY else targets
+        for method in methods:
+            for role in roles:
+                for target in targets:
+                    POLICY_TABLE.add((view, method, role, target))
+
+
+class HasPolicyPermission(BasePermission):
+
+    def has_permission(self, request, view):
+        if not bool(request.user and request.user.is_authenticated):
+            roles = [ANONYMOUS]
+        else:
+            roles = get_user_roles(request)
+        target = view.get_policy_target(request)
+        for role in roles:
+            if (type(view), request.method, role, target) in POLICY_TABLE:
+                return True
+        return False
+
+
+class PolicyMixin:
+    """
+    Authorizes requests against the view's `policy`, a list of `allow()`
+    rules over methods, caller roles and targets. The rules are compiled into
+    POLICY_TABLE when the view class is created. Views whose rules depend on
+    the requested object list its labels in `policy_targets` and resolve the
+    label of the current request in `get_policy_target`.
+    """
+    policy = ()
+    policy_targets = (None,)
+    permission_classes = [HasPolicyPermission]
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        compile_policy(cls)
+
+    def get_policy_target(self, request):
+        return None
@@ -0,0 +1,69 @@
+import zlib
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+
+
+def role_cache_key(user_id):
+    return f'user-account:{user_id}'
+
+
+def get_cached_account(user_id):
+    """
+    Returns whether the given user exists and is active, and their group
+    names, from the shared cache, loading them with a single query on a miss.
+    """
+    key = role_cache_key(user_id)
+    account = cache.get(key)
+    if account is None:
+        rows = list(User.objects.filter(pk=user_id).values_list('is_active', 'groups__name'))
+        is_active = any(active for active, _ in rows)
+        roles = frozenset(name for _, name in rows if name is not None)
+        account = (is_active, roles)
+        cache.set(key, account, settings.ROLE_CACHE_TIMEOUT)
+    return account
+
+
+def get_cached_roles(user_id):
+    """Returns the group names of the given user, see get_cached_account."""
+    return get_cached_account(user_id)[1]
+
+
+def invalidate_user_roles(*user_ids):
+    keys = [role_cache_key(user_id) for user_id in user_ids]
+    if keys:
+        # Deleting after commit keeps a concurrent request from caching the
+        # groups as they were before the change.
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def role_version(roles):
+    """
+    Returns a number that identifies the given set of roles. It changes
+    whenever a role is added or removed, so tokens can be checked against it.
+    """
+    return zlib.crc32('\n'.join(sorted(roles)).encode())
+
+
+def load_user_roles(user):
+    if not bool(user and user.is_authenticated):
+        return frozenset()
+    roles = getattr(user, 'roles', None)
+    if roles is not None:
+        return frozenset(roles)
+    return get_cached_roles(user.pk)
+
+
+def get_user_roles(request):
+    """
+    Returns the group names of the requesting user as a frozenset. The groups
+    are served from the shared role cache and memoized on the request, so
+    every permission class and helper evaluated during the request shares them.
+    """
+    roles = getattr(request, '_user_roles', None)
+    if roles is None:
+        roles = load_user_roles(request.user)
+        request._user_roles = roles
+    return roles
@@ -0,0 +1,125 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from littlelemon.models import (
+    MenuItem,
+    Purchase,
+    PurchaseItem,
+    DailyItemSales,
+    DailyCategorySales,
+    DailyCustomerSales,
+)
+
+
+def increment_rollup(model, key_field, rows):
+    """
+    Adds the counters of `rows`, a list of {day, <key_field>, counter: value}
+    dicts, to the rollup rows of `model` with a single upsert, creating the
+    rows that don't exist yet.
+    """
+    if not rows:
+        return
+    # Concurrent upserts lock the rows they touch in the order of the VALUES
+    # list, so every checkout takes them in key order to avoid deadlocks.
+    rows = sorted(rows, key=lambda row: (row['day'], row[key_field]))
+    opts = model._meta
+    table = connection.ops.quote_name(opts.db_table)
+    key_columns = [opts.get_field('day').column, opts.get_field(key_field).column]
+    counters = [name for name in rows[0] if name not in ('day', key_field)]
+    columns = key_columns + [opts.get_field(name).column for name in counters]
+    quoted = [connection.ops.quote_name(column) for column in columns]
+    placeholders = ', '.join(['(' + ', '.join(['%s'] * len(columns)) + ')'] * len(rows))
+    increments = ', '.join(
+        f'{column} = {table}.{column} + EXCLUDED.{column}' for column in quoted[len(key_columns):]
+    )
+    sql = (
+        f'INSERT INTO {table} ({", ".join(quoted)}) VALUES {placeholders} '
+        f'ON CONFLICT ({", ".join(quoted[:len(key_columns)])}) DO UPDATE SET {increments}'
+    )
+    params = [
+        value for row in rows
+        for value in [row['day'], row[key_field]] + [row[name] for name in counters]
+    ]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def add_purchase_to_rollups(purchase, purchase_items):
+    day = timezone.localdate(purchase.date)
+    items = defaultdict(lambda: [0, Decimal(0)])
+    for purchase_item in purchase_items:
+        items[purchase_item.menuitem_id][0] += purchase_item.quantity
+        items[purchase_item.menuitem_id][1] += purchase_item.price
+    categories = defaultdict(lambda: [0, Decimal(0)])
+    for menuitem_id, category_id in MenuItem.objects.filter(pk__in=items).values_list('pk', 'category_id'):
+        categories[category_id][0] += items[menuitem_id][0]
+        categories[category_id][1] += items[menuitem_id][1]
+
+    increment_rollup(DailyItemSales, 'menuitem', [
+        {'day': day, 'menuitem': menuitem_id, 'units': units, 'revenue': revenue}
+        for menuitem_id, (units, revenue) in items.items()
+    ])
+    increment_rollup(DailyCategorySales, 'category', [
+        {'day': day, 'category': category_id, 'units': units, 'revenue': revenue}
+        for category_id, (units, revenue) in categories.items()
+    ])
+    increment_rollup(DailyCustomerSales, 'user', [{
+        'day': day,
+        'user': purchase.user_id,
+        'orders': 1,
+        'units': sum(units for units, _ in items.values()),
+        'revenue': sum((revenue for _, revenue in items.values()), Decimal(0)),
+    }])
+
+
+def lock_purchases():
+    # Checkouts insert their purchase before adding it to the rollups, so
+    # this waits for the checkouts in progress and holds off new ones until
+    # the transaction ends. SQLite lets a single transaction write at a time
+    # anyway.
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(f'LOCK TABLE {connection.ops.quote_name(Purchase._meta.db_table)} IN SHARE MODE')
+
+
+@transaction.atomic
+def rebuild_rollups(since=None):
+    """
+    Recomputes the rollups from the purchases, for every day or for the days
+    from `since` on. Checkouts wait for the rebuild to finish.
+    """
+    lock_purchases()
+    rollups = [DailyItemSales, DailyCategorySales, DailyCustomerSales]
+    # Purchase-items whose purchase was deleted belong to no day.
+    purchase_items = PurchaseItem.objects.filter(purchase__isnull=False).annotate(day=TruncDate('purchase__date'))
+    purchases = Purchase.objects.annotate(day=TruncDate('date'))
+    if since is not None:
+        purchase_items = purchase_items.filter(day__gte=since)
+        purchases = purchases.filter(day__gte=since)
+    for model in rollups:
+        (model.objects.filter(day__gte=since) if since is not None else model.objects.all()).delete()
+
+    DailyItemSales.objects.bulk_create([
+        DailyItemSales(day=row['day'], menuitem_id=row['menuitem'], units=row['units'], revenue=row['revenue'])
+        for row in purchase_items.values('day', 'menuitem').annotate(units=Sum('quantity'), revenue=Sum('price'))
+    ], batch_size=1000)
+    DailyCategorySales.objects.bulk_create([
+        DailyCategorySales(day=row['day'], category_id=row['menuitem__category'], units=row['units'], revenue=row['revenue'])
+        for row in purchase_items.values('day', 'menuitem__category').annotate(units=Sum('quantity'), revenue=Sum('price'))
+    ], batch_size=1000)
+    DailyCustomerSales.objects.bulk_create([
+        DailyCustomerSales(
+            day=row['day'], user_id=row['user'], orders=row['orders'],
+            units=row['units'] or 0, revenue=row['revenue'] or 0,
+        )
+        for row in purchases.values('day', 'user').annotate(
+            orders=Count('id', distinct=True),
+            units=Sum('purchaseitems__quantity'),
+            revenue=Sum('purchaseitems__price'),
+        )
+    ], batch_size=1000)
@@ -1,10 +1,14 @@
 from rest_framework import serializers
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
 from django.contrib.auth.models import User, Group
 
 from littlelemon.models import (
-    MenuItem, Category, Cart, Order, OrderItem, Purchase, PurchaseItem,
+    MenuItem, Category, Cart, Order, OrderItem, Purchase, PurchaseItem, CheckoutJob,
 )
 
+from .authentication import RoleClaimsRefreshToken
+from .checkout import snapshot_line_items
+
 
 class GroupSerializer(serializers.ModelSerializer):
 
@@ -52,12 +56,56 @@ class CartSerializer(serializers.HyperlinkedModelSerializer):
         read_only = ['user']
 
 
+class CartLinesSerializer(CartSerializer):
+    orderitems = serializers.HyperlinkedRelatedField(source='lines', many=True, read_only=True, view_name='orderitem-detail')
+
+
+class CartTotalsSerializer(CartLinesSerializer):
+    count = serializers.IntegerField(source='totals.count', read_only=True)
+    quantity = serializers.IntegerField(source='totals.quantity', read_only=True)
+    total = serializers.DecimalField(source='totals.total', max_digits=10, decimal_places=2, read_only=True)
+
+    class Meta(CartSerializer.Meta):
+        fields = CartSerializer.Meta.fields + ['count', 'quantity', 'total']
+
+
+class CartLineSerializer(serializers.ModelSerializer):
+    title = serializers.CharField(source='menuitem.title', read_only=True)
+
+    class Meta:
+        model = OrderItem
+        fields = ['id', 'menuitem', 'title', 'quantity', 'unit_price', 'price']
+
+
+class CartSummarySerializer(CartTotalsSerializer):
+    lines = CartLineSerializer(many=True, read_only=True)
+
+    class Meta(CartTotalsSerializer.Meta):
+        fields = CartTotalsSerializer.Meta.fields + ['lines']
+
+
 class PurchaseSerializer(serializers.HyperlinkedModelSerializer):
 
     class Meta:
         model = Purchase
         fields = ['user', 'purchaseitems', 'date']
         read_only = ['user', 'date']
+        extra_kwargs = {
+            'purchaseitems': {'view_name': 'purchaseitem-detail', 'read_only': True},
+        }
+
+
+class PurchaseLineItemsSerializer(serializers.HyperlinkedModelSerializer):
+    line_items = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Purchase
+        fields = ['user', 'line_items', 'date']
+
+    def get_line_items(self, purchase):
+        if purchase.line_items is not None:
+            return purchase.line_items
+        return snapshot_line_items(purchase.purchaseitems.select_related('menuitem').order_by('id'))
 
 
 class PurchaseItemSerializer(serializers.HyperlinkedModelSerializer):
@@ -76,3 +124,19 @@ class OrderSerializer(serializers.HyperlinkedModelSerializer):
         extra_kwargs = {
             'delivery_crew_id': {'write_only': True},
         }
+
+
+class CheckoutJobSerializer(serializers.HyperlinkedModelSerializer):
+
+    class Meta:
+        model = CheckoutJob
+        fields = ['id', 'url', 'status', 'order', 'error', 'created', 'updated']
+        extra_kwargs = {'url': {'view_name': 'checkoutjob-detail'}}
+
+
+class RoleClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    token_class = RoleClaimsRefreshToken
+
+
+class RoleClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    token_class = RoleClaimsRefreshToken
@@ -0,0 +1,59 @@
+from django.contrib.auth.models import User, Group
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_save, pre_delete
+from django.dispatch import receiver
+
+from littlelemon.models import MenuItem, Category
+
+from .roles import invalidate_user_roles
+from .snapshots import bump_menu_version
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def user_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ['post_add', 'post_remove']:
+        if reverse:
+            invalidate_user_roles(*pk_set)
+        else:
+            invalidate_user_roles(instance.pk)
+    elif action == 'pre_clear':
+        if reverse:
+            invalidate_user_roles(*instance.user_set.values_list('pk', flat=True))
+        else:
+            invalidate_user_roles(instance.pk)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, update_fields=None, **kwargs):
+    # Logging in only stamps last_login, which the cached account leaves out.
+    if update_fields is None or set(update_fields) != {'last_login'}:
+        invalidate_user_roles(instance.pk)
+
+
+@receiver(pre_save, sender=Group)
+def group_saving(sender, instance, **kwargs):
+    # Saving a group without renaming it leaves the roles of its members as
+    # they were, so only a new name drops them, once it is written.
+    instance._renamed = (
+        instance.pk is not None
+        and Group.objects.filter(pk=instance.pk).exclude(name=instance.name).exists()
+    )
+
+
+@receiver(post_save, sender=Group)
+def group_saved(sender, instance, **kwargs):
+    if instance._renamed:
+        invalidate_user_roles(*instance.user_set.values_list('pk', flat=True))
+
+
+@receiver(pre_delete, sender=Group)
+def group_deleted(sender, instance, **kwargs):
+    invalidate_user_roles(*instance.user_set.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=MenuItem)
+@receiver(post_delete, sender=MenuItem)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def menu_changed(sender, **kwargs):
+    bump_menu_version()
@@ -0,0 +1,43 @@
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+
+MENU_VERSION_KEY = 'menu-version'
+
+
+def get_menu_version():
+    version = cache.get(MENU_VERSION_KEY)
+    if version is None:
+        # A timestamp rather than a counter, so a version lost with the cache
+        # never collides with one handed out before.
+        cache.add(MENU_VERSION_KEY, time.time_ns(), None)
+        version = cache.get(MENU_VERSION_KEY)
+    return version
+
+
+def bump_menu_version():
+    transaction.on_commit(lambda: cache.set(MENU_VERSION_KEY, time.time_ns(), None))
+
+
+def menu_snapshot_key(request):
+    uri_digest = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+    return f'menu-snapshot:{get_menu_version()}:{request.accepted_renderer.format}:{uri_digest}'
+
+
+def etag_for(key):
+    return '"{}"'.format(hashlib.md5(key.encode()).hexdigest())
+
+
+def etag_matches(request, etag):
+    """
+    Returns whether the If-None-Match header of the request lists `etag`.
+    `*` matches any representation, so the caller checks there is one first.
+    """
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip().removeprefix('W/') for candidate in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates
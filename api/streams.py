@@ -0,0 +1,118 @@
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken, TokenError
+
+from .authentication import RoleClaimsJWTAuthentication
+from .events import broker
+from .roles import load_user_roles
+
+
+ORDER_EVENTS_PATH = '/api/orders/events'
+
+
+def authenticate(scope):
+    """
+    Returns the user and roles of the access token sent in the Authorization
+    header, or in the `token` query parameter for EventSource clients, which
+    can't set headers.
+    """
+    headers = dict(scope['headers'])
+    authentication = RoleClaimsJWTAuthentication()
+    raw_token = None
+    if b'authorization' in headers:
+        raw_token = authentication.get_raw_token(headers[b'authorization'])
+    else:
+        for parameter in scope['query_string'].split(b'&'):
+            name, _, value = parameter.partition(b'=')
+            if name == b'token' and value:
+                raw_token = value
+    if raw_token is None:
+        return None, frozenset()
+    try:
+        user = authentication.get_user(authentication.get_validated_token(raw_token))
+    except (AuthenticationFailed, InvalidToken, TokenError):
+        return None, frozenset()
+    return user, load_user_roles(user)
+
+
+def order_event_filter(user, roles):
+    if 'Manager' in roles:
+        return lambda event: True
+    see_own = 'Customer' in roles
+    see_assigned = 'Delivery Crew' in roles
+    return lambda event: (
+        (see_own and event['user'] == user.pk)
+        or (see_assigned and event['delivery_crew'] == user.pk)
+    )
+
+
+def encode_event(event):
+    return f'id: {event["id"]}\nevent: {event["type"]}\ndata: {json.dumps(event, cls=DjangoJSONEncoder)}\n\n'.encode()
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def send_error(send, status, message):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json')],
+    })
+    await send({'type': 'http.response.body', 'body': json.dumps({'detail': message}).encode()})
+
+
+async def order_events(scope, receive, send):
+    """
+    Streams the order events the caller may see as server-sent events:
+    customers get their own orders, delivery crew the orders assigned to them
+    and managers every order. Idle streams get a comment line every
+    ORDER_EVENTS_HEARTBEAT seconds so proxies keep them open.
+    """
+    if scope['method'] != 'GET':
+        return await send_error(send, 405, f'Method "{scope["method"]}" not allowed.')
+    user, roles = await sync_to_async(authenticate)(scope)
+    if user is None:
+        return await send_error(send, 401, 'Authentication credentials were not provided or are invalid.')
+    if not roles & {'Manager', 'Customer', 'Delivery Crew'}:
+        return await send_error(send, 403, 'You do not have permission to perform this action.')
+
+    subscription = await broker.subscribe(order_event_filter(user, roles))
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': b': connected\n\n', 'more_body': True})
+        while not subscription.overflowed:
+            next_event = asyncio.ensure_future(subscription.get())
+            done, _ = await asyncio.wait(
+                [next_event, disconnected],
+                timeout=settings.ORDER_EVENTS_HEARTBEAT,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if disconnected in done:
+                next_event.cancel()
+                return
+            if next_event in done:
+                body = encode_event(next_event.result())
+            else:
+                next_event.cancel()
+                body = b': heartbeat\n\n'
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+        broker.unsubscribe(subscription)
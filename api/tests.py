@@ -0,0 +1,1468 @@
+import asyncio
+import base64
+import json
+import re
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User, Group, update_last_login
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, APITestCase
+
+from littlelemon.models import (
+    Category, MenuItem, LineItem, OrderItem, Cart, CheckoutJob, IdempotencyKey, Order, OrderEvent, Purchase,
+    DailyItemSales, DailyCategorySales, DailyCustomerSales,
+)
+
+from .authentication import RoleClaimsRefreshToken
+from .cart import add_cart_item, change_cart_items, carts, CacheCartBackend
+from .checkout import checkout, enqueue_checkout, run_checkout_job, run_next_checkout_job
+from .dispatch import crew_load
+from .filters import TypedSearchFilter
+from .roles import role_cache_key
+from .rollups import rebuild_rollups
+from .events import OrderEventBroker, OrderEventLogBackend, LocalEventBackend, publish_order_event, ORDER_ASSIGNED, ORDER_STATUS
+from .policy import ANONYMOUS
+from .urls import urlpatterns
+
+
+def create_user(username, *group_names):
+    user = User.objects.create_user(username=username, password='littlelemon')
+    for group_name in group_names:
+        Group.objects.get_or_create(name=group_name)[0].user_set.add(user)
+    return user
+
+
+def is_role_query(sql):
+    # The query of get_cached_account, which loads the group names of a user.
+    return sql.startswith('SELECT "auth_user"."is_active" AS "is_active", "auth_group"."name" AS "groups__name" FROM "auth_user"')
+
+
+class LittleLemonTestCase(APITestCase):
+    """
+    Seeds a menu, a user per role, and an order of the customer delivered by
+    the delivery crew, with a menu item left in the customer's cart.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(title='Mains', slug='mains')
+        cls.menu_items = [
+            MenuItem.objects.create(title=f'Dish {number}', price=Decimal('4.50'), featured=False, category=cls.category)
+            for number in range(3)
+        ]
+        cls.admin = create_user('admin', 'SysAdmin')
+        cls.manager = create_user('manager', 'Manager')
+        cls.delivery_crew = create_user('crew', 'Delivery Crew')
+        cls.customer = create_user('customer', 'Customer')
+
+        add_cart_item(cls.customer, cls.menu_items[0].pk, 2)
+        add_cart_item(cls.customer, cls.menu_items[1].pk, 1)
+        cls.order = checkout(cls.customer, Cart.objects.get(user=cls.customer))
+        cls.order.delivery_crew = cls.delivery_crew
+        cls.order.save()
+        add_cart_item(cls.customer, cls.menu_items[2].pk, 1)
+
+    def setUp(self):
+        cache.clear()
+
+    def request(self, user, method, path, data=None, headers=None):
+        """Sends the request as `user` and returns the response and the SQL of its queries."""
+        self.client.force_authenticate(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method.lower())(path, data, format='json', headers=headers)
+        return response, [query['sql'] for query in queries.captured_queries]
+
+
+class RoleQueryCountTests(LittleLemonTestCase):
+    """
+    Each endpoint loads the roles of the caller with one query when they
+    aren't cached, however many permission checks and helpers use them.
+    """
+
+    # (caller, path, queries with the role cache empty)
+    ENDPOINTS = [
+        ('customer', '/api/menu-items', 3),
+        ('customer', '/api/categories', 3),
+        ('customer', '/api/cart', 3),
+        ('customer', '/api/order-items', 3),
+        ('customer', '/api/orders', 3),
+        ('customer', '/api/orders/{order}', 2),
+        ('customer', '/api/purchases', 4),
+        ('customer', '/api/orders/changes', 2),
+        ('customer', '/api/users/{customer}', 3),
+        ('delivery_crew', '/api/orders', 3),
+        ('delivery_crew', '/api/menu-items', 3),
+        ('manager', '/api/users', 3),
+        ('manager', '/api/users/{customer}', 3),
+        ('manager', '/api/groups/managers', 3),
+        ('manager', '/api/orders/changes', 2),
+        ('manager', '/api/reports/sales', 2),
+        ('admin', '/api/users/{manager}', 3),
+    ]
+
+    def get_path(self, path):
+        return path.format(order=self.order.pk, customer=self.customer.pk, manager=self.manager.pk)
+
+    def test_query_count_per_endpoint(self):
+        for caller, path, expected_queries in self.ENDPOINTS:
+            with self.subTest(caller=caller, path=path):
+                cache.clear()
+                response, queries = self.request(getattr(self, caller), 'GET', self.get_path(path))
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(queries), expected_queries, '\n'.join(queries))
+                self.assertEqual(sum(map(is_role_query, queries)), 1)
+
+    def test_cached_roles_are_not_loaded_again(self):
+        for caller, path, _ in self.ENDPOINTS:
+            with self.subTest(caller=caller, path=path):
+                self.request(getattr(self, caller), 'GET', self.get_path(path))
+                response, queries = self.request(getattr(self, caller), 'GET', self.get_path(path))
+                self.assertEqual(response.status_code, 200)
+                self.assertFalse(any(map(is_role_query, queries)), '\n'.join(queries))
+
+
+
+A, S, M, D, C = ANONYMOUS, 'SysAdmin', 'Manager', 'Delivery Crew', 'Customer'
+METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE')
+
+
+def grant(callers, methods=METHODS):
+    return dict.fromkeys(methods, set(callers))
+
+
+class PolicyMatrixTests(LittleLemonTestCase):
+    """
+    Sends every method to every route as every caller role and checks who
+    gets past the policy against a literal table. Requests are rolled back,
+    so handlers that let the caller through don't change the seeded data.
+    """
+
+    CALLERS = (A, S, M, D, C)
+
+    # (path, body, {method: callers let through}); methods left out are denied to everyone.
+    MATRIX = [
+        ('users', None, grant([M]) | {'POST': {A, M}}),
+        ('users/{self}', None, grant([D, C])),
+        ('users/{other_admin}', None, grant([S])),
+        ('users/{other_manager}', None, grant([S]) | {'GET': {S, M}}),
+        ('users/{other_customer}', None, grant([S, M])),
+        ('groups', None, grant([M])),
+        ('groups/{admin_group}', None, grant([S])),
+        ('groups/{manager_group}', None, grant([S]) | {'GET': {M}}),
+        ('groups/{customer_group}', None, grant([M])),
+        ('groups/admins', None, grant([S])),
+        ('groups/admins/{other_customer}', None, grant([S])),
+        ('groups/managers', None, grant([S]) | grant([M], ['GET', 'POST'])),
+        ('groups/managers/{self}', None, grant([M])),
+        ('groups/managers/{other_customer}', None, grant([S]) | {'GET': {M}}),
+        ('groups/delivery-crew', None, grant([M])),
+        ('groups/delivery-crew/{other_customer}', None, grant([M])),
+        ('groups/customers', None, grant([M])),
+        ('groups/customers/{other_customer}', None, grant([M])),
+        ('menu-items', None, grant([M]) | {'GET': {D, C}}),
+        ('menu-items/{menu_item}', None, grant([M]) | {'GET': {D, C}}),
+        ('categories', None, grant([M]) | {'GET': {D, C}}),
+        ('categories/{category}', None, grant([M]) | {'GET': {D, C}}),
+        ('categories/{category}/menu-items', None, grant([M]) | {'GET': {D, C}}),
+        ('order-items', None, grant([C])),
+        ('order-items/{order_item}', None, grant([C])),
+        ('cart', None, grant([C])),
+        ('cart/items', None, {'POST': {C}}),
+        ('cart/items:batch', None, {'POST': {C}}),
+        ('orders', None, {'GET': {D, C}, 'POST': {C}, 'PUT': {M}, 'PATCH': {M, D}, 'DELETE': {M}}),
+        ('orders/{order}', None, grant([M]) | {'GET': {D, C}, 'PATCH': {D}}),
+        ('orders/{order}', {'delivery_crew_id': '{delivery_crew}'}, grant([M]) | {'GET': {D, C}}),
+        ('orders/dispatch', None, grant([M], ['GET', 'POST'])),
+        ('orders/changes', None, {'GET': {M, D, C}}),
+        ('orders/checkouts/{checkout_job}', None, {'GET': {M, C}}),
+        ('purchases', None, grant([C])),
+        ('purchases/{purchase}', None, grant([M]) | {'GET': {C}}),
+        ('purchase-items', None, grant([C])),
+        ('purchase-items/{purchase}', None, grant([M]) | {'GET': {C}}),
+        ('reports/sales', None, {'GET': {M}}),
+        ('reports/menu-items', None, {'GET': {M}}),
+        ('reports/categories', None, {'GET': {M}}),
+        ('reports/customers', None, {'GET': {M}}),
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.callers = {A: None, S: cls.admin, M: cls.manager, D: cls.delivery_crew, C: cls.customer}
+        cls.ids = {
+            'other_admin': create_user('admin2', 'SysAdmin').pk,
+            'other_manager': create_user('manager2', 'Manager').pk,
+            'other_customer': create_user('customer2', 'Customer').pk,
+            'admin_group': Group.objects.get(name='SysAdmin').pk,
+            'manager_group': Group.objects.get(name='Manager').pk,
+            'customer_group': Group.objects.get(name='Customer').pk,
+            'delivery_crew': cls.delivery_crew.pk,
+            'menu_item': cls.menu_items[0].pk,
+            'category': cls.category.pk,
+            'order_item': Cart.objects.get(user=cls.customer).orderitems.get().pk,
+            'order': cls.order.pk,
+            'checkout_job': CheckoutJob.objects.create(user=cls.customer).pk,
+            'purchase': Purchase.objects.get(user=cls.customer).pk,
+        }
+
+    def setUp(self):
+        super().setUp()
+        # Some handlers fail on the empty bodies sent here; only the policy decision matters.
+        self.client.raise_request_exception = False
+
+    def is_let_through(self, caller, method, path, body):
+        user = self.callers[caller]
+        ids = dict(self.ids, self=(user or self.customer).pk)
+        data = {key: value.format(**ids) for key, value in (body or {}).items()}
+        cache.clear()
+        with transaction.atomic():
+            response, _ = self.request(user, method, '/api/' + path.format(**ids), data)
+            transaction.set_rollback(True)
+        return response.status_code not in (status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN)
+
+    def test_matrix_covers_every_route(self):
+        routes = {str(pattern.pattern) for pattern in urlpatterns}
+        covered = {re.sub(r'\{\w+\}', '<int:pk>', path) for path, _, _ in self.MATRIX}
+        self.assertEqual(routes, covered)
+
+    def test_policy_matrix(self):
+        for path, body, granted in self.MATRIX:
+            for method in METHODS:
+                for caller in self.CALLERS:
+                    with self.subTest(path=path, body=body, method=method, caller=caller):
+                        expected = caller in granted.get(method, ())
+                        self.assertEqual(self.is_let_through(caller, method, path, body), expected)
+
+
+class CheckoutQueryCountTests(LittleLemonTestCase):
+    """
+    Checking out a cart costs the same number of queries however many items
+    it holds, on the request and on the checkout worker.
+    """
+
+    CART_SIZES = (1, 20)
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.menu_items += [
+            MenuItem.objects.create(title=f'Dish {number}', price=Decimal('3.25'), featured=False, category=cls.category)
+            for number in range(len(cls.menu_items), max(cls.CART_SIZES))
+        ]
+
+    def fill_cart(self, size):
+        user = create_user(f'customer-{size}', 'Customer')
+        change_cart_items(user, {menu_item.pk: 2 for menu_item in self.menu_items[:size]})
+        return user
+
+    def test_checkout_queries_do_not_grow_with_the_cart(self):
+        query_counts = []
+        for size in self.CART_SIZES:
+            user = self.fill_cart(size)
+            cache.clear()
+            response, queries = self.request(user, 'POST', '/api/orders')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(len(Order.objects.get(user=user).purchase.line_items), size)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[-1], query_counts)
+
+    def test_checkout_job_queries_do_not_grow_with_the_cart(self):
+        query_counts = []
+        for size in self.CART_SIZES:
+            user = self.fill_cart(size)
+            job = enqueue_checkout(user)
+            with CaptureQueriesContext(connection) as queries:
+                run_checkout_job(job)
+            self.assertEqual(job.status, CheckoutJob.DONE, job.error)
+            self.assertEqual(job.order.purchase.purchaseitems.count(), size)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[-1], query_counts)
+
+
+class RelationLoadingQueryCountTests(LittleLemonTestCase):
+    """
+    A page of orders, purchases or cart items costs the same number of
+    queries however many rows it holds.
+    """
+
+    ENDPOINTS = [
+        ('customer', '/api/orders'),
+        ('customer', '/api/orders/{order}'),
+        ('customer', '/api/purchases'),
+        ('customer', '/api/purchases?expand=lines'),
+        ('customer', '/api/purchases/{purchase}'),
+        ('customer', '/api/purchase-items'),
+        ('customer', '/api/order-items'),
+        ('customer', '/api/cart'),
+        ('delivery_crew', '/api/orders'),
+    ]
+
+    def add_rows(self, count):
+        for number in range(count):
+            change_cart_items(self.customer, {menu_item.pk: 1 for menu_item in self.menu_items})
+            Order.objects.filter(pk=checkout(self.customer, Cart.objects.get(user=self.customer)).pk).update(
+                delivery_crew = self.delivery_crew,
+            )
+        change_cart_items(self.customer, {menu_item.pk: 1 for menu_item in self.menu_items})
+
+    def count_queries(self):
+        query_counts = {}
+        for caller, path in self.ENDPOINTS:
+            cache.clear()
+            path = path.format(order=self.order.pk, purchase=self.order.purchase_id)
+            response, queries = self.request(getattr(self, caller), 'GET', path)
+            self.assertEqual(response.status_code, status.HTTP_200_OK, path)
+            query_counts[caller, path] = len(queries)
+        return query_counts
+
+    def test_queries_do_not_grow_with_the_rows(self):
+        query_counts = self.count_queries()
+        self.add_rows(4)
+        self.assertEqual(self.count_queries(), query_counts)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'the query plans are checked on PostgreSQL')
+class QueryPlanTests(LittleLemonTestCase):
+    """
+    The order, purchase and line-item queries of the list and detail views
+    are served from indexes, checked with EXPLAIN on a seeded dataset.
+    """
+
+    CUSTOMERS = 100
+    DELIVERY_CREW = 300
+    ORDERS_PER_CUSTOMER = 30
+    SEQ_SCAN = re.compile(r'Seq Scan on (littlelemon_order|littlelemon_purchase|littlelemon_lineitem)\b')
+
+    ENDPOINTS = [
+        ('seeded_customer', '/api/orders'),
+        ('seeded_customer', '/api/orders/{order}'),
+        ('seeded_customer', '/api/purchases'),
+        ('seeded_customer', '/api/purchases/{purchase}'),
+        ('seeded_customer', '/api/purchase-items'),
+        ('seeded_customer', '/api/order-items'),
+        ('seeded_delivery_crew', '/api/orders'),
+        ('seeded_delivery_crew', '/api/orders?status=false'),
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        customers = cls.create_users('seeded-customer', cls.CUSTOMERS, 'Customer')
+        crew = cls.create_users('seeded-crew', cls.DELIVERY_CREW, 'Delivery Crew')
+        purchases = Purchase.objects.bulk_create([
+            Purchase(user=customer, line_items=[])
+            for customer in customers for _ in range(cls.ORDERS_PER_CUSTOMER)
+        ])
+        orders = Order.objects.bulk_create([
+            Order(user=purchase.user, purchase=purchase, delivery_crew=crew[number % len(crew)], status=number % 2, total=Decimal('9.00'))
+            for number, purchase in enumerate(purchases)
+        ])
+        LineItem.objects.bulk_create([
+            LineItem(
+                user=purchase.user, menuitem=menu_item, quantity=1, unit_price=menu_item.price, price=menu_item.price,
+                state=LineItem.PURCHASED, purchase=purchase,
+            )
+            for purchase in purchases for menu_item in cls.menu_items[:2]
+        ] + [
+            LineItem(user=customer, menuitem=cls.menu_items[0], quantity=1, unit_price=cls.menu_items[0].price, price=cls.menu_items[0].price)
+            for customer in customers
+        ])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        cls.seeded_customer, cls.seeded_delivery_crew = customers[0], crew[0]
+        cls.seeded_order = orders[0]
+
+    @staticmethod
+    def create_users(prefix, count, group_name):
+        users = User.objects.bulk_create([User(username=f'{prefix}-{number}') for number in range(count)])
+        Group.objects.get(name=group_name).user_set.add(*users)
+        return users
+
+    def test_view_queries_use_indexes(self):
+        for caller, path in self.ENDPOINTS:
+            path = path.format(order=self.seeded_order.pk, purchase=self.seeded_order.purchase_id)
+            response, queries = self.request(getattr(self, caller), 'GET', path)
+            self.assertEqual(response.status_code, status.HTTP_200_OK, path)
+            for sql in queries:
+                if not sql.startswith('SELECT'):
+                    continue
+                with self.subTest(path=path, sql=sql), connection.cursor() as cursor:
+                    cursor.execute(f'EXPLAIN {sql}')
+                    plan = '\n'.join(row[0] for row in cursor.fetchall())
+                    self.assertIsNone(self.SEQ_SCAN.search(plan), plan)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'test_cart_cache'}},
+    CART_BACKEND='api.cart.CacheCartBackend',
+)
+class CacheCartBackendTests(LittleLemonTestCase):
+    """
+    The cache cart backend gives every cart item an id right away and writes
+    the cached quantities from the write-behind thread, at checkout and when
+    the process exits.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('createcachetable', verbosity=0)
+        super().setUpTestData()
+
+    def setUp(self):
+        super().setUp()
+        self.backend = CacheCartBackend()
+        carts.backend = self.backend
+        self.addCleanup(setattr, carts, 'backend', None)
+
+    def cart_quantities(self):
+        return dict(OrderItem.objects.filter(user=self.customer).values_list('menuitem_id', 'quantity'))
+
+    def change_cart(self, quantities):
+        data = [{'menuitem_id': menuitem_id, 'quantity': quantity} for menuitem_id, quantity in quantities.items()]
+        response, _ = self.request(self.customer, 'POST', '/api/cart/items:batch', data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+
+    def cache_changes(self):
+        # The cart holds one unit of the third dish. The first dish gets an
+        # order-item right away, and the rest only changes the cache.
+        first, _, third = [menu_item.pk for menu_item in self.menu_items]
+        self.change_cart({first: 3})
+        self.change_cart({first: 2, third: -1})
+        self.assertEqual(self.cart_quantities(), {first: 3, third: 1})
+        return {first: 5}
+
+    def test_new_cart_items_get_an_id(self):
+        response, _ = self.request(self.customer, 'POST', '/api/cart/items', {'menuitem_id': self.menu_items[0].pk, 'quantity': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNotNone(response.data['id'])
+        self.assertTrue(OrderItem.objects.filter(pk=response.data['id'], user=self.customer, quantity=2).exists())
+
+    def test_out_of_range_quantities_are_refused(self):
+        quantities = self.cart_quantities()
+        for quantity in [40000, 3000]:
+            with self.subTest(quantity=quantity):
+                response, _ = self.request(self.customer, 'POST', '/api/cart/items', {'menuitem_id': self.menu_items[2].pk, 'quantity': quantity})
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn('quantity', response.data)
+        self.backend.flush()
+        self.assertEqual(self.cart_quantities(), quantities)
+
+    def test_write_behind_writes_stale_carts(self):
+        expected = self.cache_changes()
+        self.backend.flush_stale()
+        self.assertNotEqual(self.cart_quantities(), expected)
+        with override_settings(CART_FLUSH_AFTER=-1):
+            self.backend.flush_stale()
+        self.assertEqual(self.cart_quantities(), expected)
+        self.assertEqual(self.backend.pending(), {})
+
+    def test_checkout_writes_the_cached_cart(self):
+        self.cache_changes()
+        response, _ = self.request(self.customer, 'POST', '/api/orders')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        purchase = Order.objects.filter(user=self.customer).latest('id').purchase
+        self.assertEqual(
+            [(line['menuitem'], line['quantity']) for line in purchase.line_items],
+            [(self.menu_items[0].pk, 5)],
+        )
+
+    def test_exit_writes_every_pending_cart(self):
+        with mock.patch('api.cart.threading.Thread') as thread, mock.patch('api.cart.atexit.register') as register:
+            self.backend.start()
+        thread.assert_called_once_with(target=self.backend.write_behind, name='cart-flush', daemon=True)
+        expected = self.cache_changes()
+        exit_handler, = register.call_args.args
+        exit_handler()
+        self.assertEqual(self.cart_quantities(), expected)
+
+    def test_reads_show_unwritten_changes_without_writing_them(self):
+        first, _, third = [menu_item.pk for menu_item in self.menu_items]
+        self.cache_changes()
+        written = self.cart_quantities()
+        first_item = OrderItem.objects.get(user=self.customer, menuitem_id=first)
+        third_item = OrderItem.objects.get(user=self.customer, menuitem_id=third)
+
+        response, _ = self.request(self.customer, 'GET', '/api/cart?expand=summary')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([(line['id'], line['quantity']) for line in response.data['lines']], [(first_item.pk, 5)])
+        self.assertEqual(len(response.data['orderitems']), 1)
+
+        # A manager who is also a customer sees every cart.
+        for user in [self.customer, create_user('manager-customer', 'Manager', 'Customer')]:
+            with self.subTest(user=user.username):
+                response, _ = self.request(user, 'GET', '/api/order-items')
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                quantities = {item['id']: item['quantity'] for item in response.data['results']}
+                self.assertEqual(quantities[first_item.pk], 5)
+                self.assertNotIn(third_item.pk, quantities)
+
+                response, _ = self.request(user, 'GET', f'/api/order-items/{first_item.pk}')
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.data['quantity'], 5)
+                self.assertEqual(Decimal(response.data['price']), first_item.unit_price * 5)
+                response, _ = self.request(user, 'GET', f'/api/order-items/{third_item.pk}')
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        self.assertEqual(self.cart_quantities(), written)
+        self.assertIn(self.customer.pk, self.backend.pending())
+
+    def test_busy_carts_are_refused(self):
+        cache.add(f'cart-lock:{self.customer.pk}', 'held', 60)
+        with override_settings(CART_LOCK_WAIT=0.05):
+            response, _ = self.request(self.customer, 'POST', '/api/cart/items', {'menuitem_id': self.menu_items[0].pk, 'quantity': 1})
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.data['detail'].code, 'cart_busy')
+
+    def test_unshared_caches_are_refused(self):
+        for backend in ['locmem.LocMemCache', 'dummy.DummyCache', 'filebased.FileBasedCache']:
+            caches = {'default': {'BACKEND': f'django.core.cache.backends.{backend}', 'LOCATION': '/tmp/littlelemon-cache'}}
+            with self.subTest(backend=backend), override_settings(CACHES=caches):
+                self.assertRaises(ImproperlyConfigured, self.backend.start)
+
+
+class OrderEventBrokerTests(LittleLemonTestCase):
+    """
+    Event streams subscribe from the event loop, so the broker starts its
+    backend, which may query the database, outside of it.
+    """
+
+    async def test_subscribe_starts_the_event_log_backend(self):
+        event_broker = OrderEventBroker()
+        with self.settings(ORDER_EVENTS_BACKEND='api.events.OrderEventLogBackend'), mock.patch('api.events.threading.Thread') as thread:
+            subscription = await event_broker.subscribe(lambda event: event['order'] == self.order.pk)
+        self.assertIsInstance(event_broker.backend, OrderEventLogBackend)
+        thread.assert_called_once()
+
+        await sync_to_async(publish_order_event)(ORDER_STATUS, self.order)
+        await sync_to_async(event_broker.backend.poll)()
+        event = await asyncio.wait_for(subscription.get(), timeout=1)
+        self.assertEqual((event['type'], event['order']), (ORDER_STATUS, self.order.pk))
+
+    async def test_failed_start_is_tried_again(self):
+        event_broker = OrderEventBroker()
+        with mock.patch.object(LocalEventBackend, 'start', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                await event_broker.subscribe(lambda event: True)
+        self.assertIsNone(event_broker.backend)
+        await event_broker.subscribe(lambda event: True)
+        self.assertIsInstance(event_broker.backend, LocalEventBackend)
+
+
+class TypedSearchFilterTests(LittleLemonTestCase):
+    """
+    Search terms only reach the fields whose type they parse as, and fields
+    declared with a lookup prefix or path use that lookup.
+    """
+
+    def search(self, queryset, search_fields, term):
+        request = Request(APIRequestFactory().get('/', {'search': term}))
+        view = SimpleNamespace(search_fields=search_fields)
+        return list(TypedSearchFilter().filter_queryset(request, queryset, view))
+
+    def test_prefixed_and_related_search_fields(self):
+        menu_items = MenuItem.objects.order_by('id')
+        self.assertEqual(self.search(menu_items, ['^title'], 'dish'), self.menu_items)
+        self.assertEqual(self.search(menu_items, ['^title'], 'ish'), [])
+        self.assertEqual(self.search(menu_items, ['=title'], '"Dish 1"'), [self.menu_items[1]])
+        self.assertEqual(self.search(menu_items, ['category__slug'], 'main'), self.menu_items)
+        self.assertEqual(self.search(menu_items, ['$title'], r'^Dish [02]$'), [self.menu_items[0], self.menu_items[2]])
+
+    def test_typed_terms(self):
+        menu_items = MenuItem.objects.order_by('id')
+        self.assertEqual(self.search(menu_items, ['title', 'price'], '4.50'), self.menu_items)
+        self.assertEqual(self.search(menu_items, ['price', 'featured'], 'cheap'), [])
+        self.assertEqual(self.search(menu_items, ['featured'], 'false'), self.menu_items)
+        self.assertEqual(self.search(menu_items, ['category'], str(self.category.pk)), self.menu_items)
+        self.assertEqual(self.search(menu_items, ['category'], '²'), [])
+
+        orders = Order.objects.all()
+        self.assertEqual(self.search(orders, ['date'], self.order.date.date().isoformat()), [self.order])
+        self.assertEqual(self.search(orders, ['date'], '2023-02-30'), [])
+        self.assertEqual(self.search(orders, ['user', 'status'], str(self.customer.pk)), [self.order])
+
+    def test_search_through_an_endpoint(self):
+        response, _ = self.request(self.customer, 'GET', '/api/menu-items', {'search': 'Dish 2'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Menu responses are served from the cached snapshot as rendered JSON.
+        self.assertEqual([item['id'] for item in response.json()['results']], [self.menu_items[2].pk])
+
+
+class SalesRollupTests(LittleLemonTestCase):
+    """
+    The rollups updated by every checkout match the ones rebuilt from the
+    purchases.
+    """
+
+    def rollups(self):
+        return {
+            model.__name__: sorted(model.objects.values_list(*[
+                field.attname for field in model._meta.concrete_fields if not field.primary_key
+            ]))
+            for model in [DailyItemSales, DailyCategorySales, DailyCustomerSales]
+        }
+
+    def check_out(self, user, quantities):
+        change_cart_items(user, quantities)
+        return checkout(user, Cart.objects.get(user=user))
+
+    def test_incremental_rollups_match_a_rebuild(self):
+        other_customer = create_user('customer2', 'Customer')
+        first, second, third = [menu_item.pk for menu_item in self.menu_items]
+        self.check_out(self.customer, {first: 1, third: 2})
+        self.check_out(other_customer, {second: 5})
+        self.check_out(other_customer, {first: 1, second: 1})
+
+        incremental = self.rollups()
+        self.assertEqual(sum(units for _, _, units, _ in incremental['DailyItemSales']), 14)
+        rebuild_rollups()
+        self.assertEqual(self.rollups(), incremental)
+        rebuild_rollups(since=timezone.localdate())
+        self.assertEqual(self.rollups(), incremental)
+
+    def test_rebuild_skips_purchase_items_without_a_purchase(self):
+        incremental = self.rollups()
+        menu_item = self.menu_items[0]
+        LineItem.objects.create(
+            user=self.customer, menuitem=menu_item, quantity=1, unit_price=menu_item.price, price=menu_item.price,
+            state=LineItem.PURCHASED,
+        )
+        rebuild_rollups()
+        self.assertEqual(self.rollups(), incremental)
+
+    @skipUnless(connection.vendor == 'postgresql', 'the purchases are locked on PostgreSQL')
+    def test_rebuild_locks_out_checkouts(self):
+        rebuild_rollups()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT mode FROM pg_locks WHERE pid = pg_backend_pid() AND relation = %s::regclass',
+                [Purchase._meta.db_table],
+            )
+            self.assertIn(('ShareLock',), cursor.fetchall())
+
+
+class RoleClaimsAuthenticationTests(LittleLemonTestCase):
+    """
+    Access tokens carry the roles of the user, and stop working once the
+    roles change or the user is deactivated or deleted.
+    """
+
+    def authenticate(self, user):
+        token = RoleClaimsRefreshToken.for_user(user).access_token
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def create_category(self):
+        return self.client.post('/api/categories', {'title': 'Sides', 'slug': 'sides'}, format='json').status_code
+
+    def test_role_change_rejects_the_token(self):
+        self.authenticate(self.manager)
+        self.assertEqual(self.create_category(), status.HTTP_201_CREATED)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.manager.groups.clear()
+        self.assertEqual(self.create_category(), status.HTTP_401_UNAUTHORIZED)
+
+    def test_deactivation_rejects_the_token(self):
+        self.authenticate(self.manager)
+        self.assertEqual(self.create_category(), status.HTTP_201_CREATED)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.manager.is_active = False
+            self.manager.save()
+        self.assertEqual(self.create_category(), status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self.client.get('/api/users').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deletion_rejects_the_token(self):
+        customer = create_user('customer2', 'Customer')
+        self.authenticate(customer)
+        self.assertEqual(self.client.get('/api/menu-items').status_code, status.HTTP_200_OK)
+        with self.captureOnCommitCallbacks(execute=True):
+            customer.delete()
+        self.assertEqual(self.client.get('/api/menu-items').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_login_keeps_the_cached_roles(self):
+        self.authenticate(self.customer)
+        self.client.get('/api/menu-items')
+        with self.captureOnCommitCallbacks(execute=True):
+            update_last_login(None, self.customer)
+        self.assertIsNotNone(cache.get(role_cache_key(self.customer.pk)))
+
+
+class KeysetPaginationTests(LittleLemonTestCase):
+    """
+    Following the next links visits every row once, in order, and a cursor
+    that wasn't handed out is refused.
+    """
+
+    @staticmethod
+    def encode_cursor(position):
+        return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+    def add_orders(self, count):
+        # Every order gets the same date, so only the ids tell them apart.
+        purchases = Purchase.objects.bulk_create([Purchase(user=self.customer, line_items=[]) for _ in range(count)])
+        Order.objects.bulk_create([
+            Order(user=self.customer, purchase=purchase, total=Decimal('9.00')) for purchase in purchases
+        ])
+        Order.objects.filter(user=self.customer).update(date=self.order.date)
+
+    def test_next_links_visit_every_row_once(self):
+        self.add_orders(12)
+        expected = list(Order.objects.filter(user=self.customer).order_by('-date', '-id').values_list('pk', flat=True))
+        served = []
+        path = '/api/orders?pagination=keyset'
+        while path is not None:
+            response, _ = self.request(self.customer, 'GET', path)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            served += [order['id'] for order in response.data['results']]
+            path = response.data['next'] and response.data['next'].removeprefix('http://testserver')
+        self.assertEqual(served, expected)
+
+    def test_tampered_cursors_are_refused(self):
+        cursors = [
+            'not-a-cursor!',
+            base64.urlsafe_b64encode(b'\xff\xfe').decode(),
+            self.encode_cursor({'id': 1}),
+            self.encode_cursor([1]),
+            self.encode_cursor(['yesterday', 1]),
+            self.encode_cursor([None, None]),
+            self.encode_cursor([self.order.date.isoformat(), None]),
+        ]
+        for cursor in cursors:
+            with self.subTest(cursor=cursor):
+                response, _ = self.request(self.customer, 'GET', f'/api/orders?cursor={cursor}')
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+                self.assertEqual(response.data['detail'], 'Invalid cursor')
+
+
+class MenuSnapshotTests(LittleLemonTestCase):
+    """
+    Menu responses carry an ETag that If-None-Match turns into a 304 until
+    the menu changes, and `*` matches only an item that exists.
+    """
+
+    def conditional_get(self, path, etag):
+        return self.request(self.customer, 'GET', path, headers={'If-None-Match': etag})
+
+    def test_matching_etags_get_not_modified(self):
+        path = f'/api/menu-items/{self.menu_items[0].pk}'
+        response, _ = self.request(self.customer, 'GET', path)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        response, queries = self.conditional_get(path, etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual([sql for sql in queries if not is_role_query(sql)], [])
+        response, _ = self.conditional_get(path, f'"other", W/{etag}')
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        response, _ = self.conditional_get(path, '"other"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['id'], self.menu_items[0].pk)
+
+    def test_menu_writes_change_the_etag(self):
+        path = '/api/menu-items'
+        response, _ = self.request(self.customer, 'GET', path)
+        etag = response['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            response, _ = self.request(self.manager, 'PATCH', f'/api/menu-items/{self.menu_items[0].pk}', {'price': '5.00'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+
+        response, _ = self.conditional_get(path, etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        prices = {item['id']: item['price'] for item in response.json()['results']}
+        self.assertEqual(prices[self.menu_items[0].pk], '5.00')
+
+    def test_any_etag_matches_only_existing_items(self):
+        response, _ = self.conditional_get(f'/api/menu-items/{self.menu_items[0].pk}', '*')
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response, _ = self.conditional_get('/api/menu-items/999999', '*')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class OrderUpdateEventTests(LittleLemonTestCase):
+    """
+    Updating an order publishes an event per field that changed, and only a
+    member of the delivery crew can be assigned to it.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.other_crew = create_user('other-crew', 'Delivery Crew')
+        self.path = f'/api/orders/{self.order.pk}'
+        self.seeded_events = OrderEvent.objects.filter(order_id=self.order.pk).count()
+
+    def events(self):
+        order_events = OrderEvent.objects.filter(order_id=self.order.pk).order_by('id')[self.seeded_events:]
+        return list(order_events.values_list('kind', 'delivery_crew_id', 'status'))
+
+    def put_order(self, **changes):
+        response, _ = self.request(self.customer, 'GET', self.path)
+        data = {field: response.data[field] for field in ['user', 'purchase', 'delivery_crew', 'status', 'total']}
+        data.update(changes)
+        with self.captureOnCommitCallbacks(execute=True):
+            response, _ = self.request(self.manager, 'PUT', self.path, data)
+        return response
+
+    def test_put_publishes_the_changed_fields(self):
+        response = self.put_order(total='9.00')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertEqual(self.events(), [])
+
+        response = self.put_order(status=True)
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertEqual(self.events(), [(ORDER_STATUS, self.delivery_crew.pk, True)])
+
+        response = self.put_order(delivery_crew=f'http://testserver/api/users/{self.other_crew.pk}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertEqual(self.events()[1:], [(ORDER_ASSIGNED, self.other_crew.pk, True)])
+
+    def test_only_delivery_crew_can_be_assigned(self):
+        response = self.put_order(delivery_crew=f'http://testserver/api/users/{self.customer.pk}')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        for delivery_crew_id in [self.customer.pk, 999999]:
+            with self.subTest(delivery_crew_id=delivery_crew_id):
+                response, _ = self.request(self.manager, 'PATCH', self.path, {'delivery_crew_id': delivery_crew_id})
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn('delivery_crew_id', response.data)
+        self.assertEqual(Order.objects.get(pk=self.order.pk).delivery_crew, self.delivery_crew)
+        self.assertEqual(self.events(), [])
+
+        response, _ = self.request(self.manager, 'PATCH', self.path, {'delivery_crew_id': self.other_crew.pk})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertEqual(self.events(), [(ORDER_ASSIGNED, self.other_crew.pk, False)])
+
+
+class ApproximateCountTests(LittleLemonTestCase):
+    """
+    PostgreSQL lists count whole tables from the planner estimate and reuse
+    filtered counts for a while, but the last page is always found from the
+    exact count. Other databases always count exactly.
+    """
+
+    def add_users(self, count):
+        User.objects.bulk_create([User(username=f'counted-{User.objects.count()}-{number}') for number in range(count)])
+
+    def get_users(self, user, path='/api/users'):
+        response, _ = self.request(user, 'GET', path)
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        return response.data
+
+    @skipUnless(connection.vendor == 'postgresql', 'the planner estimate exists on PostgreSQL')
+    def test_large_tables_use_the_planner_estimate(self):
+        # A manager who is also an admin lists every user, unfiltered.
+        admin = create_user('admin-manager', 'SysAdmin', 'Manager')
+        self.add_users(8)
+        with connection.cursor() as cursor:
+            # Stands in for the statistics of a large table, kept only until the test rolls back.
+            cursor.execute("UPDATE pg_class SET reltuples = 20000 WHERE oid = 'auth_user'::regclass")
+        data = self.get_users(admin)
+        self.assertEqual((data['count'], data['count_approximate']), (20000, True))
+        self.assertIsNotNone(data['next'])
+
+        count = User.objects.count()
+        data = self.get_users(admin, '/api/users?page=last')
+        self.assertEqual((data['count'], data['count_approximate']), (count, False))
+        self.assertEqual(len(data['results']), count - 5 * ((count - 1) // 5))
+        self.assertIsNone(data['next'])
+
+    def test_filtered_counts_are_cached_on_postgresql(self):
+        count = self.get_users(self.manager)['count']
+        self.add_users(6)
+        data = self.get_users(self.manager)
+        if connection.vendor == 'postgresql':
+            self.assertEqual((data['count'], data['count_approximate']), (count, True))
+        else:
+            self.assertEqual((data['count'], data['count_approximate']), (count + 6, False))
+
+        data = self.get_users(self.manager, '/api/users?page=last')
+        self.assertEqual((data['count'], data['count_approximate']), (count + 6, False))
+        self.assertEqual(len(data['results']), (count + 6) - 5 * ((count + 5) // 5))
+
+
+class RoleCacheInvalidationTests(LittleLemonTestCase):
+    """
+    A change of groups drops the cached roles of the users it touches, and
+    only theirs, once it is committed.
+    """
+
+    def warm_roles(self, *users):
+        for user in users:
+            self.request(user, 'GET', '/api/menu-items')
+            self.assertIsNotNone(cache.get(role_cache_key(user.pk)))
+
+    def test_group_endpoints_drop_the_changed_roles(self):
+        self.warm_roles(self.customer, self.delivery_crew)
+        response, _ = self.request(self.customer, 'GET', '/api/users')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response, _ = self.request(self.manager, 'POST', '/api/groups/managers', {'id': self.customer.pk})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertIsNone(cache.get(role_cache_key(self.customer.pk)))
+        self.assertIsNotNone(cache.get(role_cache_key(self.delivery_crew.pk)))
+        response, _ = self.request(self.customer, 'GET', '/api/users')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response, _ = self.request(self.admin, 'DELETE', f'/api/groups/managers/{self.customer.pk}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response, _ = self.request(self.customer, 'GET', '/api/users')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_roles_are_dropped_after_the_commit(self):
+        self.warm_roles(self.customer)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.customer.groups.add(Group.objects.get(name='Manager'))
+            self.assertIsNotNone(cache.get(role_cache_key(self.customer.pk)))
+        for callback in callbacks:
+            callback()
+        self.assertIsNone(cache.get(role_cache_key(self.customer.pk)))
+
+    def test_renaming_a_group_drops_the_roles_of_its_members(self):
+        self.warm_roles(self.customer, self.delivery_crew)
+        group = Group.objects.get(name='Delivery Crew')
+        with self.captureOnCommitCallbacks(execute=True):
+            group.save()
+        self.assertIsNotNone(cache.get(role_cache_key(self.delivery_crew.pk)))
+        with self.captureOnCommitCallbacks(execute=True):
+            group.name = 'Couriers'
+            group.save()
+        self.assertIsNone(cache.get(role_cache_key(self.delivery_crew.pk)))
+        self.assertIsNotNone(cache.get(role_cache_key(self.customer.pk)))
+
+
+class IdempotencyKeyTests(LittleLemonTestCase):
+    """
+    A write sent again with the same Idempotency-Key gets the stored response
+    of the first one and writes nothing, and a key reused for another request
+    is refused.
+    """
+
+    def send(self, path, data=None, key='retry-1', user=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            response, _ = self.request(user or self.customer, 'POST', path, data, headers={'Idempotency-Key': key})
+        return response
+
+    def cart_quantity(self, user=None):
+        return OrderItem.objects.get(user=user or self.customer, menuitem=self.menu_items[0]).quantity
+
+    def test_replayed_checkout_places_one_order(self):
+        orders = Order.objects.filter(user=self.customer).count()
+        first = self.send('/api/orders')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn('Idempotent-Replayed', first)
+
+        replay = self.send('/api/orders')
+        self.assertEqual(replay.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(replay['Idempotent-Replayed'], 'true')
+        self.assertEqual(Order.objects.filter(user=self.customer).count(), orders + 1)
+
+    def test_replayed_cart_change_is_applied_once(self):
+        data = {'menuitem_id': self.menu_items[0].pk, 'quantity': 2}
+        first = self.send('/api/cart/items', data)
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        replay = self.send('/api/cart/items', data)
+        self.assertEqual(replay.data, first.data)
+        self.assertEqual(self.cart_quantity(), 2)
+
+    def test_reused_keys_are_refused(self):
+        data = {'menuitem_id': self.menu_items[0].pk, 'quantity': 2}
+        self.send('/api/cart/items', data)
+        for path, other_data in [('/api/cart/items', dict(data, quantity=3)), ('/api/orders', None)]:
+            with self.subTest(path=path):
+                response = self.send(path, other_data)
+                self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(self.cart_quantity(), 2)
+        self.assertEqual(self.send('/api/cart/items', data, key='').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_keys_belong_to_a_user_and_expire(self):
+        data = {'menuitem_id': self.menu_items[0].pk, 'quantity': 2}
+        other_customer = create_user('other-customer', 'Customer')
+        self.send('/api/cart/items', data)
+        self.send('/api/cart/items', data, user=other_customer)
+        self.assertEqual(self.cart_quantity(other_customer), 2)
+
+        IdempotencyKey.objects.filter(user=self.customer).update(
+            created = timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TIMEOUT + 1),
+        )
+        response = self.send('/api/cart/items', data)
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(self.cart_quantity(), 4)
+
+
+class AsyncCheckoutTests(LittleLemonTestCase):
+    """
+    A checkout sent with Prefer: respond-async is queued and answered with
+    202, and the worker places the order that the job status then links to.
+    """
+
+    def checkout_async(self, user):
+        return self.request(user, 'POST', '/api/orders', headers={'Prefer': 'respond-async'})[0]
+
+    def run_worker(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('checkout_worker', once=True, stdout=StringIO())
+
+    def test_the_worker_places_the_queued_order(self):
+        orders = Order.objects.filter(user=self.customer).count()
+        response = self.checkout_async(self.customer)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], CheckoutJob.PENDING)
+        self.assertEqual(response['Location'], response.data['url'])
+        self.assertEqual(Order.objects.filter(user=self.customer).count(), orders)
+
+        self.run_worker()
+        job_path = response['Location'].removeprefix('http://testserver')
+        response, _ = self.request(self.customer, 'GET', job_path)
+        self.assertEqual(response.data['status'], CheckoutJob.DONE)
+        order = Order.objects.filter(user=self.customer).latest('id')
+        self.assertEqual(response.data['order'], f'http://testserver/api/orders/{order.pk}')
+        self.assertEqual([line['menuitem'] for line in order.purchase.line_items], [self.menu_items[2].pk])
+
+        other_customer = create_user('other-customer', 'Customer')
+        response, _ = self.request(other_customer, 'GET', job_path)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_jobs_of_emptied_carts_fail(self):
+        response = self.checkout_async(self.customer)
+        job = CheckoutJob.objects.get(pk=response.data['id'])
+        checkout(self.customer, Cart.objects.get(user=self.customer))
+        self.run_worker()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error, job.order), (CheckoutJob.FAILED, 'the cart is empty', None))
+
+        response = self.checkout_async(self.customer)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(CheckoutJob.objects.filter(status=CheckoutJob.PENDING).count(), 0)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'the jobs are locked on PostgreSQL')
+class CheckoutWorkerLockingTests(TransactionTestCase):
+    """
+    Workers running at the same time each claim a different pending job,
+    skipping the ones another worker holds.
+    """
+
+    def test_locked_jobs_are_skipped(self):
+        category = Category.objects.create(title='Mains', slug='mains')
+        menu_item = MenuItem.objects.create(title='Dish', price=Decimal('4.50'), featured=False, category=category)
+        jobs = []
+        for number in range(2):
+            customer = create_user(f'customer-{number}', 'Customer')
+            add_cart_item(customer, menu_item.pk, 1)
+            jobs.append(enqueue_checkout(customer))
+
+        locked, release = threading.Event(), threading.Event()
+
+        def hold_first_job():
+            try:
+                with transaction.atomic():
+                    CheckoutJob.objects.select_for_update().get(pk=jobs[0].pk)
+                    locked.set()
+                    release.wait(10)
+            finally:
+                connection.close()
+
+        holder = threading.Thread(target=hold_first_job)
+        holder.start()
+        try:
+            self.assertTrue(locked.wait(10))
+            job = run_next_checkout_job()
+        finally:
+            release.set()
+            holder.join()
+        self.assertEqual((job.pk, job.status), (jobs[1].pk, CheckoutJob.DONE))
+        jobs[0].refresh_from_db()
+        self.assertEqual(jobs[0].status, CheckoutJob.PENDING)
+
+
+class DispatchTests(LittleLemonTestCase):
+    """
+    Dispatching hands every unassigned open order to the crew member with
+    the fewest open orders at that point, the earlier crew member on ties.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.other_crew = create_user('other-crew', 'Delivery Crew')
+
+    def add_orders(self, count):
+        purchases = Purchase.objects.bulk_create([Purchase(user=self.customer, line_items=[]) for _ in range(count)])
+        orders = Order.objects.bulk_create([Order(user=self.customer, purchase=purchase, total=Decimal('9.00')) for purchase in purchases])
+        return [order.pk for order in orders]
+
+    def dispatch(self, data=None):
+        crew_load.rebuild()
+        with self.captureOnCommitCallbacks(execute=True):
+            response, _ = self.request(self.manager, 'POST', '/api/orders/dispatch', data)
+        return response
+
+    def test_orders_go_to_the_least_loaded_crew(self):
+        order_ids = self.add_orders(3)
+        assigned_events = OrderEvent.objects.filter(kind=ORDER_ASSIGNED).count()
+        response = self.dispatch()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # The seeded crew member already delivers the seeded order.
+        expected = dict(zip(order_ids, [self.other_crew.pk, self.delivery_crew.pk, self.other_crew.pk]))
+        self.assertEqual({row['order']: row['delivery_crew'] for row in response.data['assigned']}, expected)
+        self.assertEqual(dict(Order.objects.filter(pk__in=order_ids).values_list('pk', 'delivery_crew')), expected)
+        self.assertEqual(OrderEvent.objects.filter(kind=ORDER_ASSIGNED).count(), assigned_events + 3)
+
+        response, _ = self.request(self.manager, 'GET', '/api/orders/dispatch')
+        self.assertEqual(response.data['crew_load'], {self.delivery_crew.pk: 2, self.other_crew.pk: 2})
+        self.assertEqual(self.dispatch().data['assigned'], [])
+
+    def test_chosen_orders_and_limits(self):
+        order_ids = self.add_orders(3)
+        response = self.dispatch({'orders': order_ids[1:]})
+        self.assertEqual([row['order'] for row in response.data['assigned']], order_ids[1:])
+        response = self.dispatch({'limit': 1})
+        self.assertEqual([row['order'] for row in response.data['assigned']], order_ids[:1])
+        for data in [{'orders': 'all'}, {'limit': 0}]:
+            with self.subTest(data=data):
+                self.assertEqual(self.dispatch(data).status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(DISPATCH_ON_CHECKOUT=True)
+    def test_checkout_dispatches_the_new_order(self):
+        crew_load.rebuild()
+        with self.captureOnCommitCallbacks(execute=True):
+            response, _ = self.request(self.customer, 'POST', '/api/orders')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Order.objects.filter(user=self.customer).latest('id').delivery_crew, self.other_crew)
+
+
+class BulkOrderUpdateTests(LittleLemonTestCase):
+    """
+    PATCH /api/orders applies a list of changes with one UPDATE per distinct
+    new value, checks every row against the scope of the caller, and
+    answers with a result per change.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.other_crew = create_user('other-crew', 'Delivery Crew')
+        purchases = Purchase.objects.bulk_create([Purchase(user=self.customer, line_items=[]) for _ in range(4)])
+        self.orders = [self.order] + Order.objects.bulk_create([
+            Order(user=self.customer, purchase=purchase, delivery_crew=self.delivery_crew, total=Decimal('9.00'))
+            for purchase in purchases
+        ])
+        self.orders[-1].delivery_crew = self.other_crew
+        self.orders[-1].save()
+
+    def patch_orders(self, user, changes):
+        with self.captureOnCommitCallbacks(execute=True):
+            response, queries = self.request(user, 'PATCH', '/api/orders', changes)
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        return [(result['id'], result['code']) for result in response.data], queries
+
+    def test_crew_mark_their_orders_delivered(self):
+        own, foreign = [order.pk for order in self.orders[:3]], self.orders[4].pk
+        changes = [{'id': order_id, 'status': 1} for order_id in own + [foreign]]
+        changes += [{'id': own[0], 'status': 0}, {'id': self.orders[3].pk, 'delivery_crew_id': self.other_crew.pk}, {'status': 1}]
+        results, queries = self.patch_orders(self.delivery_crew, changes)
+        self.assertEqual(results, [(order_id, 200) for order_id in own] + [(foreign, 404), (own[0], 400), (self.orders[3].pk, 403), (None, 400)])
+        self.assertEqual(len([sql for sql in queries if sql.startswith('UPDATE')]), 1)
+        self.assertEqual(set(Order.objects.filter(status=True).values_list('pk', flat=True)), set(own))
+        self.assertEqual(OrderEvent.objects.filter(kind=ORDER_STATUS, order_id__in=own).count(), 3)
+
+    def test_managers_assign_members_of_the_crew(self):
+        order_ids = [order.pk for order in self.orders]
+        changes = [{'id': order_id, 'delivery_crew_id': self.other_crew.pk} for order_id in order_ids[:2]]
+        changes += [{'id': order_ids[2], 'delivery_crew_id': self.customer.pk}, {'id': order_ids[3], 'status': 1}]
+        results, queries = self.patch_orders(self.manager, changes)
+        self.assertEqual(results, [(order_ids[0], 200), (order_ids[1], 200), (order_ids[2], 400), (order_ids[3], 200)])
+        self.assertEqual(len([sql for sql in queries if sql.startswith('UPDATE')]), 2)
+        self.assertEqual(
+            list(Order.objects.filter(pk__in=order_ids).order_by('id').values_list('delivery_crew', 'status')),
+            [(self.other_crew.pk, False)] * 2 + [(self.delivery_crew.pk, False), (self.delivery_crew.pk, True), (self.other_crew.pk, False)],
+        )
+
+    def test_bad_bodies_are_refused(self):
+        for changes in [[], {'id': self.order.pk, 'status': 1}]:
+            with self.subTest(changes=changes):
+                response, _ = self.request(self.delivery_crew, 'PATCH', '/api/orders', changes)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        with override_settings(ORDER_BULK_UPDATE_LIMIT=1):
+            response, _ = self.request(self.delivery_crew, 'PATCH', '/api/orders', [{'id': self.order.pk, 'status': 1}] * 2)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class PurchaseLineItemsTests(LittleLemonTestCase):
+    """
+    Checkout keeps a copy of the purchase-items on the purchase, which later
+    menu changes leave alone, and the backfill command writes it for older
+    purchases.
+    """
+
+    def expected_line_items(self, quantities):
+        return [
+            {'menuitem': menu_item.pk, 'title': menu_item.title, 'quantity': quantity, 'unit_price': '4.50', 'price': str(Decimal('4.50') * quantity)}
+            for menu_item, quantity in zip(self.menu_items, quantities)
+        ]
+
+    def get_line_items(self):
+        response, _ = self.request(self.customer, 'GET', f'/api/purchases/{self.order.purchase_id}?expand=lines')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('purchaseitems', response.data)
+        return response.data['line_items']
+
+    def test_checkout_keeps_the_line_items(self):
+        expected = self.expected_line_items([2, 1])
+        self.assertEqual(self.get_line_items(), expected)
+        with self.captureOnCommitCallbacks(execute=True):
+            response, _ = self.request(self.manager, 'PATCH', f'/api/menu-items/{self.menu_items[0].pk}', {'title': 'Renamed', 'price': '6.00'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.get_line_items(), expected)
+
+        response, _ = self.request(self.customer, 'GET', '/api/purchases?expand=lines')
+        self.assertEqual([purchase['line_items'] for purchase in response.data['results']], [expected])
+
+    def test_older_purchases_are_backfilled(self):
+        Purchase.objects.filter(pk=self.order.purchase_id).update(line_items=None)
+        expected = self.expected_line_items([2, 1])
+        self.assertEqual(self.get_line_items(), expected)
+
+        stdout = StringIO()
+        call_command('backfill_purchase_line_items', batch_size=1, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), '1 purchases backfilled\n')
+        self.assertEqual(Purchase.objects.get(pk=self.order.purchase_id).line_items, expected)
+        with self.assertRaises(CommandError):
+            call_command('backfill_purchase_line_items', batch_size=0)
+
+
+class LineItemMigrationTests(TransactionTestCase):
+    """
+    Migrations 0036 to 0038 move the order-items and purchase-items into the
+    line-items table, keeping every row, cart and purchase, and moving back
+    restores them.
+    """
+    before = ('littlelemon', '0035_purchase_line_items')
+    after = ('littlelemon', '0038_drop_order_items')
+
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([target])
+        return executor.loader.project_state([target]).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def fill_tables(self, apps):
+        Category, MenuItem, User = [apps.get_model(*name) for name in [('littlelemon', 'Category'), ('littlelemon', 'MenuItem'), ('auth', 'User')]]
+        OrderItem, PurchaseItem = apps.get_model('littlelemon', 'OrderItem'), apps.get_model('littlelemon', 'PurchaseItem')
+        Cart, Purchase = apps.get_model('littlelemon', 'Cart'), apps.get_model('littlelemon', 'Purchase')
+        category = Category.objects.create(title='Mains', slug='mains')
+        menu_items = [MenuItem.objects.create(title=f'Dish {number}', price=Decimal('4.50'), featured=False, category=category) for number in range(2)]
+        customer = User.objects.create(username='customer')
+
+        def line(model, menu_item, quantity):
+            return model.objects.create(user=customer, menuitem=menu_item, quantity=quantity, unit_price=menu_item.price, price=menu_item.price * quantity)
+
+        purchase = Purchase.objects.create(user=customer)
+        purchase.purchaseitems.add(*[line(PurchaseItem, menu_item, 3) for menu_item in menu_items])
+        cart = Cart.objects.create(user=customer)
+        cart.orderitems.add(line(OrderItem, menu_items[0], 2))
+        # An order-item never added to the cart is kept as a line item too.
+        line(OrderItem, menu_items[1], 1)
+        return customer, cart, purchase, menu_items
+
+    def test_line_items_are_kept_both_ways(self):
+        apps = self.migrate(self.before)
+        customer, cart, purchase, menu_items = self.fill_tables(apps)
+
+        apps = self.migrate(self.after)
+        LineItem = apps.get_model('littlelemon', 'LineItem')
+        rows = LineItem.objects.filter(user_id=customer.pk).order_by('state', 'menuitem_id', 'id')
+        self.assertEqual(
+            list(rows.values_list('state', 'menuitem_id', 'quantity', 'price', 'purchase_id')),
+            [
+                ('cart', menu_items[0].pk, 2, Decimal('9.00'), None),
+                ('cart', menu_items[1].pk, 1, Decimal('4.50'), None),
+                ('purchased', menu_items[0].pk, 3, Decimal('13.50'), purchase.pk),
+                ('purchased', menu_items[1].pk, 3, Decimal('13.50'), purchase.pk),
+            ],
+        )
+        Cart = apps.get_model('littlelemon', 'Cart')
+        self.assertEqual(list(Cart.objects.get(pk=cart.pk).orderitems.values_list('menuitem_id', 'quantity')), [(menu_items[0].pk, 2)])
+
+        apps = self.migrate(self.before)
+        Cart, Purchase = apps.get_model('littlelemon', 'Cart'), apps.get_model('littlelemon', 'Purchase')
+        OrderItem = apps.get_model('littlelemon', 'OrderItem')
+        self.assertEqual(list(Cart.objects.get(pk=cart.pk).orderitems.values_list('menuitem_id', 'quantity')), [(menu_items[0].pk, 2)])
+        self.assertEqual(OrderItem.objects.filter(user_id=customer.pk).count(), 2)
+        self.assertEqual(
+            sorted(Purchase.objects.get(pk=purchase.pk).purchaseitems.values_list('menuitem_id', 'quantity')),
+            [(menu_items[0].pk, 3), (menu_items[1].pk, 3)],
+        )
+
+
+class CartItemUpsertTests(LittleLemonTestCase):
+    """
+    POST /api/cart/items adds a menu item to the cart, or adds to the
+    quantity of its cart item, with one statement priced from the menu.
+    """
+
+    def add(self, data):
+        return self.request(self.customer, 'POST', '/api/cart/items', data)
+
+    def test_adding_an_item_again_increments_it(self):
+        menu_item = self.menu_items[0]
+        first, _ = self.add({'menuitem_id': menu_item.pk, 'quantity': 2})
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        MenuItem.objects.filter(pk=menu_item.pk).update(price=Decimal('5.00'))
+
+        second, queries = self.add({'menuitem_id': menu_item.pk, 'quantity': 3})
+        self.assertEqual(second.data['id'], first.data['id'])
+        self.assertEqual((second.data['quantity'], second.data['unit_price'], second.data['price']), (5, '5.00', '25.00'))
+        self.assertEqual(len([sql for sql in queries if 'DO UPDATE' in sql]), 1)
+        cart_items = Cart.objects.get(user=self.customer).orderitems.filter(menuitem=menu_item)
+        self.assertEqual(list(cart_items.values_list('pk', 'quantity')), [(first.data['id'], 5)])
+
+        third, _ = self.add({'menuitem_id': menu_item.pk})
+        self.assertEqual(third.data['quantity'], 6)
+
+    def test_bad_items_are_refused(self):
+        response, _ = self.add({'menuitem_id': 999999})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        for data in [[{'menuitem_id': self.menu_items[0].pk}], {'menuitem_id': 'one'}, {'menuitem_id': self.menu_items[0].pk, 'quantity': 0}]:
+            with self.subTest(data=data):
+                response, _ = self.add(data)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(OrderItem.objects.filter(user=self.customer, menuitem=self.menu_items[0]).exists())
+
+
+@skipUnless(connection.vendor == 'postgresql', 'concurrent writers are run on PostgreSQL')
+class CartItemDoubleTapTests(TransactionTestCase):
+    """
+    The same menu item added from two connections at once ends up in one
+    cart item holding both quantities.
+    """
+
+    def test_concurrent_adds_share_the_cart_item(self):
+        category = Category.objects.create(title='Mains', slug='mains')
+        menu_item = MenuItem.objects.create(title='Dish', price=Decimal('4.50'), featured=False, category=category)
+        customer = create_user('customer', 'Customer')
+        Cart.objects.create(user=customer)
+        ready = threading.Barrier(2)
+        errors = []
+
+        def add():
+            try:
+                ready.wait(10)
+                add_cart_item(customer, menu_item.pk, 1)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=add) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        cart_items = Cart.objects.get(user=customer).orderitems.all()
+        self.assertEqual(list(cart_items.values_list('quantity', 'price')), [(2, Decimal('9.00'))])
+
+
+class CartBatchTests(LittleLemonTestCase):
+    """
+    POST /api/cart/items:batch applies a list of additions and removals at
+    once, with the same queries however many items it holds, and answers
+    with the cart and its totals.
+    """
+
+    def change(self, data):
+        return self.request(self.customer, 'POST', '/api/cart/items:batch', data)
+
+    def cart_quantities(self):
+        return dict(Cart.objects.get(user=self.customer).orderitems.values_list('menuitem_id', 'quantity'))
+
+    def test_items_are_added_and_removed_together(self):
+        first, second, third = [menu_item.pk for menu_item in self.menu_items]
+        response, _ = self.change([
+            {'menuitem_id': first, 'quantity': 2},
+            {'menuitem_id': second},
+            {'menuitem_id': second, 'quantity': 2},
+            {'menuitem_id': third, 'quantity': -1},
+        ])
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertEqual((response.data['count'], response.data['quantity'], response.data['total']), (2, 5, '22.50'))
+        self.assertEqual(len(response.data['orderitems']), 2)
+        self.assertEqual(self.cart_quantities(), {first: 2, second: 3})
+        self.assertFalse(OrderItem.objects.filter(user=self.customer, menuitem_id=third).exists())
+
+    def test_queries_do_not_grow_with_the_items(self):
+        _, one_item = self.change([{'menuitem_id': self.menu_items[0].pk}])
+        _, every_item = self.change([{'menuitem_id': menu_item.pk} for menu_item in self.menu_items])
+        self.assertEqual(
+            len([sql for sql in one_item if not is_role_query(sql)]),
+            len([sql for sql in every_item if not is_role_query(sql)]),
+        )
+
+    def test_bad_batches_change_nothing(self):
+        quantities = self.cart_quantities()
+        response, _ = self.change([{'menuitem_id': self.menu_items[0].pk}, {'menuitem_id': 999999}])
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.data['menuitem_ids'], [999999])
+
+        response, _ = self.change([{'menuitem_id': self.menu_items[0].pk}, {'menuitem_id': 'one', 'quantity': 0}])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data[0], {})
+        self.assertEqual(set(response.data[1]), {'menuitem_id', 'quantity'})
+        for data in [[], {'menuitem_id': self.menu_items[0].pk}, [{'menuitem_id': self.menu_items[0].pk}] * 2]:
+            with self.subTest(data=data), override_settings(CART_BATCH_LIMIT=1):
+                response, _ = self.change(data)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.cart_quantities(), quantities)
+
+
+class CartSummaryTests(LittleLemonTestCase):
+    """
+    GET /api/cart?expand=summary holds the lines and totals of the cart, read
+    with the same queries however many items it holds.
+    """
+
+    def get_summary(self, user):
+        response, queries = self.request(user, 'GET', '/api/cart?expand=summary')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data, [sql for sql in queries if not is_role_query(sql)]
+
+    def test_summary_lines_and_totals(self):
+        change_cart_items(self.customer, {self.menu_items[0].pk: 3})
+        summary, queries = self.get_summary(self.customer)
+        self.assertEqual((summary['count'], summary['quantity'], summary['total']), (2, 4, '18.00'))
+        self.assertEqual(
+            [(line['menuitem'], line['title'], line['quantity'], line['price']) for line in summary['lines']],
+            [(self.menu_items[2].pk, 'Dish 2', 1, '4.50'), (self.menu_items[0].pk, 'Dish 0', 3, '13.50')],
+        )
+        self.assertEqual(len(summary['orderitems']), 2)
+        self.assertEqual(len(queries), 2)
+
+        new_customer = create_user('new-customer', 'Customer')
+        summary, _ = self.get_summary(new_customer)
+        self.assertEqual((summary['count'], summary['quantity'], summary['total'], summary['lines']), (0, 0, '0.00', []))
+        add_cart_item(new_customer, self.menu_items[1].pk, 1)
+        summary, one_item_queries = self.get_summary(new_customer)
+        self.assertEqual(summary['count'], 1)
+        self.assertEqual(len(one_item_queries), len(queries))
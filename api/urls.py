@@ -10,9 +10,10 @@ from .views import (
     MenuItemListView, MenuItemDetailView,
     CategoryListView, CategoryDetailView, CategoryMenuItemsView,
     OrderItemListView, OrderItemDetailView,
-    CartView,
-    OrderListView, OrderDetailView,
+    CartView, CartItemsView, CartItemsBatchView,
+    OrderListView, OrderDetailView, CheckoutJobDetailView, DispatchView, OrderChangesView,
     PurchaseListView, PurchaseDetailView,
+    SalesReportView, MenuItemSalesReportView, CategorySalesReportView, CustomerSalesReportView,
 )
 
 LIST = {'get': 'list', 'post': 'create'}
@@ -43,13 +44,23 @@ urlpatterns = [
     path('order-items/<int:pk>', OrderItemDetailView.as_view(), name='orderitem-detail'),
 
     path('cart', CartView.as_view()),
+    path('cart/items', CartItemsView.as_view()),
+    path('cart/items:batch', CartItemsBatchView.as_view()),
 
     path('orders', OrderListView.as_view()),
     path('orders/<int:pk>', OrderDetailView.as_view(), name='order-detail'),
+    path('orders/dispatch', DispatchView.as_view()),
+    path('orders/changes', OrderChangesView.as_view()),
+    path('orders/checkouts/<int:pk>', CheckoutJobDetailView.as_view(), name='checkoutjob-detail'),
 
     path('purchases', PurchaseListView.as_view()),
     path('purchases/<int:pk>', PurchaseDetailView.as_view(), name='purchase-detail'),
 
     path('purchase-items', PurchaseListView.as_view()),
     path('purchase-items/<int:pk>', PurchaseDetailView.as_view(), name='purchaseitem-detail'),
+
+    path('reports/sales', SalesReportView.as_view()),
+    path('reports/menu-items', MenuItemSalesReportView.as_view()),
+    path('reports/categories', CategorySalesReportView.as_view()),
+    path('reports/customers', CustomerSalesReportView.as_view()),
 ]
\ No newline at end of file
@@ -1,4 +1,11 @@
+import operator
+from functools import reduce
+
+from django.conf import settings
 from django.contrib.auth.models import User, Group
+from django.db import DataError, transaction
+from django.db.models import Prefetch, Q, Sum
+from django.http import Http404
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
@@ -10,6 +17,7 @@ from rest_framework.generics import (
     RetrieveUpdateDestroyAPIView,
     DestroyAPIView,
 )
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework import status
 
@@ -21,15 +29,21 @@ from littlelemon.models import (
     Order,
     Purchase,
     PurchaseItem,
+    CheckoutJob,
+    OrderEvent,
+    DailyItemSales,
+    DailyCategorySales,
+    DailyCustomerSales,
 )
 
-from .permission import (
-    IsSystemAdministrotor,
-    IsManager,
-    IsDeliveryCrew,
-    IsCustomer,
-    IsCustomerOrDeliveryCrew,
-)
+from .policy import PolicyMixin, allow, methods_except, ANONYMOUS, SELF
+from .roles import get_user_roles
+from .authentication import RoleClaimsJWTAuthentication
+from .cart import carts
+from .checkout import enqueue_checkout, CheckoutError
+from .pagination import ApproximateCountPagination
+from .dispatch import crew_load, dispatch_stats, dispatch_orders
+from .events import publish_order_event, event_data, settled_before, ORDER_ASSIGNED, ORDER_STATUS, ORDER_DELETED
 
 from .serializers import (
     GroupSerializer,
@@ -37,10 +51,15 @@ from .serializers import (
     MenuItemSerializer,
     CategorySerializer,
     CartSerializer,
+    CartLinesSerializer,
+    CartTotalsSerializer,
+    CartSummarySerializer,
     OrderSerializer,
     OrderItemSerializer,
     PurchaseSerializer,
+    PurchaseLineItemsSerializer,
     PurchaseItemSerializer,
+    CheckoutJobSerializer,
 )
 
 from .mixins import (
@@ -55,23 +74,32 @@ from .mixins import (
     OrderItemHelperMixin,
     PurchaseDetailHelperMixin,
     CommonUtilsMixin,
+    MenuSnapshotMixin,
+    KeysetPaginationMixin,
+    RelationLoadingMixin,
+    LineItemsExpansionMixin,
+    IdempotencyMixin,
+    SalesReportHelperMixin,
 )
 
 
-class UserListView(UserHelperMixin, ListCreateAPIView):
+# Hyperlinked to-many fields only need the ids of the related rows, plus
+# the purchase to match them to theirs.
+PURCHASE_ITEM_IDS = Prefetch('purchaseitems', queryset=PurchaseItem.objects.only('id', 'purchase'))
+
+
+class UserListView(PolicyMixin, UserHelperMixin, ListCreateAPIView):
     model = User
     queryset = model.objects.all()
     serializer_class = UserSerializer
-    permission_classes = [IsManager]
+    pagination_class = ApproximateCountPagination
     ordering_fields = ['username', 'first_name', 'last_name']
     search_fields = ['username', 'first_name', 'last_name']
     filterset_fields = ['username', 'first_name', 'last_name']
-
-    def check_permissions(self, request):
-        self.permission_classes = [IsManager]
-        if request.method == 'POST' and self.user_is_unathentictaed(request):
-            self.permission_classes = []
-        return super().check_permissions(request)
+    policy = [
+        allow(roles=['Manager']),
+        allow(methods=['POST'], roles=[ANONYMOUS]),
+    ]
 
     def get(self, request, *args, **kwargs):
         if not self.user_is_admin(request):
@@ -85,88 +113,107 @@ class UserListView(UserHelperMixin, ListCreateAPIView):
         return Response(serialized_data.data, status=status.HTTP_201_CREATED)
 
 
-class UserDetailView(UserHelperMixin, RetrieveUpdateDestroyAPIView):
+class UserDetailView(PolicyMixin, UserHelperMixin, RetrieveUpdateDestroyAPIView):
     model = User
     queryset = model.objects.all()
     serializer_class = UserSerializer
-    permission_classes = [IsCustomerOrDeliveryCrew]
-
-    def check_permissions(self, request):
-        self.permission_classes = [IsSystemAdministrotor]
+    policy_targets = (SELF, 'SysAdmin', 'Manager', None)
+    policy = [
+        allow(roles=['Customer', 'Delivery Crew'], targets=[SELF]),
+        allow(roles=['SysAdmin'], targets=['SysAdmin', 'Manager', None]),
+        allow(methods=['GET'], roles=['Manager'], targets=['Manager']),
+        allow(roles=['Manager'], targets=[None]),
+    ]
+
+    def get_policy_target(self, request):
         if self.user_is_requested_user(request):
-            self.permission_classes = {IsCustomerOrDeliveryCrew}
-        elif self.user_is_admin(request):
-            pass
-        elif self.requested_user_is_admin(request):
-            pass
-        elif self.user_is_manager(request):
-            if self.requested_user_is_manager(request):
-                if request.method in ['GET']:
-                    self.permission_classes = [IsManager]
-            else:
-                self.permission_classes = [IsManager]
-        return super().check_permissions(request)
+            return SELF
+        if self.requested_user_is_admin(request):
+            return 'SysAdmin'
+        if self.requested_user_is_manager(request):
+            return 'Manager'
+        return None
+
+    def get_object(self):
+        user = self.get_requested_user_object(self.request)
+        if user is None:
+            raise Http404
+        self.check_object_permissions(self.request, user)
+        return user
     
     def get(self, request, *args, **kwargs):
         return super().get(request, *args, **kwargs)
 
 
-class GroupListViewSet(ListCreateAPIView):
+class GroupListViewSet(PolicyMixin, ListCreateAPIView):
     model = Group
     queryset = model.objects.all()
     serializer_class = GroupSerializer
-    permission_classes = [IsManager]
+    policy = [allow(roles=['Manager'])]
 
     def get(self, request, *args, **kwargs):
-        if not request.user.groups.filter(name='SysAdmin'):
+        if 'SysAdmin' not in get_user_roles(request):
             self.queryset = self.queryset.exclude(name='SysAdmin')
         return super().list(request, *args, **kwargs)
 
 
-class GroupDetailView(ModelViewSet):
+class GroupDetailView(PolicyMixin, ModelViewSet):
     model = Group
     queryset = model.objects.all()
     serializer_class = GroupSerializer
-
-    def check_permissions(self, request):
-        pk = request.parser_context['kwargs']['pk']
-        requested_group = Group.objects.get(pk=pk)
-        if request.method in ['GET']:
-            if requested_group.name in ['SysAdmin']:
-                self.permission_classes = [IsSystemAdministrotor]
-            else: self.permission_classes = [IsManager]
-        else:
-            if requested_group.name not in ['SysAdmin', 'Manager']:
-                self.permission_classes = [IsManager]
-            else: self.permission_classes = [IsSystemAdministrotor]
-        return super().check_permissions(request)
+    policy_targets = ('SysAdmin', 'Manager', None)
+    policy = [
+        allow(methods=['GET'], roles=['SysAdmin'], targets=['SysAdmin']),
+        allow(methods=['GET'], roles=['Manager'], targets=['Manager', None]),
+        allow(methods=methods_except('GET'), roles=['SysAdmin'], targets=['SysAdmin', 'Manager']),
+        allow(methods=methods_except('GET'), roles=['Manager'], targets=[None]),
+    ]
+
+    def get_requested_group(self, request):
+        if not hasattr(self, '_requested_group'):
+            pk = request.parser_context['kwargs']['pk']
+            self._requested_group = Group.objects.filter(pk=pk).first()
+        return self._requested_group
+
+    def get_policy_target(self, request):
+        group = self.get_requested_group(request)
+        if group is not None and group.name in ['SysAdmin', 'Manager']:
+            return group.name
+        return None
+
+    def get_object(self):
+        group = self.get_requested_group(self.request)
+        if group is None:
+            raise Http404
+        self.check_object_permissions(self.request, group)
+        return group
     
     def get(self, request, *args, **kwargs):
-        group = Group.objects.get(pk=kwargs['pk'])
+        group = self.get_object()
         serialized_data = self.serializer_class(group)
         return Response(serialized_data.data, status=status.HTTP_200_OK)
 
 
-class SysAdminListView(GroupListHelperMixin, ListAPIView):
+class SysAdminListView(PolicyMixin, GroupListHelperMixin, ListAPIView):
     model = User
     queryset = model.objects.filter(groups__name='SysAdmin')
     serializer_class = UserSerializer
-    permission_classes = [IsSystemAdministrotor]
+    policy = [allow(roles=['SysAdmin'])]
     group_name = 'SysAdmin'
     ordering_fields = ['username', 'first_name', 'last_name']
     search_fields = ['username', 'first_name', 'last_name']
     filterset_fields = ['username', 'first_name', 'last_name']
 
 
-class SysAdminDetailViewSet(GroupDetailHelperMixin, RetrieveUpdateAPIView):
+class SysAdminDetailViewSet(PolicyMixin, GroupDetailHelperMixin, RetrieveUpdateAPIView):
     model = User
     queryset = model.objects.filter(groups__name='SysAdmin')
     serializer_class = UserSerializer
-    permission_classes = [IsSystemAdministrotor]
+    policy = [allow(roles=['SysAdmin'])]
     group_name = 'SysAdmin'
 
 
-class ManagerListView(GroupListHelperMixin, ListAPIView):
+class ManagerListView(PolicyMixin, GroupListHelperMixin, ListAPIView):
     model = User
     queryset = User.objects.filter(groups__name='Manager').exclude(groups__name='SysAdmin')
     serializer_class = UserSerializer
@@ -174,131 +221,123 @@ class ManagerListView(GroupListHelperMixin, ListAPIView):
     ordering_fields = ['username', 'first_name', 'last_name']
     search_fields = ['username', 'first_name', 'last_name']
     filterset_fields = ['username', 'first_name', 'last_name']
+    policy = [
+        allow(methods=['GET', 'POST'], roles=['Manager']),
+        allow(methods=methods_except('GET', 'POST'), roles=['SysAdmin']),
+    ]
 
-    def check_permissions(self, request):
-        if request.method in ['POST', 'GET']:
-            self.permission_classes = [IsManager]
-        else:
-            self.permission_classes = [IsSystemAdministrotor]
-        return super().check_permissions(request)
 
-
-class ManagerDetailView(UserHelperMixin, GroupDetailHelperMixin, RetrieveUpdateAPIView):
+class ManagerDetailView(PolicyMixin, UserHelperMixin, GroupDetailHelperMixin, RetrieveUpdateAPIView):
     model = User
     queryset = User.objects.filter(groups__name='Manager').exclude(groups__name='SysAdmin')
     serializer_class = UserSerializer
     group_name = 'Manager'
-
-    def check_permissions(self, request):
+    policy_targets = (SELF, None)
+    policy = [
+        allow(roles=['Manager'], targets=[SELF]),
+        allow(methods=['GET'], roles=['Manager'], targets=[None]),
+        allow(methods=methods_except('GET'), roles=['SysAdmin'], targets=[None]),
+    ]
+
+    def get_policy_target(self, request):
         if self.user_is_requested_user(request):
-            self.permission_classes = [IsManager]
-        elif request.method in ['GET']:
-            self.permission_classes = [IsManager]
-        else: self.permission_classes = [IsSystemAdministrotor]
-        return super().check_permissions(request)
+            return SELF
+        return None
 
 
-class DeliveryCrewListView(GroupListHelperMixin, ListAPIView):
+class DeliveryCrewListView(PolicyMixin, GroupListHelperMixin, ListAPIView):
     model = User
     queryset = User.objects.filter(groups__name='Delivery Crew').exclude(groups__name='SysAdmin').exclude(groups__name='Manager')
     serializer_class = UserSerializer
-    permission_classes = [IsManager]
+    policy = [allow(roles=['Manager'])]
     group_name = 'Delivery Crew'
     ordering_fields = ['username', 'first_name', 'last_name']
     search_fields = ['username', 'first_name', 'last_name']
     filterset_fields = ['username', 'first_name', 'last_name']
     
 
-class DeliveryCrewDetailView(GroupDetailHelperMixin, RetrieveUpdateAPIView):
+class DeliveryCrewDetailView(PolicyMixin, GroupDetailHelperMixin, RetrieveUpdateAPIView):
     model = User
     queryset = User.objects.filter(groups__name='Delivery Crew').exclude(groups__name='SysAdmin').exclude(groups__name='Manager')
     serializer_class = UserSerializer
-    permission_classes = [IsManager]
+    policy = [allow(roles=['Manager'])]
     group_name = 'Delivery Crew'
 
 
-class CustomerListView(GroupListHelperMixin, ListAPIView):
+class CustomerListView(PolicyMixin, GroupListHelperMixin, ListAPIView):
     model = User
     queryset = User.objects.filter(groups__name='Customer').exclude(groups__name='SysAdmin').exclude(groups__name='Manager')
     serializer_class = UserSerializer
-    permission_classes = [IsManager]
+    policy = [allow(roles=['Manager'])]
     group_name = 'Customer'
     ordering_fields = ['username', 'first_name', 'last_name']
     search_fields = ['username', 'first_name', 'last_name']
     filterset_fields = ['username', 'first_name', 'last_name']
 
 
-class CustomerDetailView(GroupDetailHelperMixin, RetrieveUpdateAPIView):
+class CustomerDetailView(PolicyMixin, GroupDetailHelperMixin, RetrieveUpdateAPIView):
     model = User
     queryset = User.objects.filter(groups__name='Customer').exclude(groups__name='SysAdmin').exclude(groups__name='Manager')
     serializer_class = UserSerializer
-    permission_classes = [IsManager]
+    policy = [allow(roles=['Manager'])]
     group_name = 'Customer'
 
 
-class CategoryListView(ModelViewSet):
+class CategoryListView(PolicyMixin, MenuSnapshotMixin, ModelViewSet):
     model = Category
     queryset = model.objects.all()
     serializer_class = CategorySerializer
+    authentication_classes = [RoleClaimsJWTAuthentication]
     ordering_fields = ['title', 'slug']
     search_fields = ['title', 'slug']
     filterset_fields = ['title', 'slug']
+    policy = [
+        allow(methods=['GET'], roles=['Customer', 'Delivery Crew']),
+        allow(methods=methods_except('GET'), roles=['Manager']),
+    ]
 
-    def check_permissions(self, request):
-        if request.method in ['GET']:
-            self.permission_classes = [IsCustomerOrDeliveryCrew]
-        else:
-            self.permission_classes = [IsManager]
-        return super().check_permissions(request)
 
-
-class CategoryDetailView(ModelViewSet):
+class CategoryDetailView(PolicyMixin, MenuSnapshotMixin, ModelViewSet):
     model = Category
     queryset = model.objects.all()
     serializer_class = CategorySerializer
-
-    def check_permissions(self, request):
-        if request.method in ['GET']:
-            self.permission_classes = [IsCustomerOrDeliveryCrew]
-        else:
-            self.permission_classes = [IsManager]
-        return super().check_permissions(request)
+    authentication_classes = [RoleClaimsJWTAuthentication]
+    policy = [
+        allow(methods=['GET'], roles=['Customer', 'Delivery Crew']),
+        allow(methods=methods_except('GET'), roles=['Manager']),
+    ]
 
 
-class CategoryMenuItemsView(ListAPIView):
+class CategoryMenuItemsView(PolicyMixin, MenuSnapshotMixin, ListAPIView):
     model = MenuItem
     queryset = model.objects.all()
     serializer_class = MenuItemSerializer
+    authentication_classes = [RoleClaimsJWTAuthentication]
     ordering_fields = ['title', 'price', 'featured']
     search_fields = ['title', 'price', 'featured']
     filterset_fields = ['title', 'price', 'featured']
-
-    def check_permissions(self, request):
-        if request.method in ['GET']:
-            self.permission_classes = [IsCustomerOrDeliveryCrew]
-        else:
-            self.permission_classes = [IsManager]
-        return super().check_permissions(request)
+    policy = [
+        allow(methods=['GET'], roles=['Customer', 'Delivery Crew']),
+        allow(methods=methods_except('GET'), roles=['Manager']),
+    ]
     
     def get(self, request, *args, **kwargs):
         self.queryset = self.queryset.filter(category__pk=kwargs['pk'])
         return super().get(request, *args, **kwargs)
     
 
-class MenuItemListView(ModelViewSet):
+class MenuItemListView(PolicyMixin, MenuSnapshotMixin, ModelViewSet):
     model = MenuItem
     queryset = model.objects.all()
     serializer_class = MenuItemSerializer
+    authentication_classes = [RoleClaimsJWTAuthentication]
     ordering_fields = ['title', 'price', 'featured']
     search_fields = ['title', 'price', 'featured']
     filterset_fields = ['title', 'price', 'featured']
-
-    def check_permissions(self, request):
-        if request.method in ['GET']:
-            self.permission_classes = [IsCustomerOrDeliveryCrew]
-        else:
-            self.permission_classes = [IsManager]
-        return super().check_permissions(request)
+    policy = [
+        allow(methods=['GET'], roles=['Customer', 'Delivery Crew']),
+        allow(methods=methods_except('GET'), roles=['Manager']),
+    ]
     
     def get_queryset(self):
         query_param_value = self.request.query_params.get('category')
@@ -311,37 +350,43 @@ class MenuItemListView(ModelViewSet):
         return super().get_queryset()
 
 
-class MenuItemDetailView(ModelViewSet):
+class MenuItemDetailView(PolicyMixin, MenuSnapshotMixin, ModelViewSet):
     model = MenuItem
     queryset = model.objects.all()
     serializer_class = MenuItemSerializer
-
-    def check_permissions(self, request):
-        if request.method in ['GET']:
-            self.permission_classes = [IsCustomerOrDeliveryCrew]
-        else:
-            self.permission_classes = [IsManager]
-        return super().check_permissions(request)
+    authentication_classes = [RoleClaimsJWTAuthentication]
+    policy = [
+        allow(methods=['GET'], roles=['Customer', 'Delivery Crew']),
+        allow(methods=methods_except('GET'), roles=['Manager']),
+    ]
 
 
-class CartView(CartViewHelperMixin, APIView):
+class CartView(PolicyMixin, IdempotencyMixin, CartViewHelperMixin, APIView):
     model = Cart
     queryset = model.objects.all()
     serializer_class = CartSerializer
-    permission_classes = [IsCustomer]
+    policy = [allow(roles=['Customer'])]
     related_model = OrderItem
 
     def get(self, request, *args, **kwargs):
         user = request.user
-        if not user.groups.filter(name='Customer') and len(user.groups) == 1:
+        roles = get_user_roles(request)
+        if 'Customer' not in roles and len(roles) == 1:
             return Response({'message': 'Only Customers are allowed to own a Cart'}, status=status.HTTP_400_BAD_REQUEST)
-        cart_object = self.get_or_create_cart_object(user)
-        return self.object_serialized_response(request, cart_object) 
+        # Served by the cart backend, which may hold changes not written yet.
+        cart_object = carts.summarize(user)
+        serializer_class = CartSummarySerializer if self.wants_summary(request) else CartLinesSerializer
+        return Response(serializer_class(cart_object, context={'request': request}).data)
 
     def post(self, request, *args, **kwargs):
+        return self.idempotent_response(request, self.add_to_cart, *args, **kwargs)
+
+    def add_to_cart(self, request, *args, **kwargs):
         user = request.user
-        if not user.groups.filter(name='Customer') and len(user.groups) == 1:
+        roles = get_user_roles(request)
+        if 'Customer' not in roles and len(roles) == 1:
             return Response({'message': 'Only Customers are allowed to own a Cart'}, status=status.HTTP_400_BAD_REQUEST)
+        carts.flush(user)
         try:
             order_item = OrderItem.objects.filter(user=user).get(pk=request.data.get('id'))
             self.add_order_item_to_cart(order_item, user)
@@ -351,8 +396,10 @@ class CartView(CartViewHelperMixin, APIView):
 
     def delete(self, request, *args, **kwargs):
         user = request.user
-        if not user.groups.filter(name='Customer') and len(user.groups) == 1:
+        roles = get_user_roles(request)
+        if 'Customer' not in roles and len(roles) == 1:
             return Response({'message': 'Only Customers are allowed to own a Cart'}, status=status.HTTP_400_BAD_REQUEST)
+        carts.flush(user)
         try:
             order_item_id = request.data.get('id')
             if order_item_id is None:
@@ -368,24 +415,72 @@ class CartView(CartViewHelperMixin, APIView):
             return Response({'message': 'object does not exist'}, status=status.HTTP_404_NOT_FOUND)
 
 
-class OrderItemListView(OrderItemHelperMixin, ListCreateAPIView):
+class CartItemsView(PolicyMixin, IdempotencyMixin, CartViewHelperMixin, APIView):
+    model = Cart
+    serializer_class = OrderItemSerializer
+    policy = [allow(methods=['POST'], roles=['Customer'])]
+
+    def post(self, request, *args, **kwargs):
+        return self.idempotent_response(request, self.add_item, *args, **kwargs)
+
+    def add_item(self, request, *args, **kwargs):
+        roles = get_user_roles(request)
+        if 'Customer' not in roles and len(roles) == 1:
+            return Response({'message': 'Only Customers are allowed to own a Cart'}, status=status.HTTP_400_BAD_REQUEST)
+        menuitem_id, quantity = self.parse_cart_item(request.data)
+        try:
+            order_item = carts.add_item(request.user, menuitem_id, quantity)
+        except DataError:
+            return Response({'quantity': 'the item quantity is out of range'}, status=status.HTTP_400_BAD_REQUEST)
+        if order_item is None:
+            return Response({'message': 'object not found'}, status=status.HTTP_404_NOT_FOUND)
+        return self.object_serialized_response(request, order_item)
+
+
+class CartItemsBatchView(PolicyMixin, IdempotencyMixin, CartViewHelperMixin, APIView):
+    model = Cart
+    serializer_class = CartTotalsSerializer
+    policy = [allow(methods=['POST'], roles=['Customer'])]
+
+    def post(self, request, *args, **kwargs):
+        return self.idempotent_response(request, self.change_items, *args, **kwargs)
+
+    def change_items(self, request, *args, **kwargs):
+        roles = get_user_roles(request)
+        if 'Customer' not in roles and len(roles) == 1:
+            return Response({'message': 'Only Customers are allowed to own a Cart'}, status=status.HTTP_400_BAD_REQUEST)
+        quantities = self.parse_cart_items(request.data)
+        try:
+            cart_object, missing = carts.change_items(request.user, quantities)
+        except DataError:
+            return Response({'quantity': 'an item quantity is out of range'}, status=status.HTTP_400_BAD_REQUEST)
+        if missing:
+            return Response({'message': 'object not found', 'menuitem_ids': missing}, status=status.HTTP_404_NOT_FOUND)
+        return self.object_serialized_response(request, cart_object)
+
+
+class OrderItemListView(PolicyMixin, KeysetPaginationMixin, OrderItemHelperMixin, ListCreateAPIView):
     model = OrderItem
     related_model = MenuItem
     queryset = model.objects.all()
     serializer_class = OrderItemSerializer
-    permission_classes = [IsCustomer]
+    policy = [allow(roles=['Customer'])]
     ordering_fields = ['user', 'menuitem']
     search_fields = ['user', 'menuitem']
     filterset_fields = ['user', 'menuitem']
 
     def get(self, request, *args, **kwargs):
         user = request.user
-        if not user.groups.filter(name='Manager'):
-            self.queryset = self.queryset.filter(user=user)
+        self.exclude_unwritten_removals(None if 'Manager' in get_user_roles(request) else user)
         return super().get(request, *args, **kwargs)
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        return page if page is None else self.show_unwritten_quantities(page)
     
     def post(self, request, **kwargs):
         user = request.user
+        carts.flush(user)
         data = self.data_dict_constructor(request, user, **kwargs)
         if data is None:
             return Response({'message': 'object not found'}, status=status.HTTP_404_NOT_FOUND)
@@ -393,28 +488,30 @@ class OrderItemListView(OrderItemHelperMixin, ListCreateAPIView):
         return Response(status=status.HTTP_201_CREATED)
  
 
-class OrderItemDetailView(OrderItemHelperMixin, APIView):
+class OrderItemDetailView(PolicyMixin, OrderItemHelperMixin, APIView):
     model = OrderItem
     queryset = model.objects.all()
     serializer_class = OrderItemSerializer
-    permission_classes = [IsCustomer]
+    policy = [allow(roles=['Customer'])]
 
     def get(self, request, *args, **kwargs):
         try:
             user = request.user
-            if not user.groups.filter(name='Manager'):
-                self.queryset = self.queryset.filter(user=user)
+            self.exclude_unwritten_removals(None if 'Manager' in get_user_roles(request) else user)
             order_item_obj = self.queryset.get(pk=kwargs['pk'])
-            serialized_object = self.serializer_class(order_item_obj)
-            return Response(serialized_object.data, status=status.HTTP_200_OK)
+            self.show_unwritten_quantities([order_item_obj])
+            return self.object_serialized_response(request, order_item_obj)
         except self.model.DoesNotExist:
             return Response({'message': 'object not found'}, status=status.HTTP_404_NOT_FOUND)
 
     def patch(self, request, *args, **kwargs):
         try:
             user = request.user
-            if not user.groups.filter(name='Manager'):
+            if 'Manager' not in get_user_roles(request):
                 self.queryset = self.queryset.filter(user=user)
+                carts.flush(user)
+            else:
+                carts.flush()
             if request.data.get('quantity') is not None:
                 order_item_obj = self.queryset.get(pk=kwargs['pk'])
                 order_item_obj.quantity = int(request.data.get('quantity'))
@@ -430,8 +527,11 @@ class OrderItemDetailView(OrderItemHelperMixin, APIView):
     def delete(self, request, *args, **kwargs):
         try:
             user = request.user
-            if not user.groups.filter(name='Manager'):
+            if 'Manager' not in get_user_roles(request):
                 self.queryset = self.queryset.filter(user=user)
+                carts.flush(user)
+            else:
+                carts.flush()
             order_item_obj = self.queryset.get(pk=kwargs['pk'])
             order_item_obj.delete()
             return Response({}, status=status.HTTP_200_OK)
@@ -439,22 +539,21 @@ class OrderItemDetailView(OrderItemHelperMixin, APIView):
             return Response({'message': 'object not found'})
 
 
-class OrderListView(UserHelperMixin, OrderListHelperMixin, ListCreateAPIView):
+class OrderListView(PolicyMixin, IdempotencyMixin, KeysetPaginationMixin, UserHelperMixin, OrderListHelperMixin, ListCreateAPIView):
     model = Order
     queryset = model.objects.all()
     serializer_class = OrderSerializer
+    pagination_class = ApproximateCountPagination
+    keyset_ordering = ('-date', '-id')
     ordering_fields = ['user', 'delivery_crew', 'status', 'date']
     search_fields = ['user', 'delivery_crew', 'status', 'date']
     filterset_fields = ['user', 'delivery_crew', 'status', 'date']
-
-    def check_permissions(self, request):
-        if request.method in ['GET']:
-            self.permission_classes = [IsCustomerOrDeliveryCrew]
-        elif request.method in ['POST']:
-            self.permission_classes = [IsCustomer]
-        else:
-            self.permission_classes = [IsManager]
-        return super().check_permissions(request)
+    policy = [
+        allow(methods=['GET'], roles=['Customer', 'Delivery Crew']),
+        allow(methods=['POST'], roles=['Customer']),
+        allow(methods=['PATCH'], roles=['Delivery Crew']),
+        allow(methods=methods_except('GET', 'POST'), roles=['Manager']),
+    ]
 
     def get(self, request, *args, **kwargs):
         if self.user_is_admin(request): pass
@@ -465,48 +564,166 @@ class OrderListView(UserHelperMixin, OrderListHelperMixin, ListCreateAPIView):
             self.queryset = self.queryset.filter(user=request.user)
         return super().get(request, *args, **kwargs)
     
-    def post(self, request):
+    def post(self, request, *args, **kwargs):
+        return self.idempotent_response(request, self.place_order, *args, **kwargs)
+
+    def place_order(self, request, *args, **kwargs):
         user = request.user
+        carts.flush(user)
         user_cart = self.get_user_cart(user=user)
         if user_cart is None:
             return Response({'message': 'the user does not have a cart'}, status=status.HTTP_404_NOT_FOUND)
-        purchase_record = self.create_purchase_record(user, user_cart)
-        self.create_order_object(user, purchase_record)
-        user_cart.orderitems.clear()
-        self.delete_user_order_items(user)
-        user_cart.save()
-        
+        if self.wants_async_checkout(request):
+            if self.user_cart_is_empty(user_cart):
+                return Response({'message': 'the cart is empty'}, status=status.HTTP_400_BAD_REQUEST)
+            checkout_job = enqueue_checkout(user)
+            serialized_job = CheckoutJobSerializer(checkout_job, context={'request': request})
+            return Response(serialized_job.data, status=status.HTTP_202_ACCEPTED, headers={
+                'Location': serialized_job.data['url'],
+                'Preference-Applied': 'respond-async',
+            })
+        try:
+            self.checkout(user, user_cart)
+        except CheckoutError as error:
+            return Response({'message': str(error)}, status=status.HTTP_400_BAD_REQUEST)
         return Response(status=status.HTTP_201_CREATED)
 
+    def patch(self, request, *args, **kwargs):
+        changes = request.data
+        if not isinstance(changes, list) or not changes:
+            return Response({'message': 'requires a list of {id, status, delivery_crew_id} changes'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(changes) > settings.ORDER_BULK_UPDATE_LIMIT:
+            return Response({'message': f'at most {settings.ORDER_BULK_UPDATE_LIMIT} changes are allowed per request'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(self.bulk_update_orders(request, changes), status=status.HTTP_200_OK)
+
+
+class CheckoutJobDetailView(PolicyMixin, RetrieveAPIView):
+    model = CheckoutJob
+    queryset = model.objects.only('id', 'user_id', 'status', 'order_id', 'error', 'created', 'updated')
+    serializer_class = CheckoutJobSerializer
+    policy = [allow(methods=['GET'], roles=['Customer', 'Manager'])]
+
+    def get_queryset(self):
+        if 'Manager' in get_user_roles(self.request):
+            return self.queryset
+        return self.queryset.filter(user=self.request.user)
+
 
-class OrderDetailView(UserHelperMixin, CommonUtilsMixin, RetrieveUpdateDestroyAPIView):
+class DispatchView(PolicyMixin, APIView):
+    policy = [allow(methods=['GET', 'POST'], roles=['Manager'])]
+
+    def get(self, request, *args, **kwargs):
+        return Response({
+            'crew_load': crew_load.snapshot(),
+            'latency': dispatch_stats.report(),
+        }, status=status.HTTP_200_OK)
+
+    def post(self, request, *args, **kwargs):
+        order_ids = request.data.get('orders')
+        try:
+            if order_ids is not None:
+                if not isinstance(order_ids, list): raise ValueError
+                order_ids = [int(order_id) for order_id in order_ids]
+            limit = request.data.get('limit')
+            limit = None if limit is None else int(limit)
+            if limit is not None and limit < 1: raise ValueError
+        except (TypeError, ValueError):
+            return Response({'orders': 'requires a list of order ids', 'limit': 'requires a positive integer'}, status=status.HTTP_400_BAD_REQUEST)
+        assignments = dispatch_orders(order_ids, limit)
+        return Response({
+            'assigned': [{'order': order_id, 'delivery_crew': crew_id} for order_id, crew_id in assignments.items()],
+            'latency': dispatch_stats.report(),
+        }, status=status.HTTP_200_OK)
+
+
+class OrderChangesView(PolicyMixin, APIView):
+    policy = [allow(methods=['GET'], roles=['Customer', 'Delivery Crew', 'Manager'])]
+
+    def get(self, request, *args, **kwargs):
+        try:
+            since = int(request.query_params.get('since', 0))
+            if since < 0: raise ValueError
+        except ValueError:
+            return Response({'since': 'requires a valid integer'}, status=status.HTTP_400_BAD_REQUEST)
+        order_events = OrderEvent.objects.filter(id__gt=since).order_by('id')
+        roles = get_user_roles(request)
+        if 'Manager' not in roles:
+            scopes = []
+            if 'Customer' in roles:
+                scopes.append(Q(user_id=request.user.pk))
+            if 'Delivery Crew' in roles:
+                scopes.append(Q(delivery_crew_id=request.user.pk))
+            order_events = order_events.filter(reduce(operator.or_, scopes))
+
+        page_size = settings.ORDER_EVENTS_PAGE_SIZE
+        order_events = list(order_events[:page_size + 1])
+        has_more = len(order_events) > page_size
+        order_events = order_events[:page_size]
+        # The cursor stops before the first event that may still be followed
+        # by a lower id, so that event is served again on the next call.
+        settled = settled_before()
+        cursor = since
+        for order_event in order_events:
+            if order_event.created >= settled:
+                has_more = False
+                break
+            cursor = order_event.pk
+        return Response({
+            'since': cursor,
+            'has_more': has_more,
+            'events': [event_data(order_event) for order_event in order_events],
+        }, status=status.HTTP_200_OK)
+
+
+class OrderDetailView(PolicyMixin, UserHelperMixin, CommonUtilsMixin, RetrieveUpdateDestroyAPIView):
     model = Order
     queryset = model.objects.all()
     serializer_class = OrderSerializer
-
-    def check_permissions(self, request):
-        if request.method in ['GET']:
-            self.permission_classes = [IsCustomerOrDeliveryCrew]
-        elif request.method in ['PATCH']:
-            self.permission_classes = [IsDeliveryCrew]
-            if request.data.get('delivery_crew_id'):
-                self.permission_classes = [IsManager]
-        else:
-            self.permission_classes = [IsManager]
-        return super().check_permissions(request)
+    policy_targets = ('assignment', None)
+    policy = [
+        allow(methods=['GET'], roles=['Customer', 'Delivery Crew']),
+        allow(methods=['PATCH'], roles=['Delivery Crew'], targets=[None]),
+        allow(methods=['PATCH'], roles=['Manager'], targets=['assignment']),
+        allow(methods=methods_except('GET', 'PATCH'), roles=['Manager']),
+    ]
+
+    def get_policy_target(self, request):
+        if request.method in ['PATCH'] and request.data.get('delivery_crew_id'):
+            return 'assignment'
+        return None
     
     def get(self, request, *args, **kwargs):
         user = request.user
-        if user.groups.filter(name='Manager'):
+        roles = get_user_roles(request)
+        if 'Manager' in roles:
             pass #self.queryset = self.queryset
-        elif user.groups.filter(name='Customer'):
+        elif 'Customer' in roles:
             self.queryset = self.queryset.filter(user=user)
-        elif user.groups.filter(name='Delivery Crew'):
+        elif 'Delivery Crew' in roles:
             self.queryset = self.queryset.filter(delivery_crew=user)
         return super().get(request, *args, **kwargs)
 
+    @transaction.atomic
+    def perform_update(self, serializer):
+        order_object = serializer.instance
+        old_status, old_delivery_crew_id = order_object.status, order_object.delivery_crew_id
+        delivery_crew = serializer.validated_data.get('delivery_crew')
+        if delivery_crew is not None and delivery_crew.pk != old_delivery_crew_id:
+            if not self.delivery_crew_members([delivery_crew.pk]):
+                raise ValidationError({'delivery_crew': self.not_delivery_crew_message})
+        serializer.save()
+        if order_object.status != old_status:
+            publish_order_event(ORDER_STATUS, order_object)
+        if order_object.delivery_crew_id != old_delivery_crew_id:
+            publish_order_event(ORDER_ASSIGNED, order_object)
+
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        publish_order_event(ORDER_DELETED, instance)
+        instance.delete()
+
     def patch(self, request, *args, **kwargs):
-        status = request.data.get('status')
+        order_status = request.data.get('status')
         delivery_crew_id = request.data.get('delivery_crew_id')
         try:
             if self.user_is_admin(request): pass
@@ -514,25 +731,40 @@ class OrderDetailView(UserHelperMixin, CommonUtilsMixin, RetrieveUpdateDestroyAP
             elif self.user_is_delivery_crew(request):
                 self.queryset = self.queryset.filter(delivery_crew=request.user)
             order_object = self.queryset.get(pk=kwargs['pk'])
-            if status is not None:
-                if int(status) < 0 or int(status) > 1: raise ValueError
-                order_object.status = int(status)
-                order_object.save()
+            update_fields = []
+            if order_status is not None:
+                if int(order_status) < 0 or int(order_status) > 1: raise ValueError
+                order_object.status = int(order_status)
+                update_fields.append('status')
             if delivery_crew_id is not None:
-                order_object.delivery_crew = User.objects.get(pk=delivery_crew_id)
-                order_object.save()
+                delivery_crew_id = int(delivery_crew_id)
+                if not self.delivery_crew_members([delivery_crew_id]):
+                    return Response({'delivery_crew_id': self.not_delivery_crew_message}, status=status.HTTP_400_BAD_REQUEST)
+                order_object.delivery_crew_id = delivery_crew_id
+                update_fields.append('delivery_crew')
+            with transaction.atomic():
+                if update_fields:
+                    order_object.save(update_fields=update_fields)
+                if order_status is not None:
+                    publish_order_event(ORDER_STATUS, order_object)
+                if delivery_crew_id is not None:
+                    publish_order_event(ORDER_ASSIGNED, order_object)
             return self.object_serialized_response(request, order_object)
-        except Purchase.DoesNotExist:
-            return Response({'message': 'object not found'}, status=status.HTTP_404_BAD_REQUEST)
+        except Order.DoesNotExist:
+            return Response({'message': 'object not found'}, status=status.HTTP_404_NOT_FOUND)
         except ValueError:
             return Response({'status': 'requires a valid integer (0 or 1)', 'id': 'requires a valid inetger'}, status=status.HTTP_400_BAD_REQUEST)
 
 
-class PurchaseListView(ListAPIView):
+class PurchaseListView(PolicyMixin, KeysetPaginationMixin, LineItemsExpansionMixin, RelationLoadingMixin, ListAPIView):
     model = Purchase
     queryset = model.objects.all()
     serializer_class = PurchaseSerializer
-    permission_classes = [IsCustomer]
+    line_items_serializer_class = PurchaseLineItemsSerializer
+    prefetch_related_fields = [PURCHASE_ITEM_IDS]
+    pagination_class = ApproximateCountPagination
+    keyset_ordering = ('-date', '-id')
+    policy = [allow(roles=['Customer'])]
     ordering_fields = ['user', 'date']
     search_fields = ['user', 'date']
     filterset_fields = ['user', 'date']
@@ -543,29 +775,28 @@ class PurchaseListView(ListAPIView):
         return super().get(request, *args, **kwargs)
 
 
-class PurchaseDetailView(PurchaseDetailHelperMixin, RetrieveAPIView, DestroyAPIView):
+class PurchaseDetailView(PolicyMixin, PurchaseDetailHelperMixin, LineItemsExpansionMixin, RelationLoadingMixin, RetrieveAPIView, DestroyAPIView):
     model = Purchase
     queryset = model.objects.all()
     serializer_class = PurchaseSerializer
-
-    def check_permissions(self, request):
-        if request.method in ['GET']:
-            self.permission_classes = [IsCustomer]
-        else:
-            self.permission_classes = [IsManager]
-        return super().check_permissions(request)
+    line_items_serializer_class = PurchaseLineItemsSerializer
+    prefetch_related_fields = [PURCHASE_ITEM_IDS]
+    policy = [
+        allow(methods=['GET'], roles=['Customer']),
+        allow(methods=methods_except('GET'), roles=['Manager']),
+    ]
     
     def get(self, request, *args, **kwargs):
         user = request.user
         self.queryset = self.queryset.filter(user=user)
-        return super().get(*args, **kwargs)
+        return super().get(request, *args, **kwargs)
 
 
-class PurchaseItemListView(ListAPIView):
+class PurchaseItemListView(PolicyMixin, KeysetPaginationMixin, ListAPIView):
     model = PurchaseItem
     queryset = model.objects.all()
     serializer_class = PurchaseItemSerializer
-    permission_classes = [IsCustomer]
+    policy = [allow(roles=['Customer'])]
     ordering_fields = ['user', 'menuitem', 'price']
     search_fields = ['user', 'menuitem', 'price']
     filterset_fields = ['user', 'menuitem', 'price']
@@ -576,20 +807,87 @@ class PurchaseItemListView(ListAPIView):
         return super().get(request, *args, **kwargs)
 
 
-class PurchaseItemDetailView(RetrieveUpdateDestroyAPIView):
+class PurchaseItemDetailView(PolicyMixin, RetrieveUpdateDestroyAPIView):
     model = PurchaseItem
     queryset = model.objects.all()
     serializer_class = PurchaseItemSerializer
-    permission_classes = [IsCustomer]
-
-    def check_permissions(self, request):
-        if request.method in ['GET']:
-            self.permission_classes = [IsCustomer]
-        else:
-            self.permission_classes = [IsManager]
-        return super().check_permissions(request)
+    policy = [
+        allow(methods=['GET'], roles=['Customer']),
+        allow(methods=methods_except('GET'), roles=['Manager']),
+    ]
 
     def get(self, request, *args, **kwargs):
         user = request.user
         self.queryset = self.queryset.filter(user=user)
-        return super().get(*args, **kwargs)
\ No newline at end of file
+        return super().get(request, *args, **kwargs)
+
+
+class SalesReportView(PolicyMixin, SalesReportHelperMixin, APIView):
+    policy = [allow(methods=['GET'], roles=['Manager'])]
+
+    def get(self, request, *args, **kwargs):
+        date_from, date_to = self.get_report_period(request)
+        rows = (
+            DailyCustomerSales.objects
+            .filter(day__range=(date_from, date_to))
+            .values('day')
+            .annotate(orders=Sum('orders'), units=Sum('units'), revenue=Sum('revenue'))
+            .order_by('day')
+        )
+        return Response(list(rows), status=status.HTTP_200_OK)
+
+
+class MenuItemSalesReportView(PolicyMixin, SalesReportHelperMixin, APIView):
+    policy = [allow(methods=['GET'], roles=['Manager'])]
+
+    def get(self, request, *args, **kwargs):
+        date_from, date_to = self.get_report_period(request)
+        limit = self.get_report_limit(request)
+        rows = (
+            DailyItemSales.objects
+            .filter(day__range=(date_from, date_to))
+            .values('menuitem', 'menuitem__title')
+            .annotate(units=Sum('units'), revenue=Sum('revenue'))
+            .order_by('-units', 'menuitem')[:limit]
+        )
+        return Response([
+            {'menuitem': row['menuitem'], 'title': row['menuitem__title'], 'units': row['units'], 'revenue': row['revenue']}
+            for row in rows
+        ], status=status.HTTP_200_OK)
+
+
+class CategorySalesReportView(PolicyMixin, SalesReportHelperMixin, APIView):
+    policy = [allow(methods=['GET'], roles=['Manager'])]
+
+    def get(self, request, *args, **kwargs):
+        date_from, date_to = self.get_report_period(request)
+        rows = (
+            DailyCategorySales.objects
+            .filter(day__range=(date_from, date_to))
+            .values('category', 'category__title')
+            .annotate(units=Sum('units'), revenue=Sum('revenue'))
+            .order_by('-revenue', 'category')
+        )
+        return Response([
+            {'category': row['category'], 'title': row['category__title'], 'units': row['units'], 'revenue': row['revenue']}
+            for row in rows
+        ], status=status.HTTP_200_OK)
+
+
+class CustomerSalesReportView(PolicyMixin, SalesReportHelperMixin, APIView):
+    policy = [allow(methods=['GET'], roles=['Manager'])]
+
+    def get(self, request, *args, **kwargs):
+        date_from, date_to = self.get_report_period(request)
+        limit = self.get_report_limit(request)
+        rows = (
+            DailyCustomerSales.objects
+            .filter(day__range=(date_from, date_to))
+            .values('user', 'user__username')
+            .annotate(orders=Sum('orders'), units=Sum('units'), revenue=Sum('revenue'))
+            .order_by('-revenue', 'user')[:limit]
+        )
+        return Response([
+            {'user': row['user'], 'username': row['user__username'], 'orders': row['orders'], 'units': row['units'], 'revenue': row['revenue']}
+            for row in rows
+        ], status=status.HTTP_200_OK)
@@ -13,4 +13,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once the apps are loaded.
+from api.streams import ORDER_EVENTS_PATH, order_events
+
+
+async def application(scope, receive, send):
+    # The event stream holds its connection open, so it is served here rather
+    # than by a Django view, which would tie up a worker thread per client.
+    if scope['type'] == 'http' and scope['path'] == ORDER_EVENTS_PATH:
+        return await order_events(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -77,6 +77,57 @@ DATABASES = {
     }
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': env('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': env('CACHE_LOCATION', default='littlelemon'),
+    }
+}
+
+ROLE_CACHE_TIMEOUT = 300
+
+MENU_SNAPSHOT_TIMEOUT = 600
+
+IDEMPOTENCY_KEY_TIMEOUT = 86400
+
+DISPATCH_ON_CHECKOUT = env.bool('DISPATCH_ON_CHECKOUT', default=False)
+
+DISPATCH_BATCH_SIZE = 500
+
+DISPATCH_REBUILD_INTERVAL = 60
+
+ORDER_EVENTS_BACKEND = env('ORDER_EVENTS_BACKEND', default='api.events.LocalEventBackend')
+
+ORDER_EVENTS_HEARTBEAT = 15
+
+ORDER_EVENTS_QUEUE_SIZE = 100
+
+ORDER_EVENTS_SETTLE = 2
+
+ORDER_EVENTS_POLL_INTERVAL = 1
+
+ORDER_EVENTS_PAGE_SIZE = 500
+
+ORDER_BULK_UPDATE_LIMIT = 500
+
+CART_BATCH_LIMIT = 100
+
+CART_BACKEND = env('CART_BACKEND', default='api.cart.DatabaseCartBackend')
+
+CART_CACHE_TIMEOUT = 86400
+
+CART_FLUSH_AFTER = 30
+
+CART_FLUSH_INTERVAL = 5
+
+CART_LOCK_TIMEOUT = 10
+
+CART_LOCK_WAIT = 5
+
+APPROXIMATE_COUNT_THRESHOLD = 10000
+
+APPROXIMATE_COUNT_TIMEOUT = 30
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -118,7 +169,7 @@ REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend',
         'rest_framework.filters.OrderingFilter',
-        'rest_framework.filters.SearchFilter',
+        'api.filters.TypedSearchFilter',
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 5
@@ -7,6 +7,11 @@ from rest_framework_simplejwt.views import (
     TokenBlacklistView,
 )
 
+from api.serializers import (
+    RoleClaimsTokenObtainPairSerializer,
+    RoleClaimsTokenRefreshSerializer,
+)
+
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -19,7 +24,15 @@ urlpatterns = [
     # path('api/', include('djoser.urls.authtoken')),
 
     # JWT
-    path('api/token/login/', TokenObtainPairView.as_view(),  name='token_obtain_pair'),
-    path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path(
+        'api/token/login/',
+        TokenObtainPairView.as_view(serializer_class=RoleClaimsTokenObtainPairSerializer),
+        name='token_obtain_pair',
+    ),
+    path(
+        'api/token/refresh/',
+        TokenRefreshView.as_view(serializer_class=RoleClaimsTokenRefreshSerializer),
+        name='token_refresh',
+    ),
     path('api/token/blacklist/', TokenBlacklistView.as_view(), name='token_blacklist'),
 ]
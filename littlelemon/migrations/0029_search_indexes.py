@@ -0,0 +1,55 @@
+# Generated by Django 4.1.7 on 2026-10-18 19:03
+
+from django.db import migrations, models
+
+
+SEARCH_INDEXES = [
+    ('littlelemon_menuitem_title_search', 'littlelemon_menuitem', 'title'),
+    ('littlelemon_category_title_search', 'littlelemon_category', 'title'),
+    ('littlelemon_category_slug_search', 'littlelemon_category', 'slug'),
+    ('auth_user_username_search', 'auth_user', 'username'),
+    ('auth_user_first_name_search', 'auth_user', 'first_name'),
+    ('auth_user_last_name_search', 'auth_user', 'last_name'),
+]
+
+
+def create_search_indexes(apps, schema_editor):
+    # Trigram indexes over the same UPPER(column::text) expression that
+    # icontains lookups compile to on PostgreSQL. Other databases can't use
+    # an index for a LIKE '%term%' match, so they get none.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for name, table, column in SEARCH_INDEXES:
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {name} ON {table} '
+            f'USING gin ((UPPER({column}::text)) gin_trgm_ops)'
+        )
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for name, table, column in SEARCH_INDEXES:
+            schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('littlelemon', '0028_rename_delivered_order_status'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='menuitem',
+            name='featured',
+            field=models.BooleanField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='menuitem',
+            name='price',
+            field=models.DecimalField(db_index=True, decimal_places=2, max_digits=6),
+        ),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.1.7 on 2026-10-18 19:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('littlelemon', '0032_access_pattern_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order_id', models.BigIntegerField()),
+                ('user_id', models.IntegerField()),
+                ('delivery_crew_id', models.IntegerField(null=True)),
+                ('kind', models.CharField(choices=[('created', 'Created'), ('assigned', 'Assigned'), ('status', 'Status'), ('deleted', 'Deleted')], max_length=16)),
+                ('status', models.BooleanField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='orderevent',
+            index=models.Index(fields=['user_id', 'id'], name='littlelemon_user_id_16e1bb_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderevent',
+            index=models.Index(fields=['delivery_crew_id', 'id'], name='littlelemon_deliver_5a4daf_idx'),
+        ),
+    ]
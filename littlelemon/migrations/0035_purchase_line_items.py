@@ -0,0 +1,19 @@
+# Generated by Django 4.1.7 on 2026-10-18 19:21
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('littlelemon', '0034_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='purchase',
+            name='line_items',
+            field=models.JSONField(blank=True, editable=False, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True),
+        ),
+    ]
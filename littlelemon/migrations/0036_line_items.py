@@ -0,0 +1,43 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# The purchase-items table becomes the line-items table, and carts get a
+# link table to it. 0037 moves the rows over and 0038 drops the old tables
+# and adds the constraints, each in a transaction of its own: PostgreSQL
+# can't alter a table that still has foreign key checks pending from the
+# rows moved in the same transaction.
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('littlelemon', '0035_purchase_line_items'),
+    ]
+
+    operations = [
+        migrations.RenameModel(
+            old_name='PurchaseItem',
+            new_name='LineItem',
+        ),
+        migrations.RenameIndex(
+            model_name='lineitem',
+            new_name='littlelemon_user_id_96bc5a_idx',
+            old_name='littlelemon_user_id_ae843a_idx',
+        ),
+        migrations.AddField(
+            model_name='lineitem',
+            name='state',
+            field=models.CharField(choices=[('cart', 'In cart'), ('purchased', 'Purchased')], default='purchased', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='lineitem',
+            name='purchase',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='littlelemon.purchase'),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='lineitems',
+            field=models.ManyToManyField(related_name='+', to='littlelemon.lineitem'),
+        ),
+    ]
@@ -0,0 +1,83 @@
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+
+# Purchase-items keep their ids in the line-items table. Order-items are
+# copied into it as cart line items, under new ids, and the carts are
+# pointed at the copies.
+
+def merge_line_items(apps, schema_editor):
+    LineItem = apps.get_model('littlelemon', 'LineItem')
+    OrderItem = apps.get_model('littlelemon', 'OrderItem')
+    Cart = apps.get_model('littlelemon', 'Cart')
+    Purchase = apps.get_model('littlelemon', 'Purchase')
+    PurchaseItems = Purchase._meta.get_field('purchaseitems').remote_field.through
+    OldCartItems = Cart._meta.get_field('orderitems').remote_field.through
+    NewCartItems = Cart._meta.get_field('lineitems').remote_field.through
+
+    LineItem.objects.update(purchase_id=Subquery(
+        PurchaseItems.objects.filter(lineitem_id=OuterRef('pk')).values('purchase_id')[:1]
+    ))
+
+    order_items = list(OrderItem.objects.order_by('id'))
+    line_items = LineItem.objects.bulk_create([
+        LineItem(
+            user_id = order_item.user_id,
+            menuitem_id = order_item.menuitem_id,
+            quantity = order_item.quantity,
+            unit_price = order_item.unit_price,
+            price = order_item.price,
+            state = 'cart',
+        )
+        for order_item in order_items
+    ])
+    new_ids = {order_item.pk: line_item.pk for order_item, line_item in zip(order_items, line_items)}
+    NewCartItems.objects.bulk_create([
+        NewCartItems(cart_id=cart_id, lineitem_id=new_ids[orderitem_id])
+        for cart_id, orderitem_id in OldCartItems.objects.values_list('cart_id', 'orderitem_id')
+    ])
+
+
+def split_line_items(apps, schema_editor):
+    LineItem = apps.get_model('littlelemon', 'LineItem')
+    OrderItem = apps.get_model('littlelemon', 'OrderItem')
+    Cart = apps.get_model('littlelemon', 'Cart')
+    Purchase = apps.get_model('littlelemon', 'Purchase')
+    PurchaseItems = Purchase._meta.get_field('purchaseitems').remote_field.through
+    OldCartItems = Cart._meta.get_field('orderitems').remote_field.through
+    NewCartItems = Cart._meta.get_field('lineitems').remote_field.through
+
+    cart_items = list(LineItem.objects.filter(state='cart').order_by('id'))
+    order_items = OrderItem.objects.bulk_create([
+        OrderItem(
+            user_id = line_item.user_id,
+            menuitem_id = line_item.menuitem_id,
+            quantity = line_item.quantity,
+            unit_price = line_item.unit_price,
+            price = line_item.price,
+        )
+        for line_item in cart_items
+    ])
+    old_ids = {line_item.pk: order_item.pk for line_item, order_item in zip(cart_items, order_items)}
+    OldCartItems.objects.bulk_create([
+        OldCartItems(cart_id=cart_id, orderitem_id=old_ids[lineitem_id])
+        for cart_id, lineitem_id in NewCartItems.objects.values_list('cart_id', 'lineitem_id')
+    ])
+    NewCartItems.objects.all().delete()
+    LineItem.objects.filter(state='cart').delete()
+
+    PurchaseItems.objects.bulk_create([
+        PurchaseItems(purchase_id=purchase_id, lineitem_id=lineitem_id)
+        for lineitem_id, purchase_id in LineItem.objects.filter(purchase__isnull=False).values_list('id', 'purchase_id')
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('littlelemon', '0036_line_items'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_line_items, split_line_items),
+    ]
@@ -0,0 +1,69 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('littlelemon', '0037_merge_line_items'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='cart',
+            name='orderitems',
+        ),
+        migrations.DeleteModel(
+            name='OrderItem',
+        ),
+        migrations.RemoveField(
+            model_name='purchase',
+            name='purchaseitems',
+        ),
+        migrations.RenameField(
+            model_name='cart',
+            old_name='lineitems',
+            new_name='orderitems',
+        ),
+        migrations.CreateModel(
+            name='OrderItem',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('littlelemon.lineitem',),
+        ),
+        migrations.CreateModel(
+            name='PurchaseItem',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('littlelemon.lineitem',),
+        ),
+        migrations.AlterField(
+            model_name='cart',
+            name='orderitems',
+            field=models.ManyToManyField(to='littlelemon.orderitem'),
+        ),
+        migrations.AlterField(
+            model_name='lineitem',
+            name='state',
+            field=models.CharField(choices=[('cart', 'In cart'), ('purchased', 'Purchased')], default='cart', max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='lineitem',
+            name='purchase',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='purchaseitems', to='littlelemon.purchase'),
+        ),
+        migrations.AddConstraint(
+            model_name='lineitem',
+            constraint=models.UniqueConstraint(condition=models.Q(('state', 'cart')), fields=('user', 'menuitem'), name='unique_cart_line_item'),
+        ),
+    ]
@@ -1,11 +1,12 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
 
 
 class MenuItem(models.Model):
     title = models.CharField(max_length=255, db_index=True)
-    price = models.DecimalField(max_digits=6, decimal_places=2)
-    featured = models.BooleanField()
+    price = models.DecimalField(max_digits=6, decimal_places=2, db_index=True)
+    featured = models.BooleanField(db_index=True)
     category = models.ForeignKey('littlelemon.Category', on_delete=models.PROTECT)
 
     def __str__(self):
@@ -20,15 +21,55 @@ class Category(models.Model):
         return self.title
 
 
-class OrderItem(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+# Order-items and purchase-items share this table, told apart by the state,
+# so checking out only flips the state of the cart items and sets their
+# purchase.
+class LineItem(models.Model):
+    IN_CART = 'cart'
+    PURCHASED = 'purchased'
+    STATE_CHOICES = [(IN_CART, 'In cart'), (PURCHASED, 'Purchased')]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     menuitem = models.ForeignKey(MenuItem, on_delete=models.PROTECT)
     quantity = models.SmallIntegerField()
     unit_price = models.DecimalField(max_digits=6, decimal_places=2)
     price = models.DecimalField(max_digits=6, decimal_places=2)
+    state = models.CharField(max_length=16, choices=STATE_CHOICES, default=IN_CART)
+    purchase = models.ForeignKey(
+        'littlelemon.Purchase',
+        on_delete = models.SET_NULL,
+        related_name = 'purchaseitems',
+        null = True, blank = True,
+    )
 
     class Meta:
-        unique_together = ['user', 'menuitem']
+        indexes = [models.Index(fields=['user', 'id'])]
+        constraints = [
+            models.UniqueConstraint(
+                fields = ['user', 'menuitem'],
+                condition = models.Q(state='cart'),
+                name = 'unique_cart_line_item',
+            ),
+        ]
+
+
+class OrderItemManager(models.Manager):
+
+    def get_queryset(self):
+        return super().get_queryset().filter(state=LineItem.IN_CART)
+
+
+class PurchaseItemManager(models.Manager):
+
+    def get_queryset(self):
+        return super().get_queryset().filter(state=LineItem.PURCHASED)
+
+
+class OrderItem(LineItem):
+    objects = OrderItemManager()
+
+    class Meta:
+        proxy = True
 
     def __str__(self):
         return f'{self.user.username} ordered items'
@@ -41,38 +82,150 @@ class Cart(models.Model):
     def __str__(self):
         return f'{self.user.username} cart'
 
-class PurchaseItem(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
-    menuitem = models.ForeignKey(MenuItem, on_delete=models.PROTECT)
-    quantity = models.SmallIntegerField()
-    unit_price = models.DecimalField(max_digits=6, decimal_places=2)
-    price = models.DecimalField(max_digits=6, decimal_places=2)
+class PurchaseItem(LineItem):
+    objects = PurchaseItemManager()
+
+    class Meta:
+        proxy = True
 
     def __str__(self):
         return f'{self.user.username} purchase items'
 
 
 class Purchase(models.Model):
-    user = models.ForeignKey(User, on_delete=models.SET_DEFAULT, default=0)
-    purchaseitems = models.ManyToManyField(PurchaseItem, default=0)
+    user = models.ForeignKey(User, on_delete=models.SET_DEFAULT, default=0, db_index=False)
+    # Copy of the purchase-items taken at checkout, so purchases can be read
+    # without joining them. Null for purchases not backfilled yet.
+    line_items = models.JSONField(encoder=DjangoJSONEncoder, null=True, blank=True, editable=False)
     date = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [models.Index(fields=['user', 'date', 'id'])]
+
     def __str__(self):
         return f'{self.user.username} purchase on {str(self.date).split(" ")[0]}'
 
 
 class Order(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     purchase = models.OneToOneField(Purchase, on_delete=models.PROTECT, default=0)
     delivery_crew = models.ForeignKey(
         User,
         on_delete = models.CASCADE, 
         related_name = 'delivery_crew',
         null = True, blank = True,
+        db_index = False,
     )
     status = models.BooleanField(db_index=True, default=0)
     total = models.DecimalField(max_digits=6, decimal_places=2)
     date = models.DateTimeField(auto_now_add=True, db_index=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'date', 'id']),
+            models.Index(fields=['delivery_crew', 'status', 'date']),
+        ]
+
     def __str__(self):
         return f'{self.user} order'
+
+
+class IdempotencyKey(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True)
+    response = models.JSONField(encoder=DjangoJSONEncoder, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['user', 'key']
+        indexes = [models.Index(fields=['user', 'created'])]
+
+    def __str__(self):
+        return f'{self.user.username} idempotency key {self.key}'
+
+
+class CheckoutJob(models.Model):
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    order = models.OneToOneField(Order, on_delete=models.SET_NULL, null=True, blank=True)
+    error = models.CharField(max_length=255, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'id'])]
+
+    def __str__(self):
+        return f'{self.user.username} checkout {self.status}'
+
+
+class OrderEvent(models.Model):
+    CREATED = 'created'
+    ASSIGNED = 'assigned'
+    STATUS = 'status'
+    DELETED = 'deleted'
+    KIND_CHOICES = [(CREATED, 'Created'), (ASSIGNED, 'Assigned'), (STATUS, 'Status'), (DELETED, 'Deleted')]
+
+    # Plain ids, so the events of a deleted order are kept.
+    order_id = models.BigIntegerField()
+    user_id = models.IntegerField()
+    delivery_crew_id = models.IntegerField(null=True)
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    status = models.BooleanField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_id', 'id']),
+            models.Index(fields=['delivery_crew_id', 'id']),
+        ]
+
+    def __str__(self):
+        return f'order {self.order_id} {self.kind}'
+
+
+class DailyItemSales(models.Model):
+    day = models.DateField()
+    menuitem = models.ForeignKey(MenuItem, on_delete=models.CASCADE)
+    units = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ['day', 'menuitem']
+
+    def __str__(self):
+        return f'{self.menuitem} sales on {self.day}'
+
+
+class DailyCategorySales(models.Model):
+    day = models.DateField()
+    category = models.ForeignKey(Category, on_delete=models.CASCADE)
+    units = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ['day', 'category']
+
+    def __str__(self):
+        return f'{self.category} sales on {self.day}'
+
+
+class DailyCustomerSales(models.Model):
+    day = models.DateField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    orders = models.IntegerField(default=0)
+    units = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ['day', 'user']
+
+    def __str__(self):
+        return f'{self.user.username} purchases on {self.day}'